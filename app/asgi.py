@@ -0,0 +1,399 @@
+"""Chế độ phục vụ ASGI (asyncio) cho các API đọc/ghi giao dịch.
+
+Chạy: gunicorn -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 asgi:app
+
+Các request chờ Redis hoặc chờ trạng thái giao dịch (long-poll, SSE) không giữ thread nào: Redis được gọi qua
+redis.asyncio với một connection pool dùng chung cho cả worker, việc render ảnh QR (tốn CPU) chạy trong thread pool
+riêng. Cấu hình, cache QR, bố cục lịch sử giao dịch và các luồng nền dùng chung với main.py.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import redis.asyncio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import parse_etags, quote_etag
+
+import metrics
+from status_events import AsyncTransactionStatusHub
+from mailbox_sources import MailboxHealth
+from transaction_store import AsyncTransactionStore, TransactionStore
+
+# Như replay.py: main kết nối Redis và khởi tạo các kho khi import nên được import với
+# BACKGROUND_WORKERS_ENABLED=false để không chuyển đổi lịch sử, render QR hay chạy luồng nền ở mỗi worker khi import;
+# theo cấu hình gốc, main.start() được gọi trong lifespan
+BACKGROUND_WORKERS_ENABLED = os.environ.get('BACKGROUND_WORKERS_ENABLED', 'true').lower() == 'true'
+os.environ['BACKGROUND_WORKERS_ENABLED'] = 'false'
+import main
+
+logger = logging.getLogger(__name__)
+
+ASYNC_REDIS_MAX_CONNECTIONS = int(os.environ.get('ASYNC_REDIS_MAX_CONNECTIONS', 100))
+ASYNC_REDIS_POOL_TIMEOUT = float(os.environ.get('ASYNC_REDIS_POOL_TIMEOUT', 5))
+ASGI_QR_WORKERS = int(os.environ.get('ASGI_QR_WORKERS', os.cpu_count() or 1))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Pool, hub và executor gắn với event loop của worker nên được tạo khi ứng dụng khởi động
+    # Cùng cấu hình với main.redis_client (Sentinel, replica, timeout, thử lại), pool riêng cho mỗi worker
+    app.state.redis, app.state.redis_reader = main.redis_settings.create_async_clients(
+        max_connections=ASYNC_REDIS_MAX_CONNECTIONS, pool_timeout=ASYNC_REDIS_POOL_TIMEOUT)
+    app.state.status_hub = AsyncTransactionStatusHub(app.state.redis)
+    app.state.history = AsyncTransactionStore(app.state.redis_reader, main.transaction_store_reader)
+    app.state.qr_executor = ThreadPoolExecutor(max_workers=ASGI_QR_WORKERS, thread_name_prefix='qr')
+    if BACKGROUND_WORKERS_ENABLED:
+        await run_in_threadpool(main.start)
+    try:
+        yield
+    finally:
+        await app.state.status_hub.close()
+        await app.state.redis.aclose(close_connection_pool=True)
+        if app.state.redis_reader is not app.state.redis:
+            await app.state.redis_reader.aclose(close_connection_pool=True)
+        app.state.qr_executor.shutdown(wait=False)
+
+
+def authorized(request):
+    return request.headers.get('Authorization') == f'Bearer {main.API_KEY}'
+
+
+def unauthorized():
+    return JSONResponse({'message': 'Unauthorized'}, 401)
+
+
+async def render_in_executor(request, func, *args):
+    """Chạy hàm render QR (tốn CPU) trong thread pool để không chặn event loop."""
+    return await asyncio.get_running_loop().run_in_executor(request.app.state.qr_executor, func, *args)
+
+
+def render_dynamic_qr(amount, code, scale, kind):
+    image = main.render_qr_image(main.BANK_CODE, main.ACCOUNT_NUMBER, amount, code, kind=kind, scale=scale)
+    return base64.b64encode(image).decode('utf-8')
+
+
+async def create_transaction(request):
+    """Như /create_transaction của main.py."""
+    if not authorized(request):
+        return unauthorized()
+
+    try:
+        data = await request.json()
+        transaction_id = data.get('transaction_id')
+        amount = data.get('amount')
+        if not transaction_id or not amount:
+            return JSONResponse({'message': 'Missing transaction_id or amount'}, 400)
+
+        try:
+            qr_format, qr_scale = main.parse_qr_options(data)
+        except ValueError as e:
+            return JSONResponse({'message': 'Invalid QR options', 'error': str(e)}, 400)
+
+        timestamp = int(time.time())
+        # Mã được cấp từ khối đã đặt trước trong bộ nhớ, chỉ thỉnh thoảng mới cần một lệnh Redis
+        code = await run_in_threadpool(main.transaction_code_generator.generate)
+
+        # queue_pending_transaction chỉ đưa lệnh vào pipeline nên dùng được với pipeline của redis.asyncio
+        pipe = request.app.state.redis.pipeline()
+        main.queue_pending_transaction(pipe, code, transaction_id, amount, timestamp)
+        await pipe.execute()
+
+        logger.info(f"Đã tạo mã giao dịch tạm thời: {code} cho transaction_id: {transaction_id} với transaction_amount: {amount} (hết hạn sau {main.TRANSACTION_CODE_EXPIRATION} giây), type: receive, status: pending")
+
+        qr_code_base64 = await render_in_executor(request, render_dynamic_qr, amount, code, qr_scale, qr_format)
+
+        return JSONResponse({
+            "status": "success",
+            "transaction_id": transaction_id,
+            "code": code,
+            "qr_code_data": qr_code_base64,
+            "qr_code_format": qr_format,
+            "amount": amount,
+            "expires_at": timestamp + main.TRANSACTION_CODE_EXPIRATION,
+            "message": ""
+        }, 201)
+
+    except Exception as e:
+        logger.error(f"Lỗi khi tạo mã giao dịch: {e}")
+        return JSONResponse({'message': 'Error creating transaction', 'error': str(e)}, 500)
+
+
+async def generate_qr_code(request):
+    """Như /qrpay của main.py."""
+    try:
+        data = await request.json()
+        bank_code = data.get('bank_code', main.BANK_CODE)
+        account_number = data.get('account_number', main.ACCOUNT_NUMBER)
+        purpose = data.get('purpose', main.DEFAULT_QR_PURPOSE)
+
+        if not bank_code or not account_number:
+            return JSONResponse({'message': 'Missing bank_code or account_number'}, 400)
+
+        try:
+            qr_format, qr_scale = main.parse_qr_options(data)
+        except ValueError as e:
+            return JSONResponse({'message': 'Invalid QR options', 'error': str(e)}, 400)
+
+        etag = main.static_qr_cache_key(bank_code, account_number, purpose, qr_format, qr_scale)
+        headers = {'ETag': quote_etag(etag), 'Cache-Control': f'public, max-age={main.QR_CACHE_MAX_AGE}'}
+        if etag in parse_etags(request.headers.get('If-None-Match')):
+            return Response(status_code=304, headers=headers)
+
+        # Ảnh đã có trong cache của process thì trả về ngay, không cần chuyển sang thread pool
+        image = main.qr_image_cache.peek(etag)
+        if image is None:
+            image = await render_in_executor(request, main.render_static_qr, bank_code, account_number, purpose,
+                                             qr_format, qr_scale)
+        return Response(image, media_type=main.QR_MIMETYPES[qr_format], headers=headers)
+
+    except Exception as e:
+        logger.error(f"Lỗi khi tạo mã QR: {e}")
+        return JSONResponse({'message': 'Error generating QR code', 'error': str(e)}, 500)
+
+
+async def transaction_status_response(redis_client, code):
+    """Như main.transaction_status_response nhưng đọc Redis bất đồng bộ."""
+    data = await redis_client.hgetall(f"{main.PENDING_TRANSACTION_PREFIX}{code}")
+    if data:
+        transaction = {field.decode(): value.decode() for field, value in data.items()}
+    else:
+        # Không còn trong pending thì đọc từ lịch sử giao dịch
+        data = await redis_client.hgetall(main.transaction_store.record_key(code))
+        if data:
+            transaction = TransactionStore._decode(data)
+        elif main.history_archive is not None:
+            # Giao dịch cũ đã được lưu trữ ra đĩa
+            transaction = await run_in_threadpool(main.history_archive.get, code)
+        else:
+            transaction = None
+        if transaction is None:
+            return None
+    status = transaction.get('status')
+    return {
+        'status': status,
+        'amount': transaction.get('amount'),
+        'timestamp': transaction.get('timestamp'),
+        'transaction_id': transaction.get('transaction_id'),
+        'description': transaction.get('description'),
+        'message': main.get_status_message(status)
+    }
+
+
+async def wait_for_transaction_status(request, code, last_status, timeout):
+    """Như main.wait_for_transaction_status, chờ trên asyncio.Queue thay vì giữ một thread."""
+    hub = request.app.state.status_hub
+    waiter = await hub.subscribe(code)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            transaction = await transaction_status_response(request.app.state.redis, code)
+            if transaction is None:
+                return None
+            if last_status is None:
+                last_status = transaction['status']
+            remaining = deadline - time.monotonic()
+            if transaction['status'] != last_status or remaining <= 0:
+                return transaction
+            try:
+                await asyncio.wait_for(waiter.get(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        hub.unsubscribe(code, waiter)
+
+
+async def check_transaction_status(request):
+    """Như /check_transaction_status của main.py (hỗ trợ long-poll bằng `wait`/`last_status`)."""
+    if not authorized(request):
+        return unauthorized()
+
+    code = request.query_params.get('code')
+    if not code:
+        return JSONResponse({'message': 'Missing transaction code'}, 400)
+
+    try:
+        wait = float(request.query_params.get('wait', 0))
+    except ValueError:
+        wait = None
+    if wait is None or not 0 <= wait <= main.STATUS_LONG_POLL_MAX_WAIT:
+        return JSONResponse({'message': f'wait must be between 0 and {main.STATUS_LONG_POLL_MAX_WAIT}'}, 400)
+
+    if wait:
+        transaction = await wait_for_transaction_status(request, code, request.query_params.get('last_status'), wait)
+    else:
+        transaction = await transaction_status_response(request.app.state.redis_reader, code)
+        if transaction is None and main.redis_settings.reads_from_replica:
+            # Giao dịch vừa tạo có thể chưa có trên replica
+            transaction = await transaction_status_response(request.app.state.redis, code)
+
+    if transaction is None:
+        return JSONResponse({'message': 'Transaction not found'}, 404)
+    return JSONResponse(transaction, 200)
+
+
+async def stream_transaction_status(request):
+    """Như /transaction_status/stream của main.py (Server-Sent Events)."""
+    if not authorized(request):
+        return unauthorized()
+
+    code = request.query_params.get('code')
+    if not code:
+        return JSONResponse({'message': 'Missing transaction code'}, 400)
+
+    redis_client = request.app.state.redis
+    if await transaction_status_response(redis_client, code) is None:
+        return JSONResponse({'message': 'Transaction not found'}, 404)
+
+    async def generate():
+        # Đăng ký trong generator để luôn hủy đăng ký khi stream kết thúc hoặc client ngắt kết nối
+        hub = request.app.state.status_hub
+        waiter = await hub.subscribe(code)
+        try:
+            last_status = None
+            deadline = time.monotonic() + main.STATUS_STREAM_TIMEOUT
+            transaction = await transaction_status_response(redis_client, code)
+            while True:
+                if transaction is not None and transaction['status'] != last_status:
+                    yield f"event: status\ndata: {json.dumps(transaction)}\n\n"
+                    last_status = transaction['status']
+                    if last_status in main.FINAL_TRANSACTION_STATUSES:
+                        return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(waiter.get(), min(remaining, main.STATUS_STREAM_HEARTBEAT))
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                transaction = await transaction_status_response(redis_client, code)
+        finally:
+            hub.unsubscribe(code, waiter)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def anext_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def get_transaction_history(request):
+    """Như /transaction_history của main.py, duyệt lịch sử bằng AsyncTransactionStore."""
+    if not authorized(request):
+        return unauthorized()
+
+    args = request.query_params
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+        if limit is not None and not 0 < limit <= main.HISTORY_PAGE_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {main.HISTORY_PAGE_MAX_LIMIT}")
+        since = main.parse_history_time_param(args.get('since'))
+        until = main.parse_history_time_param(args.get('until'))
+        cursor = main.decode_history_cursor(args['cursor']) if args.get('cursor') else None
+    except ValueError as e:
+        return JSONResponse({'message': 'Invalid query parameters', 'error': str(e)}, 400)
+
+    filters = {
+        'type': args.get('type'),
+        'phone_number': args.get('phone_number'),
+        'transaction_id': args.get('transaction_id'),
+    }
+
+    try:
+        results = request.app.state.history.query(
+            filters,
+            status=args.get('status'),
+            min_score=since if since is not None else '-inf',
+            max_score=until if until is not None else '+inf',
+            after=cursor,
+            batch_size=main.HISTORY_SCAN_BATCH_SIZE,
+        )
+
+        if limit is not None:
+            transactions, next_cursor = [], None
+            async for score, record_id, transaction in results:
+                if len(transactions) == limit:
+                    next_cursor = main.encode_history_cursor(*last)
+                    break
+                transactions.append(transaction)
+                last = (score, record_id)
+            await results.aclose()
+            return JSONResponse({'transactions': transactions, 'next_cursor': next_cursor}, 200)
+
+        first = await anext_or_none(results)
+        if first is None:
+            return JSONResponse({'message': 'No transactions found'}, 404)
+
+        async def generate():
+            try:
+                yield json.dumps(first[2]) + "\n"
+                async for _, _, transaction in results:
+                    yield json.dumps(transaction) + "\n"
+            finally:
+                await results.aclose()
+
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+    except Exception as e:
+        logger.error(f"Lỗi khi lấy lịch sử giao dịch: {e}")
+        return JSONResponse({'message': 'Error retrieving transaction history', 'error': str(e)}, 500)
+
+
+async def health(request):
+    """Như /health của main.py, kiểm tra cả pool Redis bất đồng bộ."""
+    redis_client = request.app.state.redis
+    try:
+        await redis_client.ping()
+        redis_ok = True
+    except redis.exceptions.RedisError:
+        redis_ok = False
+
+    try:
+        leader_status = await run_in_threadpool(main.leader_elector.status)
+    except redis.exceptions.RedisError as e:
+        leader_status = {'instance_id': main.leader_elector.instance_id, 'error': str(e)}
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for source in main.mailbox_sources:
+            pipe.hgetall(MailboxHealth(redis_client, source.name).key)
+        mailboxes = {source.name: MailboxHealth.decode_status(data)
+                     for source, data in zip(main.mailbox_sources, await pipe.execute())}
+    except redis.exceptions.RedisError as e:
+        mailboxes = {'error': str(e)}
+
+    write_buffer = main.write_buffer
+    return JSONResponse({
+        'status': 'ok' if redis_ok else 'degraded',
+        'redis': redis_ok,
+        'background_workers': BACKGROUND_WORKERS_ENABLED,
+        'mailboxes': mailboxes,
+        'write_buffer': {'enabled': write_buffer.enabled, 'pending': await run_in_threadpool(write_buffer.pending)},
+        **leader_status
+    }, 200 if redis_ok else 503)
+
+
+async def metrics_endpoint(request):
+    """Như /metrics của main.py (gauge trạng thái đọc Redis đồng bộ nên chạy trong thread pool)."""
+    return Response(await run_in_threadpool(metrics.render), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+app = Starlette(routes=[
+    Route('/create_transaction', create_transaction, methods=['POST']),
+    Route('/qrpay', generate_qr_code, methods=['POST']),
+    Route('/check_transaction_status', check_transaction_status, methods=['GET']),
+    Route('/transaction_status/stream', stream_transaction_status, methods=['GET']),
+    Route('/transaction_history', get_transaction_history, methods=['GET']),
+    Route('/health', health, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+], lifespan=lifespan)
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+EMAIL_LEDGER_PREFIX = os.environ.get('EMAIL_LEDGER_PREFIX', 'email_ledger:')
+
+# Nhận quyền xử lý một email một cách nguyên tử.
+# KEYS[1] = entry key, KEYS[2] = retry zset
+# ARGV: message_key, owner, now, claim_timeout, ttl, body, source
+CLAIM_SCRIPT = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status == 'processed' or status == 'dead' then
+    return 0
+end
+if status == 'claimed' then
+    local claimed_at = tonumber(redis.call('HGET', KEYS[1], 'claimed_at') or '0')
+    if tonumber(ARGV[3]) - claimed_at < tonumber(ARGV[4]) then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], 'status', 'claimed', 'owner', ARGV[2], 'claimed_at', ARGV[3])
+redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+if ARGV[6] ~= '' then
+    redis.call('HSET', KEYS[1], 'body', ARGV[6])
+end
+if ARGV[7] ~= '' then
+    redis.call('HSET', KEYS[1], 'source', ARGV[7])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+-- Nếu tiến trình chết giữa chừng, email sẽ được xử lý lại sau claim_timeout
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]) + tonumber(ARGV[4]), ARGV[1])
+return 1
+"""
+
+# Ghi nhận xử lý lỗi, chỉ khi email vẫn đang được chính lượt nhận quyền này xử lý (compare-and-set). Email đã
+# processed (MULTI/EXEC đã chạy dù client báo lỗi) hoặc đã bị tiến trình khác nhận lại thì không bị thay đổi.
+# KEYS[1] = entry key, KEYS[2] = retry zset
+# ARGV: message_key, owner, now, error, max_attempts, retry_backoff
+# Trả về 0 nếu không còn giữ quyền, 1 nếu chuyển sang failed, 2 nếu chuyển sang dead
+MARK_FAILED_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'claimed' or redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] then
+    return 0
+end
+local attempts = tonumber(redis.call('HGET', KEYS[1], 'attempts') or '0')
+if attempts >= tonumber(ARGV[5]) then
+    redis.call('HSET', KEYS[1], 'status', 'dead', 'error', ARGV[4], 'updated_at', ARGV[3])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 2
+end
+redis.call('HSET', KEYS[1], 'status', 'failed', 'error', ARGV[4], 'updated_at', ARGV[3])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]) + tonumber(ARGV[6]) * 2 ^ (attempts - 1), ARGV[1])
+return 1
+"""
+
+
+def message_key(message_id, body):
+    """Khóa định danh email: Message-ID nếu có, ngược lại là SHA-256 của nội dung."""
+    if message_id and message_id.strip():
+        return message_id.strip()
+    return "sha256:" + hashlib.sha256(body.encode()).hexdigest()
+
+
+class EmailLedger:
+    """Sổ ghi nhận email đã xử lý trong Redis để mỗi email chỉ được xử lý đúng một lần.
+
+    Trạng thái của mỗi email: claimed (đang xử lý), processed, failed (chờ thử lại) và dead (quá số lần thử).
+    Email claimed/failed nằm trong zset retry với score là thời điểm được phép xử lý lại, nên có thể
+    chạy nhiều watcher song song mà không xác nhận giao dịch hai lần.
+    """
+
+    def __init__(self, redis_client, ttl=30 * 24 * 3600, claim_timeout=300, max_attempts=5,
+                 retry_backoff=60, prefix=EMAIL_LEDGER_PREFIX):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.prefix = prefix
+        self.retry_key = f"{prefix}retry"
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self._mark_failed_script = redis_client.register_script(MARK_FAILED_SCRIPT)
+
+    def entry_key(self, key):
+        return f"{self.prefix}entry:{key}"
+
+    def claim(self, key, body='', source=''):
+        """Nhận quyền xử lý email. Trả về None nếu email đã được xử lý hoặc đang được tiến trình khác xử lý.
+
+        Khi nhận được quyền, trả về owner của lượt nhận quyền này (riêng cho từng lượt, kể cả trong cùng process)
+        để truyền cho mark_failed(). source là tên hộp thư nhận email, được lưu cùng nội dung để lần xử lý lại
+        dùng đúng cấu hình hộp thư.
+        """
+        owner = f"{self.owner}:{uuid.uuid4().hex[:8]}"
+        claimed = self._claim_script(
+            keys=[self.entry_key(key), self.retry_key],
+            args=[key, owner, time.time(), self.claim_timeout, self.ttl, body, source or ''],
+        )
+        return owner if claimed else None
+
+    def mark_processed(self, key, pipe=None):
+        """Đánh dấu email đã xử lý xong, có thể nằm trong pipeline của caller (cùng các thay đổi trạng thái)."""
+        target = pipe if pipe is not None else self.redis.pipeline()
+        target.hset(self.entry_key(key), mapping={'status': 'processed', 'updated_at': time.time()})
+        target.hdel(self.entry_key(key), 'body', 'error')
+        target.zrem(self.retry_key, key)
+        if pipe is None:
+            target.execute()
+
+    def mark_failed(self, key, error, owner):
+        """Ghi nhận xử lý lỗi. Email được thử lại với backoff tăng dần, quá max_attempts thì chuyển sang dead.
+
+        owner là giá trị claim() trả về: chỉ có tác dụng khi email vẫn đang được lượt nhận quyền đó xử lý.
+        Trả về trạng thái mới ('failed' hoặc 'dead'), None nếu không còn giữ quyền.
+        """
+        result = self._mark_failed_script(
+            keys=[self.entry_key(key), self.retry_key],
+            args=[key, owner, time.time(), str(error), self.max_attempts, self.retry_backoff],
+        )
+        if result == 2:
+            logger.error(f"Email {key} xử lý lỗi {self.max_attempts} lần, ngừng thử lại: {error}")
+            return 'dead'
+        if result == 0:
+            logger.warning(f"Email {key} đã được xử lý xong hoặc được tiến trình khác nhận lại, bỏ qua lỗi: {error}")
+            return None
+        return 'failed'
+
+    def due_entries(self, limit=50):
+        """Các email failed hoặc claimed quá hạn đã đến lúc thử lại, trả về danh sách (key, body, source)."""
+        keys = [key.decode() for key in self.redis.zrangebyscore(self.retry_key, '-inf', time.time(), start=0, num=limit)]
+        if not keys:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(self.entry_key(key), 'body', 'source')
+        entries = []
+        for key, (body, source) in zip(keys, pipe.execute()):
+            if body is None:
+                # Bản ghi đã hết hạn hoặc không còn nội dung để xử lý lại
+                self.redis.zrem(self.retry_key, key)
+                continue
+            entries.append((key, body.decode(), source.decode() if source else None))
+        return entries
+
+    def status(self, key):
+        status = self.redis.hget(self.entry_key(key), 'status')
+        return status.decode() if status else None
+
+    def statuses(self, keys):
+        """Trạng thái của nhiều email trong một round trip, None với email chưa có trong sổ."""
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(self.entry_key(key), 'status')
+        return [status.decode() if status else None for status in pipe.execute()]
@@ -0,0 +1,187 @@
+import logging
+import re
+from datetime import datetime
+from html import unescape
+from html.parser import HTMLParser
+
+logger = logging.getLogger(__name__)
+
+PHONE_NUMBER_PATTERN = re.compile(r"NT\d{10}")
+TRANSACTION_CODE_PATTERN = re.compile(r"VCD\d{10}")
+HTML_HINT_PATTERN = re.compile(r"<(?:p|br|div|td|tr|table|html|body|span)\b", re.IGNORECASE)
+
+# Thẻ HTML kết thúc một dòng khi chuyển sang văn bản
+HTML_BLOCK_TAGS = {'p', 'br', 'div', 'tr', 'li', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+
+class _HTMLTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self.skip += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            self.skip = max(self.skip - 1, 0)
+        elif tag in HTML_BLOCK_TAGS or tag == 'td':
+            self.chunks.append('\n' if tag != 'td' else ' ')
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    """Chuyển HTML sang văn bản, mỗi khối (p, div, br, tr...) thành một dòng."""
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    lines = (re.sub(r"[ \t\r\f\v\xa0]+", " ", line).strip() for line in unescape(''.join(parser.chunks)).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def normalize_body(body, content_type=None):
+    """Trả về nội dung dạng văn bản, chuyển HTML nếu cần."""
+    if content_type == 'text/html' or (content_type is None and '<' in body and HTML_HINT_PATTERN.search(body)):
+        return html_to_text(body)
+    return body
+
+
+def extract_body(msg):
+    """Lấy nội dung văn bản của email: ưu tiên text/plain, sau đó text/html, giải mã theo charset của từng phần.
+
+    Trả về None nếu email không có phần văn bản nào.
+    """
+    html_part = None
+    for part in msg.walk():
+        content_type = part.get_content_type()
+        if part.is_multipart() or content_type not in ('text/plain', 'text/html'):
+            continue
+        if content_type == 'text/plain':
+            return _decode_part(part)
+        if html_part is None:
+            html_part = part
+    if html_part is not None:
+        return html_to_text(_decode_part(html_part))
+    return None
+
+
+def _decode_part(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+class BankAlertParser:
+    """Parser cho một định dạng email biến động số dư.
+
+    Lớp con khai báo `name` và `pattern` (một regex duy nhất, mỗi trường là một named group trong các nhánh
+    thay thế) để toàn bộ nội dung chỉ cần quét một lần.
+    """
+
+    name = None
+    pattern = None
+    amount_fields = ()
+    time_format = "%d/%m/%Y %H:%M"
+    time_suffix = "+07:00"
+
+    def parse(self, body, content_type=None):
+        text = normalize_body(body, content_type)
+        details = dict.fromkeys(self.pattern.groupindex)
+        remaining = len(details)
+        for match in self.pattern.finditer(text):
+            # Mỗi nhánh của regex chỉ có một group nên lastgroup là trường vừa khớp
+            field = match.lastgroup
+            if details[field] is None:
+                details[field] = match.group(field)
+                remaining -= 1
+                if not remaining:
+                    break
+
+        for field in self.amount_fields:
+            if details[field]:
+                details[field] = details[field].replace('.', '').replace(',', '')
+        if details.get('description'):
+            details['description'] = details['description'].strip()
+
+        # Chuyển đổi sang định dạng ISO 8601
+        if details.get('time'):
+            try:
+                details['time'] = self.parse_time(details['time']).isoformat() + self.time_suffix
+            except ValueError:
+                logger.info("Lỗi: Định dạng thời gian không hợp lệ.")
+
+        description = details.get('description') or ''
+        phone_number = PHONE_NUMBER_PATTERN.search(description)
+        code = TRANSACTION_CODE_PATTERN.search(description)
+        details['phone_number'] = phone_number.group(0) if phone_number else None
+        details['code'] = code.group(0) if code else None
+        return details
+
+    def parse_time(self, value):
+        return datetime.strptime(value, self.time_format)
+
+
+class CakeAlertParser(BankAlertParser):
+    """Email biến động số dư của Cake/Timo."""
+
+    name = 'cake'
+    pattern = re.compile(
+        r"vừa tăng (?P<amount_increased>[\d,.]+) VND"
+        r"|vừa giảm (?P<amount_decreased>[\d,.]+) VND"
+        r"|vào (?P<time>\d{2}/\d{2}/\d{4} \d{2}:\d{2})"
+        r"|Số dư hiện tại: (?P<current_balance>[\d,.]+) VND"
+        # Mô tả lấy tới hết dòng nhưng không tiêu thụ nội dung (lookahead) nên các trường đứng sau trên cùng dòng
+        # vẫn được tìm thấy, như khi tìm riêng từng trường
+        r"|Mô tả: (?=(?P<description>[^\n]+))"
+    )
+    amount_fields = ('amount_increased', 'amount_decreased', 'current_balance')
+
+    def parse_time(self, value):
+        # Regex đã đảm bảo dạng dd/mm/YYYY HH:MM nên cắt chuỗi trực tiếp, nhanh hơn strptime nhiều lần
+        return datetime(int(value[6:10]), int(value[3:5]), int(value[0:2]), int(value[11:13]), int(value[14:16]))
+
+
+PARSERS = {}
+
+
+def register_parser(parser):
+    """Đăng ký parser cho một định dạng email ngân hàng mới."""
+    PARSERS[parser.name] = parser
+    return parser
+
+
+def get_parser(name='cake'):
+    return PARSERS[name]
+
+
+def parse(body, parser='cake', content_type=None):
+    """Trích xuất chi tiết giao dịch từ nội dung email bằng parser đã đăng ký."""
+    return get_parser(parser).parse(body, content_type)
+
+
+def parse_many(bodies, parser='cake', executor=None, chunksize=64):
+    """Trích xuất hàng loạt (ví dụ khi xử lý lại email tồn đọng).
+
+    Có thể truyền executor (ví dụ ProcessPoolExecutor) để chạy song song, kết quả giữ nguyên thứ tự.
+    """
+    engine = get_parser(parser)
+    if executor is None:
+        return [engine.parse(body) for body in bodies]
+    return list(executor.map(_parse_with, [parser] * len(bodies), bodies, chunksize=chunksize))
+
+
+def _parse_with(parser, body):
+    return get_parser(parser).parse(body)
+
+
+register_parser(CakeAlertParser())
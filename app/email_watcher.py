@@ -0,0 +1,323 @@
+import email
+import imaplib
+import logging
+import re
+import select
+import ssl
+import time
+
+from metrics import IMAP_COMMAND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def open_imap_connection(host, port=None, use_ssl=True, timeout=None):
+    """Mở kết nối IMAP (SSL hoặc thường, dùng cho server IMAP giả lập khi kiểm thử)."""
+    if use_ssl:
+        return imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT, timeout=timeout)
+    return imaplib.IMAP4(host, port or imaplib.IMAP4_PORT, timeout=timeout)
+
+
+class ImapIdleWatcher:
+    """Giữ một kết nối IMAP đã đăng nhập và xử lý email mới ngay khi server báo (IMAP IDLE, RFC 2177).
+
+    - on_new_mail(mail) được gọi với kết nối đã chọn hộp thư: một lần sau mỗi lần kết nối và mỗi khi có email mới.
+    - Tự kết nối lại với backoff tăng dần khi mất kết nối hoặc đăng nhập lỗi.
+    - Nếu server không hỗ trợ IDLE, chuyển sang kiểm tra định kỳ mỗi poll_interval giây trên cùng kết nối.
+    - health (nếu có, ví dụ MailboxHealth) được báo succeeded() sau mỗi lượt thành công và failed() khi lỗi.
+    """
+
+    def __init__(self, connect, login, password, on_new_mail, folder="inbox", poll_interval=20,
+                 idle_timeout=29 * 60, initial_backoff=1, max_backoff=300, should_run=None, health=None):
+        self.connect = connect
+        self.login = login
+        self.password = password
+        self.on_new_mail = on_new_mail
+        self.folder = folder
+        self.poll_interval = poll_interval
+        # RFC 2177: client nên gửi lại IDLE trước 29 phút để server không ngắt kết nối
+        self.idle_timeout = idle_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.running = True
+        # Cho phép dừng watcher từ bên ngoài, ví dụ khi instance mất quyền leader
+        self.should_run = should_run or (lambda: True)
+        self.health = health
+
+    def stop(self):
+        self.running = False
+
+    def is_running(self):
+        return self.running and self.should_run()
+
+    def run(self):
+        backoff = self.initial_backoff
+        while self.is_running():
+            mail = None
+            try:
+                with IMAP_COMMAND_SECONDS.labels('connect').time():
+                    mail = self.connect()
+                with IMAP_COMMAND_SECONDS.labels('login').time():
+                    mail.login(self.login, self.password)
+                with IMAP_COMMAND_SECONDS.labels('select').time():
+                    mail.select(self.folder)
+                supports_idle = 'IDLE' in mail.capabilities
+                logger.info(f"Đã kết nối IMAP, chế độ: {'IDLE' if supports_idle else 'polling'}")
+                backoff = self.initial_backoff
+
+                # Xử lý email đến trong lúc chưa kết nối
+                self.process(mail)
+                self._report(True)
+                while self.is_running():
+                    if supports_idle:
+                        new_mail = self.idle(mail, self.idle_timeout)
+                        if new_mail:
+                            self.process(mail)
+                        # Chu kỳ IDLE kết thúc bình thường nghĩa là kết nối tới hộp thư vẫn hoạt động
+                        self._report(True)
+                    else:
+                        time.sleep(self.poll_interval)
+                        with IMAP_COMMAND_SECONDS.labels('noop').time():
+                            mail.noop()
+                        self.process(mail)
+                        self._report(True)
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.error(f"Lỗi kết nối IMAP: {e}. Kết nối lại sau {backoff} giây")
+                self._report(False, e, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý email: {e}. Kết nối lại sau {backoff} giây")
+                self._report(False, e, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if mail is not None:
+                    try:
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def _report(self, ok, error=None, retry_in=0):
+        if self.health is None:
+            return
+        try:
+            if ok:
+                self.health.succeeded()
+            else:
+                self.health.failed(error, retry_in)
+        except Exception as e:
+            logger.warning(f"Lỗi khi ghi tình trạng hộp thư: {e}")
+
+    def process(self, mail):
+        """Gọi on_new_mail, lặp lại nếu server báo có email mới (EXISTS) ngay trong lúc đang xử lý.
+
+        Các thông báo EXISTS đi kèm phản hồi SEARCH/FETCH/STORE được imaplib giữ lại và server sẽ không gửi lại
+        khi vào IDLE, nên nếu bỏ qua chúng email đó phải chờ tới lần IDLE hết hạn mới được xử lý.
+        """
+        while self.is_running():
+            mail.untagged_responses.pop('EXISTS', None)
+            self.on_new_mail(mail)
+            if not mail.untagged_responses.get('EXISTS'):
+                return
+
+    def idle(self, mail, timeout):
+        """Gửi IDLE và chờ tối đa timeout giây. Trả về True nếu server báo có email mới (EXISTS).
+
+        Trong lúc IDLE, dữ liệu được đọc trực tiếp từ socket (imaplib không hỗ trợ IDLE) để có thể chờ bằng select.
+        """
+        sock = mail.socket()
+        tag = mail._new_tag()
+        mail.send(tag + b' IDLE\r\n')
+        reader = _LineReader(sock)
+
+        line = reader.readline(timeout=30)
+        if line is None or not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE không được chấp nhận: {line!r}")
+
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while self.is_running() and not new_mail:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Chia nhỏ thời gian chờ để stop() có hiệu lực nhanh
+            line = reader.readline(timeout=min(remaining, 1))
+            if line is None:
+                continue
+            new_mail = _is_new_mail_response(line)
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(f"Server đóng kết nối: {line!r}")
+
+        mail.send(b'DONE\r\n')
+        while True:
+            line = reader.readline(timeout=30)
+            if line is None:
+                raise imaplib.IMAP4.abort("Không nhận được phản hồi kết thúc IDLE")
+            if line.startswith(tag):
+                if not line[len(tag):].strip().upper().startswith(b'OK'):
+                    raise imaplib.IMAP4.error(f"IDLE kết thúc với lỗi: {line!r}")
+                return new_mail
+            new_mail = new_mail or _is_new_mail_response(line)
+
+
+def _is_new_mail_response(line):
+    parts = line.split()
+    return len(parts) >= 3 and parts[0] == b'*' and parts[2].upper() == b'EXISTS'
+
+
+class _LineReader:
+    """Đọc từng dòng phản hồi IMAP từ socket với timeout, hỗ trợ cả socket SSL."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def readline(self, timeout):
+        deadline = time.monotonic() + timeout
+        while b'\r\n' not in self.buffer:
+            pending = isinstance(self.sock, ssl.SSLSocket) and self.sock.pending()
+            if not pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                readable, _, _ = select.select([self.sock], [], [], remaining)
+                if not readable:
+                    return None
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise imaplib.IMAP4.abort("Kết nối IMAP bị đóng")
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+
+def format_uid_set(uids):
+    """Gộp danh sách UID thành chuỗi sequence-set IMAP gọn, ví dụ [1, 2, 3, 7] -> '1:3,7'."""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def build_sender_criteria(senders):
+    """Tạo điều kiện SEARCH kết hợp nhiều người gửi bằng OR lồng nhau."""
+    senders = [sender for sender in senders if sender]
+    if not senders:
+        return ''
+    criteria = f'FROM "{senders[-1]}"'
+    for sender in reversed(senders[:-1]):
+        criteria = f'OR FROM "{sender}" {criteria}'
+    return criteria
+
+
+_FETCH_UID_RE = re.compile(rb'UID (\d+)')
+_FETCH_SECTION_RE = re.compile(rb'BODY\[([^\]]*)\] \{\d+\}$')
+_FETCH_START_RE = re.compile(rb'^\d+ \(')
+
+
+def parse_fetch_response(data):
+    """Tách phản hồi UID FETCH của imaplib thành danh sách (uid, {section: bytes})."""
+    messages = []
+    current = None
+    for item in data:
+        prefix = item[0] if isinstance(item, tuple) else item
+        if prefix is None:
+            continue
+        if _FETCH_START_RE.match(prefix):
+            current = {'uid': None, 'sections': {}}
+            messages.append(current)
+        if current is None:
+            continue
+        uid_match = _FETCH_UID_RE.search(prefix)
+        if uid_match:
+            current['uid'] = int(uid_match.group(1))
+        if isinstance(item, tuple):
+            section_match = _FETCH_SECTION_RE.search(prefix)
+            if section_match:
+                current['sections'][section_match.group(1).decode().upper()] = item[1]
+    return [(message['uid'], message['sections']) for message in messages if message['uid'] is not None]
+
+
+class UidHighWaterMark:
+    """Lưu UID lớn nhất đã xử lý của một hộp thư trong Redis, gắn với UIDVALIDITY của hộp thư.
+
+    tolerate_errors: các lỗi Redis được bỏ qua (ví dụ khi email được đệm ra đĩa lúc Redis không phản hồi). Khi đó
+    get() trả về 0 (chỉ tìm theo UNSEEN, email đã xử lý đều đã được đánh dấu \\Seen) và set() không cập nhật.
+    """
+
+    def __init__(self, redis_client, account, folder, tolerate_errors=()):
+        self.redis = redis_client
+        self.key = f"email_watcher:last_uid:{account}:{folder}"
+        self.tolerate_errors = tuple(tolerate_errors)
+
+    def get(self, uidvalidity):
+        try:
+            data = self.redis.hgetall(self.key)
+        except self.tolerate_errors as e:
+            logger.warning(f"Không đọc được high-water mark {self.key} ({e}), tìm mọi email chưa đọc")
+            return 0
+        if not data or data.get(b'uidvalidity', b'').decode() != str(uidvalidity):
+            # UIDVALIDITY thay đổi nghĩa là UID cũ không còn ý nghĩa
+            return 0
+        return int(data.get(b'last_uid', b'0'))
+
+    def set(self, uidvalidity, last_uid):
+        try:
+            self.redis.hset(self.key, mapping={'uidvalidity': str(uidvalidity), 'last_uid': last_uid})
+        except self.tolerate_errors as e:
+            logger.warning(f"Không cập nhật được high-water mark {self.key} ({e})")
+
+
+def fetch_new_messages(mail, senders, high_water_mark, batch_size=200):
+    """Lấy email chưa đọc mới hơn high-water mark từ các người gửi, theo lô UID.
+
+    Mỗi lô gồm một UID FETCH (chỉ lấy header và phần text đầu tiên bằng BODY.PEEK). Hàm là generator trả về
+    từng (uid, email.message.Message); chỉ khi caller xử lý xong cả lô, các email mới được đánh dấu \\Seen
+    bằng một UID STORE và high-water mark mới được cập nhật. Nếu tiến trình dừng giữa chừng, lô đó sẽ được lấy lại.
+    """
+    # Đọc UIDVALIDITY từ phản hồi SELECT mà không lấy ra khỏi bộ đệm, để dùng lại trên kết nối IDLE
+    uidvalidity = int((mail.untagged_responses.get('UIDVALIDITY') or [b'0'])[-1])
+    last_uid = high_water_mark.get(uidvalidity)
+
+    criteria = 'UNSEEN'
+    if last_uid:
+        criteria += f' UID {last_uid + 1}:*'
+    sender_criteria = build_sender_criteria(senders)
+    if sender_criteria:
+        criteria += f' {sender_criteria}'
+
+    with IMAP_COMMAND_SECONDS.labels('search').time():
+        _, data = mail.uid('SEARCH', None, f'({criteria})')
+    # 'n:*' luôn khớp UID lớn nhất kể cả khi nhỏ hơn n
+    uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        uid_set = format_uid_set(batch)
+        with IMAP_COMMAND_SECONDS.labels('fetch').time():
+            _, data = mail.uid('FETCH', uid_set, '(UID BODY.PEEK[HEADER] BODY.PEEK[1.MIME] BODY.PEEK[1])')
+        for uid, sections in parse_fetch_response(data):
+            yield uid, build_text_message(sections)
+        with IMAP_COMMAND_SECONDS.labels('store').time():
+            mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Seen)')
+        high_water_mark.set(uidvalidity, batch[-1])
+
+
+def build_text_message(sections):
+    """Dựng lại email.message từ header và phần text đầu tiên (BODY[1]) đã fetch."""
+    header = sections.get('HEADER', b'')
+    top = email.message_from_bytes(header)
+    if top.get_content_maintype() == 'multipart':
+        # BODY[1] là phần con đầu tiên, header của nó nằm trong BODY[1.MIME]
+        header = sections.get('1.MIME') or b'Content-Type: text/plain\r\n\r\n'
+    if not header.endswith(b'\r\n\r\n'):
+        header = header.rstrip(b'\r\n') + b'\r\n\r\n'
+    message = email.message_from_bytes(header + sections.get('1', b''))
+    for name in ('From', 'Message-ID', 'Subject', 'Date'):
+        if top[name] and not message[name]:
+            message[name] = top[name]
+    return message
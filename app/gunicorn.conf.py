@@ -0,0 +1,23 @@
+import os
+import shutil
+
+# Gunicorn tự đọc file này (./gunicorn.conf.py) khi khởi động từ thư mục app.
+# Khi đặt PROMETHEUS_MULTIPROC_DIR, mỗi worker ghi số liệu Prometheus vào thư mục này để /metrics gộp lại.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Mỗi request SSE/long-poll giữ một thread trong lúc chờ, nên dùng worker gthread thay cho worker sync mặc định
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+
+def on_starting(server):
+    # Xóa số liệu của lần chạy trước
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,346 @@
+import fcntl
+import functools
+import gzip
+import hashlib
+import heapq
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ARCHIVE_DIR = os.environ.get('HISTORY_ARCHIVE_DIR', '')
+HISTORY_ARCHIVE_INDEX_CACHE_DAYS = int(os.environ.get('HISTORY_ARCHIVE_INDEX_CACHE_DAYS', 8))
+HISTORY_ARCHIVE_MERGE_SEGMENTS = int(os.environ.get('HISTORY_ARCHIVE_MERGE_SEGMENTS', 8))
+HISTORY_ARCHIVE_SMALL_SEGMENT = int(os.environ.get('HISTORY_ARCHIVE_SMALL_SEGMENT', 10000))
+SEGMENT_SUFFIX = '.ndjson.gz'
+DAY_INDEX_NAME = 'index.json.gz'
+ID_FILTER_NAME = 'ids.bloom'
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.lock'
+
+
+def _write_atomic(path, data):
+    """Ghi file qua file tạm + fsync + rename để người đọc không bao giờ thấy file dở dang."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_segment(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return tuple(tuple(json.loads(line)) for line in f)
+
+
+@functools.lru_cache(maxsize=16)
+def read_segment(path):
+    """Đọc toàn bộ một segment (đã sắp theo (score, id)). Segment không bao giờ bị sửa nên được cache."""
+    return _load_segment(path)
+
+
+class IdFilter:
+    """Bloom filter các id của một ngày (~10 bit mỗi id, tỉ lệ dương tính giả ~1%).
+
+    Giữ trong bộ nhớ cho mọi ngày để get() của một code không có trong archive không phải đọc chỉ mục nào.
+    """
+
+    HEADER = struct.Struct('>QB')
+
+    def __init__(self, size, hashes=7, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def build(cls, ids, bits_per_id=10):
+        id_filter = cls(max(64, len(ids) * bits_per_id))
+        for record_id in ids:
+            id_filter.add(record_id)
+        return id_filter
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, hashes = cls.HEADER.unpack_from(data)
+        return cls(size, hashes, bytearray(data[cls.HEADER.size:]))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.size, self.hashes) + bytes(self.bits)
+
+    def _positions(self, record_id):
+        first, second = struct.unpack('>QQ', hashlib.blake2b(record_id.encode(), digest_size=16).digest())
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, record_id):
+        for position in self._positions(record_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, record_id):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(record_id))
+
+
+class HistoryArchive:
+    """Lưu trữ lịch sử giao dịch cũ ra đĩa: các segment NDJSON nén gzip, chỉ ghi thêm, chia theo ngày.
+
+    Bố cục thư mục:
+        {directory}/manifest.json                     các ngày đã lưu trữ: khoảng score, số bản ghi, phiên bản
+        {directory}/{YYYY-MM-DD}/{segment}.ndjson.gz  mỗi dòng [score, id, record], sắp theo (score, id)
+        {directory}/{YYYY-MM-DD}/index.json.gz        chỉ mục của ngày: segment, id -> [segment, dòng],
+                                                      transaction_id -> [id]
+        {directory}/{YYYY-MM-DD}/ids.bloom            bloom filter các id của ngày (IdFilter)
+
+    Mỗi lần ghi, segment mới được ghi trước, rồi đến chỉ mục, bloom filter của ngày và cuối cùng là manifest.
+    Một bản ghi có thể được ghi hai lần nếu tiến trình dừng giữa lúc ghi segment và xóa khỏi Redis; chỉ mục của
+    ngày luôn trỏ tới bản ghi mới nhất và chỉ bản đó được trả về. Khi một ngày có từ merge_segments segment nhỏ
+    (ít hơn small_segment bản ghi) trở lên, các segment nhỏ được gộp thành một.
+
+    Mỗi process chỉ giữ manifest, bloom filter của các ngày và chỉ mục của tối đa index_cache_days ngày gần nhất
+    được dùng (LRU); chỉ mục được đọc lại khi phiên bản trong manifest thay đổi.
+    Khi chạy nhiều instance, directory phải là volume dùng chung.
+    """
+
+    def __init__(self, directory=HISTORY_ARCHIVE_DIR, index_cache_days=HISTORY_ARCHIVE_INDEX_CACHE_DAYS,
+                 merge_segments=HISTORY_ARCHIVE_MERGE_SEGMENTS, small_segment=HISTORY_ARCHIVE_SMALL_SEGMENT):
+        self.directory = directory
+        self.index_cache_days = index_cache_days
+        self.merge_segments = merge_segments
+        self.small_segment = small_segment
+        self.manifest = {}
+        self.manifest_stat = None
+        self.id_filters = {}
+        self.day_indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _day_path(self, day, name):
+        return os.path.join(self.directory, day, name)
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST_NAME), encoding='utf-8') as f:
+                return json.load(f)['days']
+        except FileNotFoundError:
+            return {}
+
+    def _read_day_index(self, day):
+        with gzip.open(self._day_path(day, DAY_INDEX_NAME), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _load_manifest(self):
+        """Manifest chỉ được đọc lại khi file đổi (mỗi lần ghi tạo file mới qua rename)."""
+        try:
+            stat = os.stat(os.path.join(self.directory, MANIFEST_NAME))
+        except FileNotFoundError:
+            return {}
+        with self.lock:
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) != self.manifest_stat:
+                self.manifest = self._read_manifest()
+                self.manifest_stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            return self.manifest
+
+    def _id_filter(self, day, version):
+        with self.lock:
+            cached = self.id_filters.get(day)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        with open(self._day_path(day, ID_FILTER_NAME), 'rb') as f:
+            id_filter = IdFilter.from_bytes(f.read())
+        with self.lock:
+            self.id_filters[day] = (version, id_filter)
+        return id_filter
+
+    def _day_index(self, day, version):
+        with self.lock:
+            cached = self.day_indexes.get(day)
+            if cached is not None and cached[0] == version:
+                self.day_indexes.move_to_end(day)
+                return cached[1]
+        index = self._read_day_index(day)
+        with self.lock:
+            self.day_indexes[day] = (version, index)
+            self.day_indexes.move_to_end(day)
+            while len(self.day_indexes) > self.index_cache_days:
+                self.day_indexes.popitem(last=False)
+        return index
+
+    def _forget_day(self, day):
+        # Chỉ mục đã cache trỏ tới segment vừa bị gộp và xóa: đọc lại từ đĩa ở lần sau
+        with self.lock:
+            self.day_indexes.pop(day, None)
+            self.id_filters.pop(day, None)
+            self.manifest_stat = None
+
+    @contextmanager
+    def _write_lock(self):
+        # Chỉ leader ghi archive, khóa file tránh hai instance cùng ghi trong lúc chuyển giao quyền leader
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_NAME), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _write_segment(self, day, entries):
+        name = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        lines = ''.join(json.dumps([score, record_id, record]) + '\n' for score, record_id, record in entries)
+        _write_atomic(self._day_path(day, name + SEGMENT_SUFFIX), gzip.compress(lines.encode('utf-8'), mtime=0))
+        return name
+
+    @staticmethod
+    def _add_segment(index, name, entries):
+        number = len(index['segments'])
+        index['segments'].append({'name': name, 'count': len(entries), 'min_score': entries[0][0],
+                                  'max_score': entries[-1][0]})
+        for line_number, (_, record_id, record) in enumerate(entries):
+            index['ids'][record_id] = [number, line_number]
+            if record.get('transaction_id') is not None:
+                record_ids = index['transaction_ids'].setdefault(str(record['transaction_id']), [])
+                if record_id not in record_ids:
+                    record_ids.append(record_id)
+
+    def _merge_small_segments(self, day, index):
+        """Gộp các segment nhỏ của ngày thành một segment, trả về tên các segment đã được gộp (cần xóa)."""
+        small = [number for number, segment in enumerate(index['segments']) if segment['count'] < self.small_segment]
+        if len(small) < max(self.merge_segments, 2):
+            return []
+
+        # Chỉ giữ bản ghi mà chỉ mục đang trỏ tới (bản mới nhất của mỗi id)
+        small_set = set(small)
+        wanted = {}
+        for record_id, (number, line_number) in index['ids'].items():
+            if number in small_set:
+                wanted.setdefault(number, []).append(line_number)
+        entries = []
+        for number, line_numbers in wanted.items():
+            lines = _load_segment(self._day_path(day, index['segments'][number]['name'] + SEGMENT_SUFFIX))
+            entries.extend(lines[line_number] for line_number in line_numbers)
+        entries.sort(key=lambda entry: (entry[0], entry[1]))
+
+        merged = [segment['name'] for number, segment in enumerate(index['segments']) if number in small_set]
+        kept = [number for number in range(len(index['segments'])) if number not in small_set]
+        renumber = {old: new for new, old in enumerate(kept)}
+        index['segments'] = [index['segments'][number] for number in kept]
+        index['ids'] = {record_id: [renumber[number], line_number]
+                        for record_id, (number, line_number) in index['ids'].items() if number not in small_set}
+        if entries:
+            self._add_segment(index, self._write_segment(day, entries), entries)
+        return merged
+
+    def write(self, entries):
+        """Ghi các bản ghi [(score, id, record)] thành segment mới theo ngày tạo. Trả về danh sách segment đã ghi."""
+        by_day = {}
+        for score, record_id, record in entries:
+            by_day.setdefault(datetime.fromtimestamp(score).strftime('%Y-%m-%d'), []).append((score, record_id, record))
+
+        written = []
+        with self._write_lock():
+            manifest = self._read_manifest()
+            for day, day_entries in sorted(by_day.items()):
+                day_entries.sort(key=lambda entry: (entry[0], entry[1]))
+                os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+                index = self._read_day_index(day) if day in manifest else {
+                    'segments': [], 'ids': {}, 'transaction_ids': {}}
+
+                name = self._write_segment(day, day_entries)
+                self._add_segment(index, name, day_entries)
+                merged = self._merge_small_segments(day, index)
+
+                _write_atomic(self._day_path(day, DAY_INDEX_NAME),
+                              gzip.compress(json.dumps(index).encode('utf-8'), mtime=0))
+                _write_atomic(self._day_path(day, ID_FILTER_NAME), IdFilter.build(index['ids']).to_bytes())
+                manifest[day] = {
+                    'version': manifest.get(day, {}).get('version', 0) + 1,
+                    'count': len(index['ids']),
+                    'min_score': min(segment['min_score'] for segment in index['segments']),
+                    'max_score': max(segment['max_score'] for segment in index['segments']),
+                }
+                for merged_name in merged:
+                    os.remove(self._day_path(day, merged_name + SEGMENT_SUFFIX))
+                if merged:
+                    logger.info(f"Đã gộp {len(merged)} segment nhỏ của ngày {day} trong archive")
+                written.append(self._day_path(day, name))
+            _write_atomic(os.path.join(self.directory, MANIFEST_NAME), json.dumps({'days': manifest}).encode('utf-8'))
+        return written
+
+    def get(self, record_id):
+        """Lấy một bản ghi đã lưu trữ theo id/code, None nếu không có."""
+        for day, day_info in sorted(self._load_manifest().items(), reverse=True):
+            # Bloom filter loại gần hết các ngày không chứa id mà không cần đọc chỉ mục
+            if record_id not in self._id_filter(day, day_info['version']):
+                continue
+            for attempt in range(2):
+                try:
+                    index = self._day_index(day, day_info['version'])
+                    location = index['ids'].get(record_id)
+                    if location is None:
+                        break
+                    segment = index['segments'][location[0]]
+                    return read_segment(self._day_path(day, segment['name'] + SEGMENT_SUFFIX))[location[1]][2]
+                except FileNotFoundError:
+                    if attempt:
+                        raise
+                    self._forget_day(day)
+        return None
+
+    def _load_day_segments(self, day, version, lower, upper, after, transaction_id):
+        """Chỉ mục của ngày và các segment (số thứ tự, các dòng) có thể chứa bản ghi cần tìm."""
+        for attempt in range(2):
+            try:
+                index = self._day_index(day, version)
+                numbers = range(len(index['segments']))
+                if transaction_id is not None:
+                    # Lọc theo transaction_id chỉ cần đọc các segment chứa bản ghi có transaction_id đó
+                    numbers = sorted({index['ids'][record_id][0]
+                                      for record_id in index['transaction_ids'].get(str(transaction_id), [])})
+                segments = []
+                for number in numbers:
+                    segment = index['segments'][number]
+                    if segment['max_score'] < lower or segment['min_score'] > upper:
+                        continue
+                    if after is not None and segment['max_score'] < after[0]:
+                        continue
+                    segments.append((number, read_segment(self._day_path(day, segment['name'] + SEGMENT_SUFFIX))))
+                return index, segments
+            except FileNotFoundError:
+                if attempt:
+                    raise
+                self._forget_day(day)
+
+    def scan(self, filters=None, status=None, min_score='-inf', max_score='+inf', after=None):
+        """Như TransactionStore.query nhưng trên dữ liệu đã lưu trữ, trả về từng (score, id, record) theo thứ tự."""
+        filters = {field: value for field, value in (filters or {}).items() if value is not None}
+        lower, upper = float(min_score), float(max_score)
+        transaction_id = filters.get('transaction_id')
+
+        # Các ngày không chồng lấn về score nên được duyệt lần lượt, mỗi lúc chỉ đọc segment của một ngày
+        for day, day_info in sorted(self._load_manifest().items()):
+            if day_info['max_score'] < lower or day_info['min_score'] > upper:
+                continue
+            if after is not None and day_info['max_score'] < after[0]:
+                continue
+            index, segments = self._load_day_segments(day, day_info['version'], lower, upper, after, transaction_id)
+            ids = index['ids']
+
+            def current(number, lines):
+                # Bỏ qua bản cũ của bản ghi đã được lưu trữ lại (chỉ mục trỏ tới bản mới nhất)
+                for line_number, (score, record_id, record) in enumerate(lines):
+                    if ids.get(record_id) == [number, line_number]:
+                        yield score, record_id, record
+
+            for score, record_id, record in heapq.merge(*(current(number, lines) for number, lines in segments),
+                                                        key=lambda entry: (entry[0], entry[1])):
+                if not lower <= score <= upper or (after is not None and (score, record_id) <= tuple(after)):
+                    continue
+                if status is not None and record.get('status') != status:
+                    continue
+                if all(str(record.get(field)) == str(value) for field, value in filters.items()):
+                    yield score, record_id, record
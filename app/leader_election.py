@@ -0,0 +1,166 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from threading import Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+LEADER_KEY_PREFIX = os.environ.get('LEADER_KEY_PREFIX', 'leader:')
+
+# Gia hạn lease nếu vẫn thuộc về instance này
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Trả lease nếu vẫn thuộc về instance này
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def default_instance_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaderLease:
+    """Lease trong Redis (SET NX PX) để chỉ một instance giữ vai trò leader cho một tác vụ.
+
+    hold_on_errors: các lỗi Redis mà khi gặp lúc gia hạn, lease đang giữ vẫn được coi là còn hiệu lực, tối đa
+    max_hold giây kể từ lần gia hạn thành công cuối cùng. Key trong Redis vẫn hết hạn sau ttl, nên nếu instance khác
+    còn kết nối được Redis thì nó giành được lease và hai instance cùng chạy tác vụ trong khoảng (max_hold - ttl)
+    giây. Chỉ dùng cho tác vụ chịu được việc chạy trùng đó (ví dụ nhờ sổ ghi nhận email), để tác vụ không dừng khi
+    Redis không phản hồi.
+    """
+
+    def __init__(self, redis_client, name, instance_id, ttl=30, hold_on_errors=(), max_hold=300):
+        self.redis = redis_client
+        self.name = name
+        self.key = f"{LEADER_KEY_PREFIX}{name}"
+        self.instance_id = instance_id
+        self.ttl_ms = int(ttl * 1000)
+        self.hold_on_errors = tuple(hold_on_errors)
+        self.max_hold = max_hold
+        self.valid_until = 0
+        self.renewed_at = 0
+        self._renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    def is_held(self):
+        # Không gia hạn được trong thời gian ttl thì coi như đã mất lease, kể cả khi không liên lạc được Redis
+        return time.monotonic() < self.valid_until
+
+    def acquire(self):
+        started = time.monotonic()
+        if self.redis.set(self.key, self.instance_id, nx=True, px=self.ttl_ms):
+            self._renewed(started)
+            return True
+        return self.renew()
+
+    def renew(self):
+        started = time.monotonic()
+        try:
+            renewed = self._renew_script(keys=[self.key], args=[self.instance_id, self.ttl_ms])
+        except self.hold_on_errors as e:
+            if not self.is_held():
+                raise
+            self.valid_until = min(started + self.ttl_ms / 1000, self.renewed_at + self.max_hold)
+            if not self.is_held():
+                raise
+            logger.warning(f"Không gia hạn được lease {self.name} ({e}), tiếp tục giữ lease tới khi Redis phản hồi "
+                           f"(tối đa {self.valid_until - started:.0f} giây nữa)")
+            return True
+        if renewed:
+            self._renewed(started)
+            return True
+        self.valid_until = 0
+        return False
+
+    def _renewed(self, started):
+        self.renewed_at = started
+        self.valid_until = started + self.ttl_ms / 1000
+
+    def release(self):
+        self.valid_until = 0
+        self._release_script(keys=[self.key], args=[self.instance_id])
+
+    def holder(self):
+        holder = self.redis.get(self.key)
+        return holder.decode() if holder else None
+
+
+class LeaderElector:
+    """Chạy mỗi tác vụ nền trên đúng một instance trong toàn bộ deployment.
+
+    Mỗi tác vụ có một lease riêng. Một thread duy trì sẽ gia hạn lease đang giữ hoặc thử giành lease còn trống
+    mỗi renew_interval giây; khi giành được, target(should_run) được chạy trong thread riêng. target phải dừng
+    khi should_run() trả về False (mất lease), và on_lost (nếu có) được gọi để dừng các thao tác đang chờ.
+    hold_on_errors, max_hold: xem LeaderLease.
+    """
+
+    def __init__(self, redis_client, instance_id=None, ttl=30, renew_interval=10, max_hold=300):
+        self.redis = redis_client
+        self.instance_id = instance_id or default_instance_id()
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.max_hold = max_hold
+        self.tasks = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def register(self, name, target, on_lost=None, hold_on_errors=()):
+        lease = LeaderLease(self.redis, name, self.instance_id, self.ttl, hold_on_errors, self.max_hold)
+        with self.lock:
+            self.tasks[name] = {'lease': lease, 'target': target, 'on_lost': on_lost, 'thread': None}
+
+    def start(self):
+        self.thread = Thread(target=self._maintain, daemon=True)
+        self.thread.start()
+
+    def _maintain(self):
+        while True:
+            with self.lock:
+                tasks = list(self.tasks.items())
+            for name, task in tasks:
+                try:
+                    self._tick(name, task)
+                except Exception as e:
+                    logger.error(f"Lỗi khi duy trì lease {name}: {e}")
+            time.sleep(self.renew_interval)
+
+    def _tick(self, name, task):
+        lease = task['lease']
+        was_held = lease.is_held()
+        held = lease.renew() if was_held else lease.acquire()
+
+        if was_held and not held:
+            logger.warning(f"Instance {self.instance_id} mất quyền leader cho tác vụ {name}")
+            if task['on_lost']:
+                task['on_lost']()
+        elif held and not (task['thread'] and task['thread'].is_alive()):
+            logger.info(f"Instance {self.instance_id} trở thành leader cho tác vụ {name}")
+            task['thread'] = Thread(target=task['target'], args=(lease.is_held,), daemon=True)
+            task['thread'].start()
+
+    def is_leader(self, name):
+        task = self.tasks.get(name)
+        return bool(task and task['lease'].is_held())
+
+    def status(self):
+        """Trạng thái các lease cho health endpoint."""
+        leases = {}
+        for name, task in self.tasks.items():
+            lease = task['lease']
+            leases[name] = {
+                'leader': lease.is_held(),
+                'holder': lease.holder(),
+                'running': bool(task['thread'] and task['thread'].is_alive()),
+            }
+        return {'instance_id': self.instance_id, 'leases': leases}
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from email_watcher import ImapIdleWatcher, open_imap_connection
+from metrics import EMAIL_LAST_SUCCESS, IMAP_COMMAND_SECONDS, MAILBOX_UP
+
+logger = logging.getLogger(__name__)
+
+MAILBOX_HEALTH_PREFIX = os.environ.get('MAILBOX_HEALTH_PREFIX', 'email_watcher:health:')
+
+
+class MailboxSource:
+    """Một hộp thư nhận email biến động số dư và tài khoản ngân hàng mà hộp thư đó báo về."""
+
+    def __init__(self, name, login, password, host='imap.gmail.com', port=None, use_ssl=True, folder='inbox',
+                 senders=(), parser='cake', bank_code=None, account_number=None, use_idle=True, poll_interval=20,
+                 timeout=60):
+        self.name = name
+        self.login = login
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.folder = folder
+        self.senders = [sender for sender in senders if sender]
+        self.parser = parser
+        self.bank_code = bank_code
+        self.account_number = account_number
+        self.use_idle = use_idle
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def connect(self):
+        return open_imap_connection(self.host, self.port, self.use_ssl, timeout=self.timeout)
+
+    def __repr__(self):
+        return f"MailboxSource({self.name!r}, {self.login!r}, folder={self.folder!r})"
+
+
+def load_mailbox_sources(config, defaults):
+    """Đọc danh sách hộp thư từ config (chuỗi JSON hoặc '@đường_dẫn' tới file JSON).
+
+    Mỗi phần tử là một object với các trường của MailboxSource; trường thiếu lấy từ defaults. Mật khẩu có thể
+    đặt qua `password_env` (tên biến môi trường) để không ghi mật khẩu vào cấu hình. Config rỗng: một hộp thư
+    duy nhất tên 'default' dựng từ defaults (cấu hình EMAIL_* cũ).
+    """
+    if not config.strip():
+        return [MailboxSource('default', **defaults)]
+    if config.startswith('@'):
+        with open(config[1:], encoding='utf-8') as f:
+            entries = json.load(f)
+    else:
+        entries = json.loads(config)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("EMAIL_SOURCES phải là một danh sách JSON khác rỗng")
+
+    sources = []
+    for index, entry in enumerate(entries):
+        entry = dict(entry)
+        name = str(entry.pop('name', None) or entry.get('login') or index)
+        password_env = entry.pop('password_env', None)
+        if password_env:
+            entry['password'] = os.environ.get(password_env)
+        if isinstance(entry.get('senders'), str):
+            entry['senders'] = entry['senders'].split(',')
+        source = MailboxSource(name, **{**defaults, **entry})
+        if not source.login or not source.password:
+            raise ValueError(f"Hộp thư {name} thiếu login hoặc password")
+        if any(existing.name == name for existing in sources):
+            raise ValueError(f"Trùng tên hộp thư: {name}")
+        sources.append(source)
+    return sources
+
+
+class MailboxHealth:
+    """Tình trạng của một hộp thư, lưu trong Redis để /health của mọi worker và instance đều đọc được."""
+
+    def __init__(self, redis_client, name, prefix=MAILBOX_HEALTH_PREFIX):
+        self.redis = redis_client
+        self.name = name
+        self.key = f"{prefix}{name}"
+
+    def succeeded(self):
+        now = time.time()
+        self.redis.hset(self.key, mapping={'status': 'ok', 'last_success': now, 'failures': 0, 'retry_at': ''})
+        EMAIL_LAST_SUCCESS.labels(self.name).set(now)
+        MAILBOX_UP.labels(self.name).set(1)
+
+    def failed(self, error, retry_in):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, mapping={'status': 'error', 'last_error': str(error), 'last_error_at': now,
+                                     'retry_at': now + retry_in})
+        pipe.hincrby(self.key, 'failures', 1)
+        pipe.execute()
+        MAILBOX_UP.labels(self.name).set(0)
+
+    def status(self):
+        return self.decode_status(self.redis.hgetall(self.key))
+
+    @staticmethod
+    def decode_status(raw):
+        """Chuyển hash tình trạng hộp thư (đọc bằng client đồng bộ hoặc redis.asyncio) thành nội dung cho /health."""
+        data = {field.decode(): value.decode() for field, value in raw.items()}
+        for field in ('last_success', 'last_error_at', 'retry_at'):
+            data[field] = float(data[field]) if data.get(field) else None
+        if 'failures' in data:
+            data['failures'] = int(data['failures'])
+        return data
+
+
+class MailboxWatcherPool:
+    """Theo dõi đồng thời nhiều hộp thư; một hộp thư chậm hoặc lỗi không làm chậm các hộp thư khác.
+
+    - Hộp thư dùng IDLE: mỗi hộp thư một ImapIdleWatcher trên thread riêng (thread chỉ chờ trên socket),
+      tự kết nối lại với backoff riêng.
+    - Hộp thư polling: mỗi lượt kiểm tra chạy trên ThreadPoolExecutor giới hạn max_workers. Mỗi hộp thư có lịch
+      và backoff riêng, và không bao giờ có hai lượt chạy song song trên cùng một hộp thư.
+
+    on_new_mail(mail, source) xử lý email mới trên một kết nối đã đăng nhập và chọn hộp thư.
+    """
+
+    def __init__(self, sources, on_new_mail, redis_client, max_workers=4, idle_timeout=29 * 60, initial_backoff=1,
+                 max_backoff=300, should_run=None):
+        self.sources = sources
+        self.on_new_mail = on_new_mail
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.should_run = should_run or (lambda: True)
+        self.health = {source.name: MailboxHealth(redis_client, source.name) for source in sources}
+
+    def poll(self, source):
+        """Một lượt kiểm tra hộp thư polling: kết nối, xử lý email mới rồi đóng kết nối."""
+        with IMAP_COMMAND_SECONDS.labels('connect').time():
+            mail = source.connect()
+        try:
+            with IMAP_COMMAND_SECONDS.labels('login').time():
+                mail.login(source.login, source.password)
+            with IMAP_COMMAND_SECONDS.labels('select').time():
+                mail.select(source.folder)
+            self.on_new_mail(mail, source)
+        finally:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    def _watch_idle(self, source):
+        watcher = ImapIdleWatcher(source.connect, source.login, source.password,
+                                  lambda mail: self.on_new_mail(mail, source), folder=source.folder,
+                                  poll_interval=source.poll_interval, idle_timeout=self.idle_timeout,
+                                  initial_backoff=self.initial_backoff, max_backoff=self.max_backoff,
+                                  should_run=self.should_run, health=self.health[source.name])
+        watcher.run()
+
+    def run(self):
+        idle_threads = []
+        for source in self.sources:
+            if source.use_idle:
+                thread = threading.Thread(target=self._watch_idle, args=(source,), name=f"imap-{source.name}",
+                                          daemon=True)
+                thread.start()
+                idle_threads.append(thread)
+
+        polling = [source for source in self.sources if not source.use_idle]
+        logger.info(f"Theo dõi {len(self.sources)} hộp thư: {len(idle_threads)} IDLE, {len(polling)} polling "
+                    f"({self.max_workers} worker)")
+        if polling:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='imap-poll') as executor:
+                self._schedule(polling, executor)
+        for thread in idle_threads:
+            thread.join()
+
+    def _schedule(self, sources, executor):
+        # name -> [thời điểm chạy tiếp theo, backoff hiện tại, future của lượt đang chạy]
+        schedule = {source.name: [0, self.initial_backoff, None] for source in sources}
+        while self.should_run():
+            now = time.monotonic()
+            for source in sources:
+                state = schedule[source.name]
+                future = state[2]
+                if future is not None:
+                    if not future.done():
+                        continue
+                    state[2] = None
+                    error = future.exception()
+                    if error is None:
+                        self._report_success(source)
+                        state[0], state[1] = now + source.poll_interval, self.initial_backoff
+                    else:
+                        logger.error(f"Lỗi khi kiểm tra hộp thư {source.name}: {error}. Thử lại sau {state[1]} giây")
+                        self._report_failure(source, error, state[1])
+                        state[0], state[1] = now + state[1], min(state[1] * 2, self.max_backoff)
+                if state[2] is None and now >= state[0]:
+                    state[2] = executor.submit(self.poll, source)
+            time.sleep(0.2)
+
+    def _report_success(self, source):
+        try:
+            self.health[source.name].succeeded()
+        except Exception as e:
+            logger.warning(f"Lỗi khi ghi tình trạng hộp thư {source.name}: {e}")
+
+    def _report_failure(self, source, error, retry_in):
+        try:
+            self.health[source.name].failed(error, retry_in)
+        except Exception as e:
+            logger.warning(f"Lỗi khi ghi tình trạng hộp thư {source.name}: {e}")
+
+    def status(self):
+        """Tình trạng của từng hộp thư theo tên."""
+        return {name: health.status() for name, health in self.health.items()}
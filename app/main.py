@@ -1,20 +1,36 @@
-import imaplib
 import email
-import re
+import email.utils
 import time
 import os
-import requests
+import socket
 import io
 import base64
+import queue
+import zipfile
 from datetime import datetime
 import logging
-from flask import Flask, request, jsonify, send_file
-from io import BytesIO
-from qr_pay import QRPay
-from threading import Thread
+from flask import Flask, request, jsonify, Response, stream_with_context
 import redis
 import json
-from segno import helpers
+from email_watcher import UidHighWaterMark, fetch_new_messages
+from mailbox_sources import MailboxHealth, MailboxWatcherPool, load_mailbox_sources
+from qr_cache import QRImageCache, cache_key
+from qr_render import QRRenderPool, render_payment_qr
+from transaction_codes import TransactionCodeGenerator
+from pending_deadlines import PendingDeadlineIndex
+from payment_matcher import PaymentMatcher, PendingAmountIndex
+import payment_decision
+from webhook_dispatcher import WebhookDispatcher
+from leader_election import LeaderElector
+from status_events import TransactionStatusHub
+import email_parser
+from email_ledger import EmailLedger, message_key
+from transaction_store import TransactionStore, parse_transaction_time
+from history_archive import HistoryArchive
+from transaction_stats import TransactionStats
+from redis_layer import RedisSettings, parse_sentinels
+from write_buffer import REDIS_UNAVAILABLE_ERRORS, WriteAheadBuffer, WriteBufferFull
+import metrics
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO,
@@ -23,230 +39,569 @@ logger = logging.getLogger(__name__)
 
 # Tải biến môi trường
 EMAIL_IMAP = os.environ.get('EMAIL_IMAP', 'imap.gmail.com')
+EMAIL_IMAP_PORT = int(os.environ.get('EMAIL_IMAP_PORT', 0)) or None
+EMAIL_IMAP_SSL = os.environ.get('EMAIL_IMAP_SSL', 'true').lower() == 'true'
+EMAIL_USE_IDLE = os.environ.get('EMAIL_USE_IDLE', 'true').lower() == 'true'
+EMAIL_IDLE_TIMEOUT = int(os.environ.get('EMAIL_IDLE_TIMEOUT', 29 * 60))
+EMAIL_RECONNECT_MAX_BACKOFF = int(os.environ.get('EMAIL_RECONNECT_MAX_BACKOFF', 300))
+EMAIL_IMAP_TIMEOUT = float(os.environ.get('EMAIL_IMAP_TIMEOUT', 60))
 EMAIL_LOGIN = os.environ.get('EMAIL_LOGIN')
 EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')
 CAKE_EMAIL_SENDERS = os.environ.get('CAKE_EMAIL_SENDERS', '').split(',')
+# Danh sách hộp thư (JSON hoặc @đường_dẫn file JSON), để trống: một hộp thư theo các biến EMAIL_* ở trên
+EMAIL_SOURCES = os.environ.get('EMAIL_SOURCES', '')
+EMAIL_WATCHER_MAX_WORKERS = int(os.environ.get('EMAIL_WATCHER_MAX_WORKERS', 4))
 API_KEY = os.environ.get('API_KEY', '')
 APP_URL = os.environ.get('APP_URL', '')
 REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
 REDIS_DB = int(os.environ.get('REDIS_DB', 0))
+REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', '')
+# Redis Sentinel (danh sách host:port cách nhau bằng dấu phẩy), để trống: kết nối thẳng REDIS_HOST:REDIS_PORT
+REDIS_SENTINELS = parse_sentinels(os.environ.get('REDIS_SENTINELS', ''))
+REDIS_SENTINEL_MASTER = os.environ.get('REDIS_SENTINEL_MASTER', 'mymaster')
+REDIS_SENTINEL_PASSWORD = os.environ.get('REDIS_SENTINEL_PASSWORD', '')
+REDIS_READ_FROM_REPLICAS = os.environ.get('REDIS_READ_FROM_REPLICAS', 'false').lower() == 'true'
+REDIS_REPLICA_HOST = os.environ.get('REDIS_REPLICA_HOST', '')
+REDIS_REPLICA_PORT = int(os.environ.get('REDIS_REPLICA_PORT', 0)) or REDIS_PORT
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 64))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+REDIS_RETRY_ATTEMPTS = int(os.environ.get('REDIS_RETRY_ATTEMPTS', 3))
+# Thư mục đệm thay đổi trạng thái khi Redis không phản hồi, để trống: không đệm (email được xử lý lại sau)
+WRITE_BUFFER_DIR = os.environ.get('WRITE_BUFFER_DIR', '')
+WRITE_BUFFER_MAX_BYTES = int(os.environ.get('WRITE_BUFFER_MAX_BYTES', 64 * 1024 * 1024))
 TRANSACTION_CODE_EXPIRATION = int(os.environ.get('TRANSACTION_CODE_EXPIRATION', 600))
 TRANSACTION_HISTORY_KEY = os.environ.get('TRANSACTION_HISTORY_KEY', 'transaction_history')
 BANK_CODE = os.environ.get('BANK_CODE', '963388')
 ACCOUNT_NUMBER = os.environ.get('ACCOUNT_NUMBER', '0977091190')
 EMAIL_POLL_INTERVAL = int(os.environ.get('EMAIL_POLL_INTERVAL', 20))
+EMAIL_PARSER = os.environ.get('EMAIL_PARSER', 'cake')
+EMAIL_FETCH_BATCH_SIZE = int(os.environ.get('EMAIL_FETCH_BATCH_SIZE', 200))
+EMAIL_LEDGER_TTL = int(os.environ.get('EMAIL_LEDGER_TTL', 30 * 24 * 3600))
+EMAIL_CLAIM_TIMEOUT = int(os.environ.get('EMAIL_CLAIM_TIMEOUT', 300))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+EMAIL_RETRY_INTERVAL = int(os.environ.get('EMAIL_RETRY_INTERVAL', 30))
+TRANSACTION_CODE_BLOCK_SIZE = int(os.environ.get('TRANSACTION_CODE_BLOCK_SIZE', 100))
+QR_CACHE_MAX_BYTES = int(os.environ.get('QR_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+QR_CACHE_TTL = int(os.environ.get('QR_CACHE_TTL', 24 * 3600))
+QR_CACHE_MAX_AGE = int(os.environ.get('QR_CACHE_MAX_AGE', 3600))
+QR_MAX_SCALE = int(os.environ.get('QR_MAX_SCALE', 20))
+QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+DEFAULT_QR_PURPOSE = 'NT0977091190' # Nên thay bằng default value phù hợp
+EXPIRY_BATCH_SIZE = int(os.environ.get('EXPIRY_BATCH_SIZE', 100))
+EXPIRY_MAX_SLEEP = float(os.environ.get('EXPIRY_MAX_SLEEP', 5))
+EXPIRY_RECONCILE_INTERVAL = int(os.environ.get('EXPIRY_RECONCILE_INTERVAL', 300))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', 10))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_DEAD_LETTER_MAX_LIMIT = int(os.environ.get('WEBHOOK_DEAD_LETTER_MAX_LIMIT', 1000))
+BACKGROUND_WORKERS_ENABLED = os.environ.get('BACKGROUND_WORKERS_ENABLED', 'true').lower() == 'true'
+LEADER_LEASE_TTL = int(os.environ.get('LEADER_LEASE_TTL', 30))
+LEADER_RENEW_INTERVAL = int(os.environ.get('LEADER_RENEW_INTERVAL', 10))
+LEADER_MAX_HOLD_ON_ERRORS = int(os.environ.get('LEADER_MAX_HOLD_ON_ERRORS', 300))
+STATUS_LONG_POLL_MAX_WAIT = float(os.environ.get('STATUS_LONG_POLL_MAX_WAIT', 30))
+STATUS_STREAM_TIMEOUT = float(os.environ.get('STATUS_STREAM_TIMEOUT', TRANSACTION_CODE_EXPIRATION + 60))
+STATUS_STREAM_HEARTBEAT = float(os.environ.get('STATUS_STREAM_HEARTBEAT', 15))
+# Trạng thái không còn thay đổi, stream SSE kết thúc sau khi gửi
+FINAL_TRANSACTION_STATUSES = {'completed', 'underpaid', 'received_after_expired'}
 PENDING_TRANSACTION_PREFIX = "pending_transaction:"
-
-# Kết nối Redis
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-    redis_client.ping()
-    logger.info(f"Kết nối Redis thành công: {REDIS_HOST}:{REDIS_PORT} (DB: {REDIS_DB})")
-except redis.exceptions.ConnectionError as e:
-    logger.error(f"Lỗi kết nối Redis: {e}")
-    exit(1)
+HISTORY_PAGE_MAX_LIMIT = int(os.environ.get('HISTORY_PAGE_MAX_LIMIT', 1000))
+HISTORY_SCAN_BATCH_SIZE = int(os.environ.get('HISTORY_SCAN_BATCH_SIZE', 500))
+BULK_CREATE_MAX_ITEMS = int(os.environ.get('BULK_CREATE_MAX_ITEMS', 5000))
+HISTORY_ARCHIVE_DIR = os.environ.get('HISTORY_ARCHIVE_DIR', '')
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', 90))
+HISTORY_COMPACTION_INTERVAL = int(os.environ.get('HISTORY_COMPACTION_INTERVAL', 3600))
+HISTORY_COMPACTION_BATCH_SIZE = int(os.environ.get('HISTORY_COMPACTION_BATCH_SIZE', 1000))
+STATS_MAX_DAYS = int(os.environ.get('STATS_MAX_DAYS', 366))
+# Đối soát khoản tiền đến khi nội dung chuyển khoản thiếu hoặc sai mã giao dịch
+RECONCILE_MAX_DISTANCE = int(os.environ.get('RECONCILE_MAX_DISTANCE', 1))
+RECONCILE_MISMATCH_MAX_DISTANCE = int(os.environ.get('RECONCILE_MISMATCH_MAX_DISTANCE', 0))
+RECONCILE_AMOUNT_TOLERANCE = float(os.environ.get('RECONCILE_AMOUNT_TOLERANCE', 0.1))
+RECONCILE_TIME_SLACK = int(os.environ.get('RECONCILE_TIME_SLACK', 120))
+
+# Kết nối Redis: chỉ mở kết nối khi có lệnh đầu tiên, nên ứng dụng vẫn khởi động khi Redis chưa sẵn sàng.
+# redis_client không tự thử lại khi mất kết nối (tránh ghi hai lần); redis_read_client dùng cho các API chỉ đọc,
+# có thử lại, đọc từ replica nếu có cấu hình.
+redis_settings = RedisSettings(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD,
+                               sentinels=REDIS_SENTINELS, sentinel_master=REDIS_SENTINEL_MASTER,
+                               sentinel_password=REDIS_SENTINEL_PASSWORD, read_from_replicas=REDIS_READ_FROM_REPLICAS,
+                               replica_host=REDIS_REPLICA_HOST, replica_port=REDIS_REPLICA_PORT,
+                               max_connections=REDIS_MAX_CONNECTIONS, pool_timeout=REDIS_POOL_TIMEOUT,
+                               socket_timeout=REDIS_SOCKET_TIMEOUT, connect_timeout=REDIS_CONNECT_TIMEOUT,
+                               health_check_interval=REDIS_HEALTH_CHECK_INTERVAL, retry_attempts=REDIS_RETRY_ATTEMPTS)
+redis_client, redis_read_client = redis_settings.create_clients(metrics.InstrumentedRedis)
+logger.info(f"Redis: {redis_settings.describe()}")
+
+# Đệm ra đĩa các email nhận được lúc Redis không phản hồi, xử lý lại khi Redis hoạt động trở lại
+write_buffer = WriteAheadBuffer(WRITE_BUFFER_DIR, max_bytes=WRITE_BUFFER_MAX_BYTES)
+
+# Các hộp thư cần theo dõi, mỗi hộp thư ứng với một tài khoản ngân hàng
+mailbox_sources = load_mailbox_sources(EMAIL_SOURCES, defaults={
+    'login': EMAIL_LOGIN,
+    'password': EMAIL_PASSWORD,
+    'host': EMAIL_IMAP,
+    'port': EMAIL_IMAP_PORT,
+    'use_ssl': EMAIL_IMAP_SSL,
+    'senders': CAKE_EMAIL_SENDERS,
+    'parser': EMAIL_PARSER,
+    'bank_code': BANK_CODE,
+    'account_number': ACCOUNT_NUMBER,
+    'use_idle': EMAIL_USE_IDLE,
+    'poll_interval': EMAIL_POLL_INTERVAL,
+    'timeout': EMAIL_IMAP_TIMEOUT,
+})
+mailbox_sources_by_name = {source.name: source for source in mailbox_sources}
+
+# Kho lịch sử giao dịch (hash theo từng giao dịch + chỉ mục sorted-set), bản ghi cũ được lưu trữ ra đĩa nếu cấu hình
+history_archive = HistoryArchive(HISTORY_ARCHIVE_DIR) if HISTORY_ARCHIVE_DIR else None
+transaction_store = TransactionStore(redis_client, TRANSACTION_HISTORY_KEY, archive=history_archive)
+# Bản đọc của kho lịch sử cho /check_transaction_status (đọc từ replica nếu có cấu hình)
+transaction_store_reader = TransactionStore(redis_read_client, TRANSACTION_HISTORY_KEY, archive=history_archive)
+
+# Số liệu tổng hợp theo ngày: ghi qua pipeline của các chỗ thay đổi trạng thái, /stats đọc qua redis_read_client
+transaction_stats = TransactionStats(redis_read_client)
+
+# Chỉ mục hạn của các giao dịch pending
+pending_deadlines = PendingDeadlineIndex(redis_client, PENDING_TRANSACTION_PREFIX)
+
+# Chỉ mục giao dịch pending theo số tiền và thời điểm tạo, dùng để đối soát chuyển khoản thiếu hoặc sai mã
+pending_amounts = PendingAmountIndex(redis_client, max_age=TRANSACTION_CODE_EXPIRATION)
+payment_matcher = PaymentMatcher(pending_amounts, max_distance=RECONCILE_MAX_DISTANCE,
+                                 mismatch_max_distance=RECONCILE_MISMATCH_MAX_DISTANCE,
+                                 window=TRANSACTION_CODE_EXPIRATION, time_slack=RECONCILE_TIME_SLACK,
+                                 amount_tolerance=RECONCILE_AMOUNT_TOLERANCE)
+
+# Bộ sinh mã giao dịch VCDxxxxxxxxxx không trùng lặp
+transaction_code_generator = TransactionCodeGenerator(redis_client, block_size=TRANSACTION_CODE_BLOCK_SIZE)
+
+# Cache ảnh QR đã render (trong process + Redis)
+qr_image_cache = QRImageCache(redis_client, max_bytes=QR_CACHE_MAX_BYTES, ttl=QR_CACHE_TTL)
+
+# Render ảnh QR của /create_transactions song song trên nhiều process
+qr_render_pool = QRRenderPool()
+
+# Sổ ghi nhận email đã xử lý, đảm bảo mỗi email chỉ xác nhận giao dịch một lần
+email_ledger = EmailLedger(redis_client, ttl=EMAIL_LEDGER_TTL, claim_timeout=EMAIL_CLAIM_TIMEOUT,
+                           max_attempts=EMAIL_MAX_ATTEMPTS)
+
+# Outbox gửi request xác nhận tới ứng dụng
+webhook_dispatcher = WebhookDispatcher(redis_client, APP_URL, headers={'Authorization': f'Bearer {API_KEY}'},
+                                       workers=WEBHOOK_WORKERS, timeout=WEBHOOK_TIMEOUT, max_attempts=WEBHOOK_MAX_ATTEMPTS)
+
+# Bầu chọn leader cho các luồng nền giữa các process/instance
+leader_elector = LeaderElector(redis_client, ttl=LEADER_LEASE_TTL, renew_interval=LEADER_RENEW_INTERVAL,
+                               max_hold=LEADER_MAX_HOLD_ON_ERRORS)
+
+# Phát/nhận thay đổi trạng thái giao dịch qua Redis pub/sub cho SSE và long-poll
+transaction_status_hub = TransactionStatusHub(redis_client)
 
 # Flask App
 app = Flask(__name__)
 
-def extract_transaction_details(body):
-    """Trích xuất chi tiết giao dịch từ nội dung email."""
-    transaction_details = {}
-    patterns = {
-        "amount_increased": re.compile(r"vừa tăng ([\d,.]+) VND"),
-        "amount_decreased": re.compile(r"vừa giảm ([\d,.]+) VND"),
-        "time": re.compile(r"vào (\d{2}/\d{2}/\d{4} \d{2}:\d{2})"),
-        "current_balance": re.compile(r"Số dư hiện tại: ([\d,.]+) VND"),
-        "description": re.compile(r"Mô tả: (.+)")
-    }
 
-    transaction_details = {
-        key: (match.group(1).replace('.', '').replace(',', '') if key in ["amount_increased", "amount_decreased", "current_balance"] else match.group(1).split("</p>")[0] if key == "description" else match.group(1))
-        if (match := patterns[key].search(body)) else None
-        for key in patterns
-    }
+@app.errorhandler(redis.exceptions.ConnectionError)
+@app.errorhandler(redis.exceptions.TimeoutError)
+def redis_unavailable(e):
+    """Redis không phản hồi (kết nối được mở lại ở request sau): trả 503 thay vì 500."""
+    logger.error(f"Redis không phản hồi: {e}")
+    return jsonify({'message': 'Service temporarily unavailable', 'error': str(e)}), 503
 
-    # Chuyển đổi sang định dạng ISO 8601
-    if transaction_details["time"]:
+
+def extract_transaction_details(body, parser=EMAIL_PARSER):
+    """Trích xuất chi tiết giao dịch từ nội dung email."""
+    return email_parser.parse(body, parser)
+
+
+def process_cake_email(body, received_at=None, source=None, transaction_details=None, pipe=None):
+    """Xử lý email từ Cake và gửi thông báo tới ứng dụng nếu cần.
+
+    received_at: thời điểm ngân hàng gửi email (epoch giây), dùng để đo thời gian tới khi ứng dụng xác nhận.
+    source: hộp thư nhận email (MailboxSource), quyết định parser và tài khoản ngân hàng; mặc định là hộp thư đầu tiên.
+    transaction_details: kết quả trích xuất đã có sẵn (ví dụ replay.py trích xuất song song), bỏ qua bước trích xuất.
+    pipe: pipeline của caller; mọi thay đổi trạng thái của email được đưa vào đó thay vì ghi ngay.
+    """
+    source = source or mailbox_sources[0]
+    account = {'bank_code': source.bank_code, 'account_number': source.account_number}
+    if transaction_details is None:
+        with metrics.EMAIL_PARSE_SECONDS.time():
+            transaction_details = extract_transaction_details(body, source.parser)
+    logger.debug(transaction_details)
+    if not transaction_details:
+        return
+    description = transaction_details.get('description', '')
+    transaction_time = transaction_details.get("time", 'Không rõ')
+    credit_at = payment_decision.credit_time(transaction_details, received_at)
+
+    settled = False
+    for action in payment_decision.plan_actions(transaction_details, credit_at, read_pending_transaction,
+                                                match_payment):
+        if action['action'] == 'topup':
+            direction = 'đi' if action['transaction_type'] == 'decrease' else 'đến'
+            logger.info(f"Phát hiện giao dịch chuyển tiền {direction}: {action['phone_number']}, số tiền: {action['amount']}")
+            confirm_topup(action['phone_number'], action['amount'], description, transaction_time,
+                          action['transaction_type'], received_at, account, pipe=pipe)
+        elif action['action'] == 'skip':
+            metrics.TRANSACTION_MATCHES.labels(action['reason']).inc()
+            if action['reason'] == 'not_found':
+                logger.info(f"Không tìm thấy mã giao dịch hoặc không phải giao dịch nhận tiền: {action['code']}")
+            else:
+                logger.info(f"Giao dịch không khớp với số tiền nhận được: {description}")
+        elif action['action'] == 'settle':
+            if action['match'] == 'fuzzy_code':
+                logger.info(f"Đối soát khoản tiền {action['amount']} ({description}) với giao dịch {action['code']}, mã sai {action['distance']} ký tự")
+                metrics.PAYMENT_RECONCILIATIONS.labels('fuzzy_code').inc()
+            settle_transaction(action, description, transaction_time, received_at, account, pipe=pipe)
+            settled = True
+        elif action['action'] == 'needs_review':
+            record_unmatched_payment(action, description, transaction_time, credit_at, received_at, account, pipe=pipe)
+            settled = True
+    if not settled:
+        logger.info("Không xác nhận giao dịch")
+
+
+def read_pending_transaction(code):
+    """Hash pending_transaction của code đã giải mã, {} nếu không có."""
+    data = redis_client.hgetall(f"{PENDING_TRANSACTION_PREFIX}{code}")
+    return {field.decode(): value.decode() for field, value in data.items()}
+
+
+def match_payment(description, amount, credit_time):
+    with metrics.RECONCILE_LOOKUP_SECONDS.time():
+        return payment_matcher.match(description, amount, credit_time)
+
+
+def settle_transaction(action, description, transaction_time, received_at=None, account=None, pipe=None):
+    """Ghi nhận khoản tiền đến theo hành động settle của payment_decision và gửi xác nhận tới ứng dụng.
+
+    Chuyển thiếu chuyển giao dịch sang underpaid thay vì completed, chuyển thừa vẫn completed; cả hai đều được đánh
+    dấu trong lịch sử và request xác nhận.
+    """
+    code, transaction = action['code'], action['transaction']
+    pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
+    transaction_id = transaction.get('transaction_id', '')
+    amount = action['expected_amount']
+    timestamp = transaction.get('timestamp', '0')
+    amount_received, amount_status, match = action['amount'], action['amount_status'], action['match']
+    reconciliation = {'code': code, 'expected_amount': amount, 'amount_status': amount_status, 'match': match}
+
+    logger.info(f"Xác nhận giao dịch NHẬN TIỀN: {description}, số tiền: {amount_received}, transaction_id: {transaction_id}, code: {code}, timestamp: {timestamp}, đối chiếu: {match}, số tiền: {amount_status}")
+
+    new_status = action['new_status']
+    if new_status is None:
+        metrics.TRANSACTION_MATCHES.labels('already_processed').inc()
+        logger.info(f"Giao dịch đã được xử lý trước đó: {code}, trạng thái: {action['status']}")
+        return
+
+    # Các thay đổi trạng thái được ghi cùng một MULTI/EXEC (của caller nếu có pipe)
+    target = pipe if pipe is not None else redis_client.pipeline()
+    target.hset(pending_transaction_key, 'status', new_status)
+    if action['status'] == 'pending':
+        pending_deadlines.remove(code, pipe=target)
+        pending_amounts.remove(code, amount, pipe=target)
+    # Cập nhật lịch sử giao dịch
+    update_transaction_history(code, new_status, amount_received, description, transaction_time, pipe=target,
+                               extra=reconciliation)
+    transaction_status_hub.publish(code, new_status, pipe=target)
+    transaction_stats.record(target, 'transaction', new_status, amount_received, at=received_at or time.time(),
+                             created_at=timestamp, direction='in')
+    confirm_transaction(transaction_id, amount_received, description, transaction_time, received_at, account,
+                        extra=reconciliation, pipe=target)
+    metrics.TRANSACTION_MATCHES.labels(new_status).inc()
+    metrics.PAYMENT_AMOUNT_CHECKS.labels(amount_status).inc()
+    logger.info(f"Cập nhật trạng thái giao dịch thành công: {code}, trạng thái: {new_status}")
+    if pipe is None:
+        target.execute()
+
+
+def record_unmatched_payment(action, description, transaction_time, credit_time, received_at=None, account=None,
+                             pipe=None):
+    """Lưu khoản tiền đến không khớp giao dịch nào (hành động needs_review của payment_decision).
+
+    Khoản tiền được lưu vào lịch sử với type=unmatched, status=needs_review kèm các giao dịch gợi ý để người vận hành
+    xử lý.
+    """
+    amount = action['amount']
+    metrics.PAYMENT_RECONCILIATIONS.labels(action['reason']).inc()
+    transaction_data = {
+        'type': 'unmatched',
+        'status': 'needs_review',
+        'amount': amount,
+        'description': description,
+        'transaction_time': transaction_time,
+        'reason': action['reason'],
+        'candidates': action['candidates'],
+        **(account or {})
+    }
+    target = pipe if pipe is not None else redis_client.pipeline()
+    transaction_store.add(transaction_data, created_at=credit_time, pipe=target)
+    transaction_stats.record(target, 'unmatched', 'needs_review', amount, at=received_at or time.time(), direction='in')
+    if pipe is None:
+        target.execute()
+    logger.warning(f"Khoản tiền {amount} ({description}) không khớp giao dịch nào ({action['reason']}), "
+                   f"giao dịch gợi ý: {[candidate['code'] for candidate in action['candidates']]}")
+
+
+def get_email_body(msg):
+    """Lấy nội dung văn bản của email (ưu tiên text/plain), trả về None nếu không hỗ trợ."""
+    body = email_parser.extract_body(msg)
+    if body is None:
+        logger.warning(f"Không hỗ trợ định dạng email: {msg.get_content_type()}")
+    return body
+
+
+def handle_email(key, body, received_at=None, source=None, transaction_details=None, buffer=True):
+    """Xử lý một email đúng một lần dựa trên sổ ghi nhận email (email_ledger).
+
+    Mọi thay đổi trạng thái của email (xác nhận giao dịch, outbox, sổ ghi nhận) được ghi trong một MULTI/EXEC.
+    - Redis không phản hồi khi nhận quyền xử lý (bước đầu tiên chạm tới Redis): email được đệm ra đĩa
+      (write_buffer, nếu bật và buffer=True) và được xử lý lại qua hàm này khi Redis hoạt động trở lại.
+      Không đệm được thì lỗi được báo cho caller (email vẫn còn trên hộp thư).
+    - Lỗi sau khi đã nhận quyền (kể cả mất kết nối giữa chừng): email được ghi nhận lỗi để thử lại, trừ khi MULTI/EXEC
+      thực ra đã chạy hoặc email đã bị nhận lại ở nơi khác (mark_failed chỉ ghi khi vẫn giữ quyền); nếu không ghi
+      nhận được thì email vẫn ở trạng thái claimed và được email_retry xử lý lại sau claim_timeout.
+
+    Trả về kết quả: 'processed', 'buffered', 'failed' hoặc 'duplicate' (đã/đang được xử lý ở nơi khác).
+    """
+    try:
+        owner = email_ledger.claim(key, body, source.name if source else '')
+    except REDIS_UNAVAILABLE_ERRORS as e:
+        if not buffer or not write_buffer.enabled:
+            raise
         try:
-            datetime_object = datetime.strptime(transaction_details["time"], "%d/%m/%Y %H:%M")
-            transaction_details["time"] = datetime_object.isoformat() + "+07:00"
-        except ValueError:
-            logger.info("Lỗi: Định dạng thời gian không hợp lệ.")
+            write_buffer.append({'key': key, 'body': body, 'received_at': received_at,
+                                 'source': source.name if source else None, 'buffered_at': time.time()})
+        except WriteBufferFull:
+            logger.error(f"Bộ đệm ghi {write_buffer.directory} đã đầy ({write_buffer.max_bytes} byte), không đệm được email {key}")
+            raise e
+        logger.warning(f"Redis không phản hồi ({e}), đã đệm email {key} vào {write_buffer.path()}")
+        metrics.EMAILS_TOTAL.labels('buffered').inc()
+        return 'buffered'
+    if owner is None:
+        logger.info(f"Email {key} đã được xử lý hoặc đang được xử lý ở tiến trình khác, bỏ qua")
+        metrics.EMAILS_TOTAL.labels('duplicate').inc()
+        return 'duplicate'
+    pipe = redis_client.pipeline()
+    try:
+        with metrics.EMAIL_PROCESS_SECONDS.time():
+            process_cake_email(body, received_at, source, transaction_details, pipe=pipe)
+            email_ledger.mark_processed(key, pipe=pipe)
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Lỗi khi xử lý email {key}: {e}")
+        pipe.reset()
+        try:
+            email_ledger.mark_failed(key, e, owner)
+        except redis.exceptions.RedisError as ledger_error:
+            logger.error(f"Không ghi nhận được lỗi của email {key} ({ledger_error}), email sẽ được xử lý lại sau {email_ledger.claim_timeout} giây")
+        metrics.EMAILS_TOTAL.labels('failed').inc()
+        return 'failed'
+    metrics.EMAILS_TOTAL.labels('processed').inc()
+    return 'processed'
 
-    return transaction_details
 
+def replay_buffered_email(entry):
+    """Xử lý lại một email trong write_buffer. Lỗi kết nối Redis được báo cho write_buffer để giữ entry lại."""
+    return handle_email(entry['key'], entry['body'], entry.get('received_at'),
+                        mailbox_sources_by_name.get(entry.get('source')), buffer=False)
 
-def process_cake_email(body):
-    """Xử lý email từ Cake và gửi thông báo tới ứng dụng nếu cần."""
-    transaction_details = extract_transaction_details(body)
-    logger.debug(transaction_details)
-    if transaction_details:
-        description = transaction_details.get('description', '')
-        amount_decreased = transaction_details.get('amount_decreased')
-        amount_increased = transaction_details.get('amount_increased')
-        transaction_time = transaction_details.get("time", 'Không rõ')
-
-        phone_number_match = re.compile(r"^.*?(NT\d{10})").match(description)
-
-        if amount_decreased and phone_number_match:
-            phone_number = phone_number_match.group(1)
-            logger.info(f"Phát hiện giao dịch chuyển tiền đi: {phone_number}, số tiền: {amount_decreased}")
-            confirm_topup(phone_number, amount_decreased, description, transaction_time, 'decrease')
-        if amount_increased and phone_number_match:
-            phone_number = phone_number_match.group(1)
-            logger.info(f"Phát hiện giao dịch chuyển tiền đến: {phone_number}, số tiền: {amount_increased}")
-            confirm_topup(phone_number, amount_increased, description, transaction_time, 'increase')
-
-        # Xác thực giao dịch chuyển tiền với mã tạm thời
-        match = re.search(r"(VCD\d{10})", description)
-        if match:
-            code = match.group(1)
-            pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
-            data = redis_client.hgetall(pending_transaction_key)
-
-            if data and b'type' in data and data[b'type'].decode() == 'receive':
-                if amount_increased:
-                    transaction_id = data.get(b'transaction_id', b'').decode()
-                    amount = data.get(b'amount', b'0').decode()
-                    timestamp = data.get(b'timestamp', b'0').decode()
-                    status = data.get(b'status', b'pending').decode()
-
-                    logger.info(f"Xác nhận giao dịch NHẬN TIỀN: {description}, số tiền: {amount_increased}, transaction_id: {transaction_id}, code: {code}, timestamp: {timestamp}")
-
-                    if status == 'pending':
-                        # Cập nhật trạng thái thành completed
-                        redis_client.hset(pending_transaction_key, 'status', 'completed')
-                        # Cập nhật lịch sử giao dịch
-                        update_transaction_history(code, 'completed', amount_increased, description, transaction_time)
-                        confirm_transaction(transaction_id, amount_increased, description, transaction_time)
-                        logger.info(f"Cập nhật trạng thái giao dịch thành công: {code}")
-                    elif status == 'expired':
-                        # Cập nhật trạng thái thành received_after_expired
-                        redis_client.hset(pending_transaction_key, 'status', 'received_after_expired')
-                        # Cập nhật lịch sử giao dịch
-                        update_transaction_history(code, 'received_after_expired', amount_increased, description, transaction_time)
-                        confirm_transaction(transaction_id, amount_increased, description, transaction_time)
-                        logger.info(f"Cập nhật trạng thái giao dịch nhận được sau khi hết hạn: {code}")
-                    else:
-                        logger.info(f"Giao dịch đã được xử lý trước đó: {code}, trạng thái: {status}")
-
-                else:
-                    logger.info(f"Giao dịch không khớp với số tiền nhận được: {description}")
-            else:
-                logger.info(f"Không tìm thấy mã giao dịch hoặc không phải giao dịch nhận tiền: {code}")
-        else:
-            logger.info("Không xác nhận giao dịch")
 
-def fetch_last_unseen_email():
-    """Lấy nội dung của email chưa đọc cuối cùng từ hộp thư đến."""
-    mail = imaplib.IMAP4_SSL(EMAIL_IMAP)
+def email_received_at(msg):
+    """Thời điểm gửi email theo header Date (epoch giây), None nếu không đọc được."""
     try:
-        mail.login(EMAIL_LOGIN, EMAIL_PASSWORD)
-        mail.select("inbox")
+        return email.utils.parsedate_to_datetime(msg.get('Date')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
 
-        for sender in CAKE_EMAIL_SENDERS:
-            _, email_ids = mail.search(None, f'(UNSEEN FROM "{sender}")')
-            email_ids = email_ids[0].split()
-            if not email_ids:
+def process_unseen_emails(mail, source=None):
+    """Xử lý các email chưa đọc trên một kết nối IMAP đã đăng nhập và chọn hộp thư của source."""
+    source = source or mailbox_sources[0]
+    # Khi có bộ đệm ghi, Redis không phản hồi không được chặn việc đọc email: email được đệm ra đĩa trong handle_email
+    high_water_mark = UidHighWaterMark(redis_client, source.login, source.folder,
+                                       tolerate_errors=REDIS_UNAVAILABLE_ERRORS if write_buffer.enabled else ())
+    with metrics.EMAIL_POLL_SECONDS.time():
+        for uid, msg in fetch_new_messages(mail, source.senders, high_water_mark, EMAIL_FETCH_BATCH_SIZE):
+            logger.info(f'Phát hiện email mới từ {msg.get("From")} trong hộp thư {source.name} (UID {uid})')
+            body = get_email_body(msg)
+            if body is None:
+                metrics.EMAILS_TOTAL.labels('unsupported').inc()
                 continue
+            handle_email(message_key(msg.get('Message-ID'), body), body, email_received_at(msg), source)
+
+
+def retry_failed_emails():
+    """Xử lý lại các email bị lỗi hoặc bị bỏ dở (tiến trình dừng khi đang xử lý)."""
+    for key, body, source_name in email_ledger.due_entries():
+        logger.info(f"Xử lý lại email {key}")
+        handle_email(key, body, source=mailbox_sources_by_name.get(source_name))
 
-            for email_id in email_ids:
-                _, msg_data = mail.fetch(email_id, "(RFC822)")
-                msg = email.message_from_bytes(msg_data[0][1])
-                logger.info(f'Phát hiện email mới từ {sender}')
-                mail.store(email_id, '+FLAGS', '\Seen')
-
-                if msg.get_content_type() == 'text/plain':
-                    body = msg.get_payload(decode=True).decode()
-                    process_cake_email(body)
-                elif msg.is_multipart():
-                    for part in msg.walk():
-                        if part.get_content_type() in ["text/plain", "text/html"]:
-                            body = part.get_payload(decode=True).decode()
-                            process_cake_email(body)
-                            break
-                else:
-                    logger.warning(f"Không hỗ trợ định dạng email: {msg.get_content_type()}")
-    except Exception as e:
-        logger.error(f"Lỗi khi xử lý email: {e}")
-    finally:
-        mail.logout()
 
+def confirm_topup(phone_number, amount, description, transaction_time, transaction_type, received_at=None,
+                  account=None, pipe=None):
+    """Đưa request xác nhận nạp tiền vào outbox và lưu lịch sử giao dịch (trạng thái queued).
 
-def confirm_topup(phone_number, amount, description, transaction_time, transaction_type):
-    """Gửi request xác nhận nạp tiền đến ứng dụng và lưu lịch sử giao dịch."""
-    headers = {'Authorization': f'Bearer {API_KEY}'}
+    account: {'bank_code', 'account_number'} của tài khoản nhận/chuyển tiền (theo hộp thư nhận email).
+    pipe: pipeline của caller, mặc định ghi ngay trong một MULTI/EXEC riêng.
+    """
     payload = {
         'phone_number': phone_number,
         'amount': amount,
         'description': description,
         'transaction_time': transaction_time,
-        'transaction_type': transaction_type
+        'transaction_type': transaction_type,
+        **(account or {})
     }
-    try:
-        response = requests.post(f"{APP_URL}/confirm_topup", json=payload, headers=headers)
-        response.raise_for_status()
-        logger.info(f"Đã gửi request xác nhận nạp tiền cho số điện thoại {phone_number}, số tiền {amount}, trạng thái {transaction_type}, transaction_id: {response.json().get('transaction_id')}")
-
-        transaction_data = {
-            'type': 'topup',
-            'status': 'success',
-            'phone_number': phone_number,
-            'amount': amount,
-            'description': description,
-            'transaction_time': transaction_time,
-            'transaction_type': transaction_type,
-            'response': response.json()
-        }
-        redis_client.rpush(TRANSACTION_HISTORY_KEY, json.dumps(transaction_data))
-        logger.info(f"Đã lưu lịch sử giao dịch nạp tiền: {transaction_data}")
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Lỗi khi gửi request xác nhận nạp tiền: {e}")
-        transaction_data = {
-            'type': 'topup',
-            'status': 'failed',
-            'phone_number': phone_number,
-            'amount': amount,
-            'description': description,
-            'transaction_time': transaction_time,
-            'transaction_type': transaction_type,
-            'error': str(e)
-        }
-        redis_client.rpush(TRANSACTION_HISTORY_KEY, json.dumps(transaction_data))
-        logger.error(f"Đã lưu lịch sử giao dịch nạp tiền (lỗi): {transaction_data}")
-
-
-def confirm_transaction(transaction_id, amount, description, transaction_time):
-    """Gửi request xác nhận giao dịch đến ứng dụng và lưu lịch sử giao dịch."""
-    headers = {'Authorization': f'Bearer {API_KEY}'}
+    transaction_data = {
+        'type': 'topup',
+        'status': 'queued',
+        'phone_number': phone_number,
+        'amount': amount,
+        'description': description,
+        'transaction_time': transaction_time,
+        'transaction_type': transaction_type,
+        **(account or {})
+    }
+    history_id = transaction_store.new_id()
+    target = pipe if pipe is not None else redis_client.pipeline()
+    transaction_store.add(transaction_data, record_id=history_id, pipe=target)
+    transaction_stats.record(target, 'topup', 'queued', amount, at=received_at or time.time(),
+                             direction='in' if transaction_type == 'increase' else 'out')
+    webhook_dispatcher.enqueue('topup', '/confirm_topup', payload,
+                               meta={'history_id': history_id, 'received_at': received_at}, pipe=target)
+    if pipe is None:
+        target.execute()
+    metrics.CONFIRMATIONS_QUEUED.labels('topup').inc()
+    logger.info(f"Đã đưa request xác nhận nạp tiền vào hàng đợi: {transaction_data}")
+
+
+def on_topup_acked(job, response_data, pipe):
+    """Cập nhật lịch sử và số liệu trong cùng transaction với lệnh xóa job khỏi outbox, nên chỉ được ghi một lần."""
+    transaction_store.update(job['meta']['history_id'], {'status': 'success', 'response': response_data}, pipe=pipe)
+    if job.get('dead_at'):
+        # Đã được tính failed khi bị chuyển vào dead-letter, nay được gửi lại thành công
+        transaction_stats.retract(pipe, 'topup', 'failed', job['payload']['amount'], at=job['dead_at'])
+    transaction_stats.record(pipe, 'topup', 'success', job['payload']['amount'])
+
+
+def on_topup_confirmed(job, response_data):
+    """Ghi log khi ứng dụng đã xác nhận nạp tiền."""
+    payload = job['payload']
+    observe_email_to_confirm(job)
+    app_transaction_id = response_data.get('transaction_id') if isinstance(response_data, dict) else None
+    logger.info(f"Đã gửi request xác nhận nạp tiền cho số điện thoại {payload['phone_number']}, số tiền {payload['amount']}, trạng thái {payload['transaction_type']}, transaction_id: {app_transaction_id}")
+
+
+def on_topup_failed(job, error):
+    """Cập nhật lịch sử khi không gửi được request xác nhận nạp tiền."""
+    pipe = redis_client.pipeline()
+    transaction_store.update(job['meta']['history_id'], {'status': 'failed', 'error': str(error)}, pipe=pipe)
+    if not job.get('dead_at'):
+        # Job gửi lại từ dead-letter đã được tính failed ở lần đầu
+        transaction_stats.record(pipe, 'topup', 'failed', job['payload']['amount'])
+    pipe.execute()
+    logger.error(f"Lỗi khi gửi request xác nhận nạp tiền: {error}")
+
+
+def confirm_transaction(transaction_id, amount, description, transaction_time, received_at=None, account=None,
+                        extra=None, pipe=None):
+    """Đưa request xác nhận giao dịch vào outbox.
+
+    extra: thông tin đối soát (code, expected_amount, amount_status, match) gửi kèm để ứng dụng xử lý chuyển thiếu/thừa.
+    """
     payload = {
         'transaction_id': transaction_id,
         'amount': amount,
         'description': description,
-        'transaction_time': transaction_time
+        'transaction_time': transaction_time,
+        **(account or {}),
+        **(extra or {})
     }
-    try:
-        response = requests.post(f"{APP_URL}/confirm_transaction", json=payload, headers=headers)
-        response.raise_for_status()
-        logger.info(f"Đã gửi request xác nhận giao dịch cho transaction_id {transaction_id}, số tiền {amount}, transaction_id từ app: {response.json().get('transaction_id')}")
+    webhook_dispatcher.enqueue('transaction', '/confirm_transaction', payload, meta={'received_at': received_at},
+                               pipe=pipe)
+    metrics.CONFIRMATIONS_QUEUED.labels('transaction').inc()
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Lỗi khi gửi request xác nhận giao dịch: {e}")
-        # Có thể cập nhật status = failed nếu cần thiết
 
-def generate_qr_image_from_string(qr_content, scale=10):
-    """Tạo ảnh QR PNG từ chuỗi nội dung sử dụng segno."""
-    try:
-        img_io = BytesIO()
-        qr_content.save(img_io, kind='png', scale=scale, dark='darkred', data_dark='darkorange', data_light='yellow')
-        img_io.seek(0)
-        return img_io
-    except Exception as e:
-        logger.error(f"Lỗi khi tạo mã QR từ chuỗi: {e}")
-        return None
+def on_transaction_confirmed(job, response_data):
+    payload = job['payload']
+    observe_email_to_confirm(job)
+    app_transaction_id = response_data.get('transaction_id') if isinstance(response_data, dict) else None
+    logger.info(f"Đã gửi request xác nhận giao dịch cho transaction_id {payload['transaction_id']}, số tiền {payload['amount']}, transaction_id từ app: {app_transaction_id}")
+
+
+def on_transaction_failed(job, error):
+    logger.error(f"Lỗi khi gửi request xác nhận giao dịch: {error}")
+    # Có thể cập nhật status = failed nếu cần thiết
+
+
+def observe_email_to_confirm(job):
+    """Ghi nhận thời gian từ lúc ngân hàng gửi email tới khi ứng dụng xác nhận thành công."""
+    received_at = job['meta'].get('received_at')
+    if received_at:
+        metrics.EMAIL_TO_CONFIRM_SECONDS.labels(job['kind']).observe(max(time.time() - received_at, 0))
+
+
+def render_qr_image(bank_code, account_number, amount, purpose, kind='png', scale=10):
+    """Render ảnh QR thanh toán (bytes, xem qr_render.render_payment_qr) và ghi nhận thời gian render."""
+    with metrics.QR_RENDER_SECONDS.labels(kind).time():
+        return render_payment_qr(bank_code, account_number, amount, purpose, kind=kind, scale=scale)
+
+
+def parse_qr_options(data):
+    """Đọc định dạng (png/svg) và scale của ảnh QR từ request, mặc định PNG scale 10."""
+    kind = str(data.get('format', 'png')).lower()
+    if kind not in QR_MIMETYPES:
+        raise ValueError(f"Unsupported QR format: {kind}")
+    scale = int(data.get('scale', 10))
+    if not 1 <= scale <= QR_MAX_SCALE:
+        raise ValueError(f"scale must be between 1 and {QR_MAX_SCALE}")
+    return kind, scale
+
+
+def static_qr_cache_key(bank_code, account_number, purpose, kind, scale):
+    return cache_key('static', bank_code, account_number, purpose, kind, scale)
+
+
+def render_static_qr(bank_code, account_number, purpose, kind='png', scale=10):
+    """Ảnh QR tĩnh chỉ phụ thuộc vào tham số nên được lấy từ cache, chỉ render khi chưa có."""
+    def render():
+        return render_qr_image(bank_code, account_number, None, purpose, kind=kind, scale=scale)
+
+    return qr_image_cache.get_or_render(static_qr_cache_key(bank_code, account_number, purpose, kind, scale), render)
+
+
+def queue_pending_transaction(pipe, code, transaction_id, amount, timestamp):
+    """Đưa vào pipeline các lệnh tạo giao dịch pending: hash pending, chỉ mục hạn và entry trong transaction_history."""
+    pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
+
+    # Lưu thông tin giao dịch vào Redis với trạng thái pending
+    pipe.hset(pending_transaction_key, mapping={
+        'transaction_id': transaction_id,
+        'amount': amount,
+        'timestamp': timestamp,
+        'type': 'receive',
+        'status': 'pending',
+        'description': f"Giao dịch {code}"
+    })
+    pipe.expire(pending_transaction_key, TRANSACTION_CODE_EXPIRATION)
+    pending_deadlines.add(code, timestamp + TRANSACTION_CODE_EXPIRATION, pipe=pipe)
+    pending_amounts.add(code, amount, timestamp, pipe=pipe)
+
+    # Thêm entry vào transaction_history với trạng thái pending
+    transaction_data = {
+        'type': 'transaction',
+        'status': 'pending',
+        'transaction_id': transaction_id,
+        'amount': amount,
+        'description': f"Tạo giao dịch {code}",
+        'transaction_time': datetime.fromtimestamp(timestamp).isoformat() + "+07:00",
+        'code': code
+    }
+    transaction_store.add(transaction_data, created_at=timestamp, pipe=pipe)
+    transaction_stats.record(pipe, 'transaction', 'pending', amount, at=timestamp)
+
 
 @app.route('/create_transaction', methods=['POST'])
 def create_transaction():
@@ -264,44 +619,22 @@ def create_transaction():
         if not transaction_id or not amount:
             return jsonify({'message': 'Missing transaction_id or amount'}), 400
 
+        try:
+            qr_format, qr_scale = parse_qr_options(data)
+        except ValueError as e:
+            return jsonify({'message': 'Invalid QR options', 'error': str(e)}), 400
+
         timestamp = int(time.time())
-        code = f"VCD{timestamp}"
-        pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
+        code = transaction_code_generator.generate()
 
-        # Lưu thông tin giao dịch vào Redis với trạng thái pending
         pipe = redis_client.pipeline()
-        pipe.hset(pending_transaction_key, mapping={
-            'transaction_id': transaction_id,
-            'amount': amount,
-            'timestamp': timestamp,
-            'type': 'receive',
-            'status': 'pending',
-            'description': f"Giao dịch {code}"
-        })
-        pipe.expire(pending_transaction_key, TRANSACTION_CODE_EXPIRATION)
-
-        # Thêm entry vào transaction_history với trạng thái pending
-        transaction_data = {
-            'type': 'transaction',
-            'status': 'pending',
-            'transaction_id': transaction_id,
-            'amount': amount,
-            'description': f"Tạo giao dịch {code}",
-            'transaction_time': datetime.fromtimestamp(timestamp).isoformat() + "+07:00",
-            'code': code
-        }
-        pipe.rpush(TRANSACTION_HISTORY_KEY, json.dumps(transaction_data))
-
+        queue_pending_transaction(pipe, code, transaction_id, amount, timestamp)
         pipe.execute()
 
         logger.info(f"Đã tạo mã giao dịch tạm thời: {code} cho transaction_id: {transaction_id} với transaction_amount: {amount} (hết hạn sau {TRANSACTION_CODE_EXPIRATION} giây), type: receive, status: pending")
 
-        # Tạo nội dung QR
-        qr_pay = QRPay(BANK_CODE, ACCOUNT_NUMBER, transaction_amount=amount, point_of_initiation_method='DYNAMIC', purpose_of_transaction=code)
-        qr_content = qr_pay.generate_qr_code_image(qr_pay.code)
-        
-        # Tạo ảnh QR từ nội dung và mã hóa base64
-        qr_code_base64 = base64.b64encode(generate_qr_image_from_string(qr_content).getvalue()).decode('utf-8')
+        # Tạo ảnh QR và mã hóa base64
+        qr_code_base64 = base64.b64encode(render_qr_image(BANK_CODE, ACCOUNT_NUMBER, amount, code, qr_format, qr_scale)).decode('utf-8')
 
         # Tạo JSON response
         response_data = {
@@ -309,6 +642,7 @@ def create_transaction():
             "transaction_id": transaction_id,
             "code": code,
             "qr_code_data": qr_code_base64,
+            "qr_code_format": qr_format,
             "amount": amount,
             "expires_at": timestamp + TRANSACTION_CODE_EXPIRATION,
             "message": ""
@@ -320,24 +654,240 @@ def create_transaction():
         logger.error(f"Lỗi khi tạo mã giao dịch: {e}")
         return jsonify({'message': 'Error creating transaction', 'error': str(e)}), 500
 
+class StreamWriter(io.RawIOBase):
+    """File chỉ ghi, gom dữ liệu để stream dần ra response (zipfile ghi được vào stream không seek được)."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+@app.route('/create_transactions', methods=['POST'])
+def create_transactions():
+    """API endpoint để tạo nhiều giao dịch trong một request.
+
+    Mọi mã giao dịch được cấp và mọi bản ghi được ghi vào Redis trong một pipeline, ảnh QR được render song song
+    trên process pool. Kết quả theo đúng thứ tự đầu vào, mỗi phần tử có status success/error riêng, trả về dạng
+    NDJSON (mặc định) hoặc file ZIP chứa ảnh QR và results.json (`output=zip`).
+    """
+    headers = request.headers
+    auth_header = headers.get('Authorization')
+
+    if not auth_header or auth_header != f'Bearer {API_KEY}':
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    try:
+        data = request.get_json()
+        items = data.get('transactions')
+        if not isinstance(items, list) or not items:
+            return jsonify({'message': 'Missing transactions'}), 400
+        if len(items) > BULK_CREATE_MAX_ITEMS:
+            return jsonify({'message': f'At most {BULK_CREATE_MAX_ITEMS} transactions per request'}), 400
+
+        output = str(data.get('output', 'json')).lower()
+        if output not in ('json', 'zip'):
+            return jsonify({'message': f'Unsupported output: {output}'}), 400
+
+        try:
+            qr_format, qr_scale = parse_qr_options(data)
+        except ValueError as e:
+            return jsonify({'message': 'Invalid QR options', 'error': str(e)}), 400
+
+        results = []
+        created = []
+        for index, item in enumerate(items):
+            transaction_id = item.get('transaction_id') if isinstance(item, dict) else None
+            amount = item.get('amount') if isinstance(item, dict) else None
+            result = {'index': index, 'status': 'success', 'transaction_id': transaction_id, 'amount': amount}
+            if not transaction_id or not amount:
+                result.update(status='error', error='Missing transaction_id or amount')
+            else:
+                created.append(result)
+            results.append(result)
+
+        if not created:
+            return jsonify({'message': 'No valid transactions', 'results': results}), 400
+
+        timestamp = int(time.time())
+        codes = transaction_code_generator.generate_many(len(created))
+        pipe = redis_client.pipeline()
+        for result, code in zip(created, codes):
+            result.update(code=code, expires_at=timestamp + TRANSACTION_CODE_EXPIRATION)
+            queue_pending_transaction(pipe, code, result['transaction_id'], result['amount'], timestamp)
+        pipe.execute()
+
+        logger.info(f"Đã tạo {len(created)} mã giao dịch tạm thời theo lô (hết hạn sau {TRANSACTION_CODE_EXPIRATION} giây), type: receive, status: pending")
+
+    except Exception as e:
+        logger.error(f"Lỗi khi tạo giao dịch theo lô: {e}")
+        return jsonify({'message': 'Error creating transactions', 'error': str(e)}), 500
+
+    images = qr_render_pool.render_many([
+        (BANK_CODE, ACCOUNT_NUMBER, result['amount'], result['code'], qr_format, qr_scale) for result in created
+    ])
+
+    def rendered():
+        # Ảnh được trả về theo thứ tự các giao dịch đã tạo nên ghép lại được với kết quả theo thứ tự đầu vào
+        for result in results:
+            image = None
+            if result['status'] == 'success':
+                image, error = next(images)
+                if error:
+                    logger.error(f"Lỗi khi tạo mã QR cho giao dịch {result['code']}: {error}")
+                    result.update(status='error', error=f'Transaction created but QR rendering failed: {error}')
+            yield result, image
+
+    def generate_json():
+        for result, image in rendered():
+            if image is not None:
+                result.update(qr_code_data=base64.b64encode(image).decode('utf-8'), qr_code_format=qr_format)
+            yield json.dumps(result) + "\n"
+
+    def generate_zip():
+        stream = StreamWriter()
+        manifest = []
+        # PNG đã được nén sẵn, chỉ nén SVG
+        compression = zipfile.ZIP_DEFLATED if qr_format == 'svg' else zipfile.ZIP_STORED
+        with zipfile.ZipFile(stream, 'w', compression=compression) as archive:
+            for result, image in rendered():
+                if image is not None:
+                    result['file'] = f"{result['code']}.{qr_format}"
+                    archive.writestr(result['file'], image)
+                    yield stream.drain()
+                manifest.append(result)
+            archive.writestr('results.json', json.dumps(manifest))
+        yield stream.drain()
+
+    if output == 'zip':
+        response = Response(generate_zip(), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename="transactions-{timestamp}.zip"'
+    else:
+        response = Response(generate_json(), mimetype='application/x-ndjson')
+    return response, 201
+
+def parse_history_time_param(value):
+    """Đọc tham số thời gian của /transaction_history: epoch giây hoặc ISO 8601."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        timestamp = parse_transaction_time(value)
+        if timestamp is None:
+            raise ValueError(f"Invalid time value: {value}")
+        return timestamp
+
+
+def encode_history_cursor(score, record_id):
+    return f"{score!r}:{record_id}"
+
+
+def decode_history_cursor(cursor):
+    score, record_id = cursor.split(':', 1)
+    return float(score), record_id
+
+
 @app.route('/transaction_history', methods=['GET'])
 def get_transaction_history():
-    """API endpoint để lấy lịch sử giao dịch."""
+    """API endpoint để lấy lịch sử giao dịch.
+
+    Hỗ trợ lọc theo type, status, phone_number, transaction_id, khoảng thời gian (since/until).
+    Có `limit`: trả về một trang JSON kèm `next_cursor`. Không có `limit`: stream toàn bộ kết quả dạng NDJSON.
+    """
     headers = request.headers
     auth_header = headers.get('Authorization')
 
     if not auth_header or auth_header != f'Bearer {API_KEY}':
         return jsonify({'message': 'Unauthorized'}), 401
 
+    args = request.args
     try:
-        transactions = [json.loads(transaction.decode()) for transaction in redis_client.lrange(TRANSACTION_HISTORY_KEY, 0, -1)]
-        if not transactions:
+        limit = args.get('limit', type=int)
+        if limit is not None and not 0 < limit <= HISTORY_PAGE_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {HISTORY_PAGE_MAX_LIMIT}")
+        since = parse_history_time_param(args.get('since'))
+        until = parse_history_time_param(args.get('until'))
+        cursor = decode_history_cursor(args['cursor']) if args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({'message': 'Invalid query parameters', 'error': str(e)}), 400
+
+    filters = {
+        'type': args.get('type'),
+        'phone_number': args.get('phone_number'),
+        'transaction_id': args.get('transaction_id'),
+    }
+
+    try:
+        results = transaction_store_reader.query(
+            filters,
+            status=args.get('status'),
+            min_score=since if since is not None else '-inf',
+            max_score=until if until is not None else '+inf',
+            after=cursor,
+            batch_size=HISTORY_SCAN_BATCH_SIZE,
+        )
+
+        if limit is not None:
+            transactions = []
+            next_cursor = None
+            for score, record_id, transaction in results:
+                if len(transactions) == limit:
+                    next_cursor = encode_history_cursor(*last)
+                    break
+                transactions.append(transaction)
+                last = (score, record_id)
+            return jsonify({'transactions': transactions, 'next_cursor': next_cursor}), 200
+
+        first = next(results, None)
+        if first is None:
             return jsonify({'message': 'No transactions found'}), 404
-        return jsonify(transactions), 200
+
+        def generate():
+            yield json.dumps(first[2]) + "\n"
+            for _, _, transaction in results:
+                yield json.dumps(transaction) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson'), 200
     except Exception as e:
         logger.error(f"Lỗi khi lấy lịch sử giao dịch: {e}")
         return jsonify({'message': 'Error retrieving transaction history', 'error': str(e)}), 500
 
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """API endpoint số liệu tổng hợp theo ngày (since/until: YYYY-MM-DD, tính cả hai đầu, mặc định hôm nay)."""
+    headers = request.headers
+    auth_header = headers.get('Authorization')
+
+    if not auth_header or auth_header != f'Bearer {API_KEY}':
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    try:
+        today = datetime.now().date()
+        since = datetime.strptime(request.args['since'], '%Y-%m-%d').date() if request.args.get('since') else today
+        until = datetime.strptime(request.args['until'], '%Y-%m-%d').date() if request.args.get('until') else today
+    except ValueError as e:
+        return jsonify({'message': 'Invalid query parameters', 'error': str(e)}), 400
+    if until < since:
+        return jsonify({'message': 'until must not be before since'}), 400
+    if (until - since).days + 1 > STATS_MAX_DAYS:
+        return jsonify({'message': f'Range must not exceed {STATS_MAX_DAYS} days'}), 400
+
+    return jsonify({'since': since.isoformat(), 'until': until.isoformat(),
+                    **transaction_stats.summary(since, until)}), 200
+
 @app.route('/qrpay', methods=['POST'])
 def generate_qr_code():
     """API endpoint để tạo mã QR."""
@@ -345,23 +895,79 @@ def generate_qr_code():
         data = request.get_json()
         bank_code = data.get('bank_code', BANK_CODE)
         account_number = data.get('account_number', ACCOUNT_NUMBER)
-        purpose = data.get('purpose', 'NT0977091190') # Nên thay bằng default value phù hợp
+        purpose = data.get('purpose', DEFAULT_QR_PURPOSE)
 
         if not bank_code or not account_number:
             return jsonify({'message': 'Missing bank_code or account_number'}), 400
 
-        qr_pay = QRPay(bank_code, account_number, point_of_initiation_method='STATIC', purpose_of_transaction=purpose)
-        qr_content = qr_pay.generate_qr_code_image(qr_pay.code)
-
-        return send_file(generate_qr_image_from_string(qr_content), mimetype='image/png')
+        try:
+            qr_format, qr_scale = parse_qr_options(data)
+        except ValueError as e:
+            return jsonify({'message': 'Invalid QR options', 'error': str(e)}), 400
+
+        # Ảnh QR tĩnh không đổi theo thời gian nên client có thể dùng lại bằng ETag
+        etag = static_qr_cache_key(bank_code, account_number, purpose, qr_format, qr_scale)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(render_static_qr(bank_code, account_number, purpose, qr_format, qr_scale),
+                                mimetype=QR_MIMETYPES[qr_format])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={QR_CACHE_MAX_AGE}'
+        return response
 
     except Exception as e:
         logger.error(f"Lỗi khi tạo mã QR: {e}")
         return jsonify({'message': 'Error generating QR code', 'error': str(e)}), 500
 
+def transaction_status_response(code, from_replica=False):
+    """Nội dung trả về cho client về trạng thái giao dịch, None nếu không tìm thấy."""
+    status, amount, timestamp, transaction_id, description = get_transaction_status(code, from_replica)
+    if status is None:
+        return None
+    return {
+        'status': status,
+        'amount': amount,
+        'timestamp': timestamp,
+        'transaction_id': transaction_id,
+        'description': description,
+        'message': get_status_message(status)
+    }
+
+
+def wait_for_transaction_status(code, last_status, timeout):
+    """Chờ tối đa timeout giây tới khi trạng thái giao dịch khác last_status (None: trạng thái lúc bắt đầu chờ).
+
+    Trả về trạng thái hiện tại (dict) hoặc None nếu không tìm thấy giao dịch.
+    """
+    waiter = transaction_status_hub.subscribe(code)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            # Đọc lại sau khi đã subscribe nên không lỡ thay đổi nào
+            transaction = transaction_status_response(code)
+            if transaction is None:
+                return None
+            if last_status is None:
+                last_status = transaction['status']
+            remaining = deadline - time.monotonic()
+            if transaction['status'] != last_status or remaining <= 0:
+                return transaction
+            try:
+                waiter.get(timeout=remaining)
+            except queue.Empty:
+                pass
+    finally:
+        transaction_status_hub.unsubscribe(code, waiter)
+
+
 @app.route('/check_transaction_status', methods=['GET'])
 def check_transaction_status():
-    """API endpoint để kiểm tra trạng thái giao dịch."""
+    """API endpoint để kiểm tra trạng thái giao dịch.
+
+    Có `wait` (giây): long-poll, trả về ngay khi trạng thái khác `last_status` (mặc định là trạng thái hiện tại)
+    hoặc khi hết thời gian chờ.
+    """
     headers = request.headers
     auth_header = headers.get('Authorization')
 
@@ -372,142 +978,255 @@ def check_transaction_status():
     if not code:
         return jsonify({'message': 'Missing transaction code'}), 400
 
-    status, amount, timestamp, transaction_id, description = get_transaction_status(code)
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = None
+    if wait is None or not 0 <= wait <= STATUS_LONG_POLL_MAX_WAIT:
+        return jsonify({'message': f'wait must be between 0 and {STATUS_LONG_POLL_MAX_WAIT}'}), 400
+
+    if wait:
+        transaction = wait_for_transaction_status(code, request.args.get('last_status'), wait)
+    else:
+        transaction = transaction_status_response(code, from_replica=True)
 
-    if status is None:
+    if transaction is None:
         return jsonify({'message': 'Transaction not found'}), 404
-    else:
-        return jsonify({
-            'status': status,
-            'amount': amount,
-            'timestamp': timestamp,
-            'transaction_id': transaction_id,
-            'description': description,
-            'message': get_status_message(status)
-        }), 200
-
-
-def check_expired_transactions():
-    """Kiểm tra các giao dịch pending đã hết hạn và cập nhật trạng thái."""
+    return jsonify(transaction), 200
+
+
+@app.route('/transaction_status/stream', methods=['GET'])
+def stream_transaction_status():
+    """API endpoint Server-Sent Events: gửi trạng thái hiện tại rồi gửi tiếp mỗi khi trạng thái giao dịch thay đổi."""
+    headers = request.headers
+    auth_header = headers.get('Authorization')
+
+    if not auth_header or auth_header != f'Bearer {API_KEY}':
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    code = request.args.get('code')
+    if not code:
+        return jsonify({'message': 'Missing transaction code'}), 400
+
+    waiter = transaction_status_hub.subscribe(code)
+    transaction = transaction_status_response(code)
+    if transaction is None:
+        transaction_status_hub.unsubscribe(code, waiter)
+        return jsonify({'message': 'Transaction not found'}), 404
+
+    def generate(transaction):
+        last_status = None
+        deadline = time.monotonic() + STATUS_STREAM_TIMEOUT
+        while True:
+            if transaction is not None and transaction['status'] != last_status:
+                yield f"event: status\ndata: {json.dumps(transaction)}\n\n"
+                last_status = transaction['status']
+                if last_status in FINAL_TRANSACTION_STATUSES:
+                    return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                waiter.get(timeout=min(remaining, STATUS_STREAM_HEARTBEAT))
+            except queue.Empty:
+                # Giữ kết nối qua proxy; đồng thời đọc lại trạng thái phòng khi lỡ sự kiện
+                yield ": keep-alive\n\n"
+            transaction = transaction_status_response(code)
+
+    response = Response(generate(transaction), mimetype='text/event-stream')
+    # Hủy đăng ký khi kết thúc response, kể cả khi client ngắt kết nối trước khi stream bắt đầu
+    response.call_on_close(lambda: transaction_status_hub.unsubscribe(code, waiter))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def parse_dead_letter_limit(args, default=100):
+    """Đọc tham số limit của các API dead-letter, trả về None nếu không hợp lệ (không phải số nguyên trong 1..max)."""
+    try:
+        limit = int(args.get('limit', default))
+    except ValueError:
+        return None
+    return limit if 0 < limit <= WEBHOOK_DEAD_LETTER_MAX_LIMIT else None
+
+
+@app.route('/webhooks/dead_letters', methods=['GET'])
+def get_webhook_dead_letters():
+    """API endpoint để xem các request xác nhận gửi thất bại (dead-letter)."""
+    headers = request.headers
+    auth_header = headers.get('Authorization')
+
+    if not auth_header or auth_header != f'Bearer {API_KEY}':
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    limit = parse_dead_letter_limit(request.args)
+    if limit is None:
+        return jsonify({'message': f'limit must be between 1 and {WEBHOOK_DEAD_LETTER_MAX_LIMIT}'}), 400
+    return jsonify({'stats': webhook_dispatcher.stats(), 'jobs': webhook_dispatcher.dead_letters(0, limit - 1)}), 200
+
+
+@app.route('/webhooks/dead_letters/replay', methods=['POST'])
+def replay_webhook_dead_letters():
+    """API endpoint để gửi lại các request xác nhận trong dead-letter."""
+    headers = request.headers
+    auth_header = headers.get('Authorization')
+
+    if not auth_header or auth_header != f'Bearer {API_KEY}':
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    limit = parse_dead_letter_limit(request.args)
+    if limit is None:
+        return jsonify({'message': f'limit must be between 1 and {WEBHOOK_DEAD_LETTER_MAX_LIMIT}'}), 400
+    replayed = webhook_dispatcher.replay_dead_letters(limit)
+    return jsonify({'replayed': replayed, 'stats': webhook_dispatcher.stats()}), 200
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """API endpoint kiểm tra tình trạng instance và quyền leader của các luồng nền."""
+    try:
+        redis_client.ping()
+        redis_ok = True
+    except redis.exceptions.RedisError:
+        redis_ok = False
+
+    try:
+        leader_status = leader_elector.status()
+    except redis.exceptions.RedisError as e:
+        leader_status = {'instance_id': leader_elector.instance_id, 'error': str(e)}
+
+    try:
+        mailboxes = {source.name: MailboxHealth(redis_client, source.name).status() for source in mailbox_sources}
+    except redis.exceptions.RedisError as e:
+        mailboxes = {'error': str(e)}
+
+    return jsonify({
+        'status': 'ok' if redis_ok else 'degraded',
+        'redis': redis_ok,
+        'background_workers': BACKGROUND_WORKERS_ENABLED,
+        'mailboxes': mailboxes,
+        'write_buffer': {'enabled': write_buffer.enabled, 'pending': write_buffer.pending()},
+        **leader_status
+    }), 200 if redis_ok else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """API endpoint cho Prometheus (gộp số liệu của mọi gunicorn worker khi đặt PROMETHEUS_MULTIPROC_DIR)."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
+def expire_due_transactions():
+    """Chuyển các giao dịch pending đã đến hạn sang expired theo từng lô nhỏ. Trả về số giao dịch đã hết hạn."""
+    total = 0
     while True:
-        try:
-            page_size = 100
-            cursor = '0'
-            logger.debug("Bắt đầu quét giao dịch pending...")
-            while cursor != 0:
-                cursor, keys = redis_client.scan(cursor=cursor, match=f"{PENDING_TRANSACTION_PREFIX}*", count=page_size)
-                for key in keys:
-                    logger.debug(f"Kiểm tra key: {key}")
-                    # Bắt đầu transaction
-                    pipe = redis_client.pipeline()
-                    pipe.watch(key)
-
-                    try:
-                        transaction_data = pipe.hgetall(key)
-                        logger.debug(f" Dữ liệu giao dịch từ Redis: {transaction_data}")
-
-                        if transaction_data:
-                            status = transaction_data.get(b'status', b'').decode()
-                            expiration_time = int(transaction_data.get(b'timestamp', b'0').decode()) + TRANSACTION_CODE_EXPIRATION
-                            code = key.decode().replace(PENDING_TRANSACTION_PREFIX, "")
-
-                            if status == 'pending':
-                                logger.info(f" Tìm thấy giao dịch pending: code={code}, expiration_time={datetime.fromtimestamp(expiration_time).strftime('%Y-%m-%d %H:%M:%S')}")
-
-                                if int(time.time()) > expiration_time:
-                                    logger.info(f"  Current time: {int(time.time())}, Expiration time: {expiration_time}, Timestamp: {transaction_data.get(b'timestamp', b'').decode()}")
-                                    # Cập nhật trạng thái thành expired và xóa key trong cùng một transaction
-                                    try:
-                                        pipe.multi()
-                                        pipe.hset(key, 'status', 'expired')
-                                        update_transaction_history(code, 'expired', pipe=pipe)
-                                        pipe.delete(key)
-                                        pipe.execute()
-                                        logger.info(f" Cập nhật trạng thái giao dịch thành expired và xóa key: {code}")
-                                    except redis.exceptions.WatchError:
-                                        logger.warning(f" Giao dịch {code} đã bị thay đổi bởi một client khác. Thử lại sau.")
-                                        continue
-
-                    except redis.exceptions.ResponseError as e:
-                        if "WRONGTYPE" in str(e):
-                            logger.error(f"Lỗi kiểu dữ liệu không hợp lệ cho key {key}: {e}")
-                            # Xóa key có kiểu dữ liệu không hợp lệ
-                            redis_client.delete(key)
-                            logger.info(f"Đã xóa key {key} do kiểu dữ liệu không hợp lệ.")
-                        else:
-                            logger.error(f"Lỗi Redis không xác định: {e}")
-                    except Exception as e:
-                         logger.error(f"Lỗi khi kiểm tra key {key}: {e}")
-
-            # Kiểm tra các giao dịch pending trong transaction_history mà không có pending_transaction key
-            logger.debug("Kiểm tra các giao dịch pending trong transaction_history...")
-            transactions = [json.loads(transaction.decode()) for transaction in redis_client.lrange(TRANSACTION_HISTORY_KEY, 0, -1)]
-            for i, transaction in enumerate(transactions):
-                code = transaction.get('code')
-                if code and transaction.get('status') == 'pending' and transaction.get('type') == 'transaction':
-                    pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
-                    if not redis_client.exists(pending_transaction_key):
-                        logger.info(f" Giao dịch {code} trong transaction_history không có pending_transaction key. Cập nhật trạng thái thành expired.")
-                        transaction['status'] = 'expired'
-                        redis_client.lset(TRANSACTION_HISTORY_KEY, i, json.dumps(transaction))
-                        logger.info(f"Đã cập nhật trạng thái giao dịch {code} trong transaction_history thành expired.")
+        next_deadline = pending_deadlines.next_deadline()
+        if next_deadline is None or next_deadline > time.time():
+            return total
+        codes = pending_deadlines.pop_due(limit=EXPIRY_BATCH_SIZE)
+        if codes:
+            # Key pending đã bị xóa nên số tiền được đọc từ lịch sử giao dịch
+            amounts = {record.get('code'): record.get('amount') for record in transaction_store.get_many(codes)}
+            pipe = redis_client.pipeline()
+            for code in codes:
+                update_transaction_history(code, 'expired', pipe=pipe)
+                transaction_status_hub.publish(code, 'expired', pipe=pipe)
+                transaction_stats.record(pipe, 'transaction', 'expired', amounts.get(code))
+            pipe.execute()
+            logger.info(f"Cập nhật trạng thái giao dịch thành expired và xóa key: {', '.join(codes)}")
+            metrics.TRANSACTIONS_EXPIRED.inc(len(codes))
+            total += len(codes)
+
+
+def reconcile_pending_history():
+    """Chuyển sang expired các giao dịch pending trong transaction_history mà không còn pending_transaction key."""
+    logger.debug("Kiểm tra các giao dịch pending trong transaction_history...")
+    transactions = transaction_store.get_many(transaction_store.ids_by_status('pending'))
+    for transaction in transactions:
+        code = transaction.get('code')
+        if code and transaction.get('status') == 'pending' and transaction.get('type') == 'transaction':
+            pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
+            if not redis_client.exists(pending_transaction_key):
+                logger.info(f" Giao dịch {code} trong transaction_history không có pending_transaction key. Cập nhật trạng thái thành expired.")
+                pipe = redis_client.pipeline()
+                transaction_store.update(code, {'status': 'expired'}, pipe=pipe)
+                transaction_status_hub.publish(code, 'expired', pipe=pipe)
+                transaction_stats.record(pipe, 'transaction', 'expired', transaction.get('amount'))
+                pipe.execute()
+                metrics.TRANSACTIONS_EXPIRED.inc()
+                logger.info(f"Đã cập nhật trạng thái giao dịch {code} trong transaction_history thành expired.")
+
+
+def check_expired_transactions(should_run=lambda: True):
+    """Xử lý các giao dịch pending ngay khi hết hạn, dựa trên chỉ mục hạn (zset) thay vì quét toàn bộ key."""
+    try:
+        # Lần chuyển đổi lúc import bị bỏ qua nếu khi đó Redis chưa sẵn sàng
+        transaction_store.migrate_legacy_list()
+        pending_deadlines.backfill(TRANSACTION_CODE_EXPIRATION)
+        pending_amounts.backfill(PENDING_TRANSACTION_PREFIX)
+    except Exception as e:
+        logger.error(f"Lỗi khi bổ sung chỉ mục hạn giao dịch: {e}")
 
+    last_reconcile = 0
+    while should_run():
+        delay = EXPIRY_MAX_SLEEP
+        try:
+            with metrics.EXPIRY_RUN_SECONDS.time():
+                expire_due_transactions()
+
+            # Lưới an toàn cho trường hợp tiến trình dừng giữa lúc lấy ra khỏi chỉ mục và cập nhật lịch sử
+            if time.monotonic() - last_reconcile >= EXPIRY_RECONCILE_INTERVAL:
+                with metrics.RECONCILE_SECONDS.time():
+                    reconcile_pending_history()
+                last_reconcile = time.monotonic()
+
+            # Ngủ đúng đến hạn gần nhất
+            next_deadline = pending_deadlines.next_deadline()
+            if next_deadline is not None:
+                delay = min(max(next_deadline - time.time(), 0), EXPIRY_MAX_SLEEP)
         except Exception as e:
             logger.error(f"Lỗi khi kiểm tra giao dịch hết hạn: {e}")
 
-        time.sleep(60)
+        time.sleep(delay)
 
 
-def update_transaction_history(code, new_status, amount_received=None, description=None, transaction_time=None, pipe=None):
-    """Cập nhật trạng thái của giao dịch trong transaction_history."""
+def update_transaction_history(code, new_status, amount_received=None, description=None, transaction_time=None, pipe=None,
+                               extra=None):
+    """Cập nhật trạng thái của giao dịch trong transaction_history (extra: các trường bổ sung, ví dụ kết quả đối soát)."""
     try:
-        transaction_found = False
-        transactions = [json.loads(transaction.decode()) for transaction in redis_client.lrange(TRANSACTION_HISTORY_KEY, 0, -1)]
-        updated_transactions = []
-
-        for i, transaction in enumerate(transactions):
-            if transaction.get('code') == code:
-                transaction_found = True
-                transaction['status'] = new_status
-                if amount_received is not None:
-                    transaction['amount'] = amount_received
-                if description is not None:
-                    transaction['description'] = description
-                if transaction_time is not None:
-                    transaction['transaction_time'] = transaction_time
-                updated_transactions.append(transaction)
-                logger.info(f"Đã cập nhật trạng thái giao dịch trong lịch sử: code={code}, status={new_status}")
-            else:
-                updated_transactions.append(transaction)
-
-        if transaction_found:
-            if pipe is None:
-                # Nếu không sử dụng pipeline, cập nhật trực tiếp
-                redis_client.delete(TRANSACTION_HISTORY_KEY)
-                if updated_transactions:
-                    redis_client.rpush(TRANSACTION_HISTORY_KEY, *[json.dumps(transaction) for transaction in updated_transactions])
-            else:
-                # Nếu sử dụng pipeline, thêm lệnh vào pipeline
-                pipe.delete(TRANSACTION_HISTORY_KEY)
-                if updated_transactions:
-                    pipe.rpush(TRANSACTION_HISTORY_KEY, *[json.dumps(transaction) for transaction in updated_transactions])
+        fields = {'status': new_status, **(extra or {})}
+        if amount_received is not None:
+            fields['amount'] = amount_received
+        if description is not None:
+            fields['description'] = description
+        if transaction_time is not None:
+            fields['transaction_time'] = transaction_time
+
+        # Khi dùng pipeline, lệnh cập nhật được đưa vào cùng transaction của caller
+        if transaction_store.update(code, fields, pipe=pipe):
+            logger.info(f"Đã cập nhật trạng thái giao dịch trong lịch sử: code={code}, status={new_status}")
         else:
             logger.warning(f"Không tìm thấy giao dịch trong lịch sử: {code}")
     except Exception as e:
         logger.error(f"Lỗi khi cập nhật lịch sử giao dịch: {e}")
 
 
-def get_transaction_status(code):
-    """Lấy trạng thái giao dịch dựa trên mã giao dịch (code)."""
+def get_transaction_status(code, from_replica=False):
+    """Lấy trạng thái giao dịch dựa trên mã giao dịch (code).
+
+    from_replica: đọc qua redis_read_client; giao dịch vừa tạo có thể chưa có trên replica nên khi không tìm thấy
+    sẽ đọc lại từ master.
+    """
     pending_transaction_key = f"{PENDING_TRANSACTION_PREFIX}{code}"
-    data = redis_client.hgetall(pending_transaction_key)
+    data = (redis_read_client if from_replica else redis_client).hgetall(pending_transaction_key)
 
     if not data:
         # Kiểm tra trong lịch sử giao dịch nếu không tìm thấy trong pending
-        transactions = [json.loads(transaction.decode()) for transaction in redis_client.lrange(TRANSACTION_HISTORY_KEY, 0, -1)]
-        for transaction in transactions:
-            if transaction.get('code') == code:
-                return transaction.get('status'), transaction.get('amount'), transaction.get('timestamp'), transaction.get('transaction_id'), transaction.get('description')
+        transaction = (transaction_store_reader if from_replica else transaction_store).get(code)
+        if transaction:
+            return transaction.get('status'), transaction.get('amount'), transaction.get('timestamp'), transaction.get('transaction_id'), transaction.get('description')
+        if from_replica and redis_settings.reads_from_replica:
+            return get_transaction_status(code)
         return None, None, None, None, None
     else:
         # Lấy thông tin từ pending_transaction nếu tìm thấy
@@ -525,28 +1244,105 @@ def get_status_message(status):
         return 'Transaction completed'
     elif status == 'expired':
         return 'Transaction expired'
+    elif status == 'underpaid':
+        return 'Transaction underpaid'
     elif status == 'received_after_expired':
         return 'Transaction received after expired'
     else:
         return 'Unknown transaction status'
 
 
-def email_processing_thread():
+def email_processing_thread(should_run=lambda: True):
     """Hàm chạy trong thread riêng để xử lý email."""
     logger.info('Bắt đầu luồng xử lý email')
-    while True:
-        fetch_last_unseen_email()
-        time.sleep(EMAIL_POLL_INTERVAL)
+    # Hộp thư dùng IDLE giữ kết nối mở và xử lý ngay khi server báo có email mới, các hộp thư khác được kiểm tra định kỳ
+    pool = MailboxWatcherPool(mailbox_sources, process_unseen_emails, redis_client,
+                              max_workers=EMAIL_WATCHER_MAX_WORKERS, idle_timeout=EMAIL_IDLE_TIMEOUT,
+                              max_backoff=EMAIL_RECONNECT_MAX_BACKOFF, should_run=should_run)
+    pool.run()
 
 
-logger.info(f'KHỞI TẠO THÀNH CÔNG')
+def email_retry_thread(should_run=lambda: True):
+    """Hàm chạy trong thread riêng để xử lý lại các email lỗi."""
+    while should_run():
+        try:
+            retry_failed_emails()
+        except Exception as e:
+            logger.error(f"Lỗi khi xử lý lại email: {e}")
+        time.sleep(EMAIL_RETRY_INTERVAL)
+
+
+def write_buffer_thread(should_run=lambda: True):
+    """Hàm chạy trong thread riêng để xử lý lại các email trong write_buffer khi Redis hoạt động trở lại."""
+    write_buffer.run(replay_buffered_email, should_run)
 
-# Bắt đầu luồng xử lý email
-email_thread = Thread(target=email_processing_thread)
-email_thread.daemon = True
-email_thread.start()
 
-# Bắt đầu luồng kiểm tra giao dịch hết hạn
-expired_transactions_thread = Thread(target=check_expired_transactions)
-expired_transactions_thread.daemon = True
-expired_transactions_thread.start()
+def history_compaction_thread(should_run=lambda: True):
+    """Hàm chạy trong thread riêng để chuyển lịch sử giao dịch cũ hơn HISTORY_RETENTION_DAYS ra đĩa."""
+    while should_run():
+        try:
+            cutoff = time.time() - HISTORY_RETENTION_DAYS * 24 * 3600
+            with metrics.HISTORY_COMPACTION_SECONDS.time():
+                archived = transaction_store.archive_older_than(cutoff, batch_size=HISTORY_COMPACTION_BATCH_SIZE)
+            if archived:
+                metrics.HISTORY_ARCHIVED.inc(archived)
+                logger.info(f"Đã lưu trữ {archived} bản ghi lịch sử giao dịch vào {HISTORY_ARCHIVE_DIR}")
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu trữ lịch sử giao dịch: {e}")
+        time.sleep(HISTORY_COMPACTION_INTERVAL)
+
+
+def start():
+    """Chuyển đổi lịch sử giao dịch dạng cũ, render trước ảnh QR mặc định và chạy các luồng nền.
+
+    Các luồng nền chỉ chạy trên instance đang giữ quyền leader, không chạy ở mọi gunicorn worker.
+    """
+    try:
+        transaction_store.migrate_legacy_list()
+    except redis.exceptions.RedisError as e:
+        # Chạy lại khi luồng kiểm tra giao dịch hết hạn khởi động
+        logger.warning(f"Chưa chuyển đổi được lịch sử giao dịch dạng cũ: {e}")
+
+    # Render trước ảnh QR tĩnh mặc định để request /qrpay đầu tiên không phải chờ
+    try:
+        render_static_qr(BANK_CODE, ACCOUNT_NUMBER, DEFAULT_QR_PURPOSE)
+    except Exception as e:
+        logger.warning(f"Lỗi khi render trước mã QR mặc định: {e}")
+
+    # Khi có bộ đệm ghi, luồng đọc email tiếp tục chạy (và đệm email) khi Redis không phản hồi; chạy trùng trên hai
+    # instance vẫn an toàn vì mỗi email chỉ được xử lý qua sổ ghi nhận
+    leader_elector.register('email_processing', email_processing_thread,
+                            hold_on_errors=REDIS_UNAVAILABLE_ERRORS if write_buffer.enabled else ())
+    leader_elector.register('expired_transactions', check_expired_transactions)
+    leader_elector.register('email_retry', email_retry_thread)
+    leader_elector.register('webhook_dispatcher', webhook_dispatcher.run)
+    if history_archive is not None:
+        leader_elector.register('history_compaction', history_compaction_thread)
+    if write_buffer.enabled:
+        # WRITE_BUFFER_DIR thường là thư mục cục bộ nên mỗi máy một lease, process giữ lease xử lý lại bộ đệm
+        # của mọi process trên máy (kể cả process đã dừng)
+        leader_elector.register(f'write_buffer:{socket.gethostname()}', write_buffer_thread,
+                                hold_on_errors=REDIS_UNAVAILABLE_ERRORS)
+    leader_elector.start()
+
+
+logger.info(f'KHỞI TẠO THÀNH CÔNG')
+
+webhook_dispatcher.on_result('topup', on_success=on_topup_confirmed, on_dead=on_topup_failed, on_ack=on_topup_acked)
+webhook_dispatcher.on_result('transaction', on_success=on_transaction_confirmed, on_dead=on_transaction_failed)
+
+# Các gauge đọc trực tiếp từ Redis khi Prometheus scrape
+metrics.state_collector.add('ewatcher_pending_transactions', 'Số giao dịch đang chờ thanh toán', pending_deadlines.count)
+metrics.state_collector.add('ewatcher_transaction_history_records', 'Số bản ghi trong lịch sử giao dịch',
+                            transaction_store.count)
+metrics.state_collector.add('ewatcher_webhook_jobs', 'Số request xác nhận trong outbox theo trạng thái',
+                            webhook_dispatcher.stats, label='state')
+metrics.state_collector.add('ewatcher_email_retry_backlog', 'Số email đang chờ xử lý lại',
+                            lambda: redis_client.zcard(email_ledger.retry_key))
+metrics.state_collector.add('ewatcher_write_buffer_pending', 'Số email đang đệm trên đĩa chờ xử lý lại',
+                            write_buffer.pending)
+
+# Với BACKGROUND_WORKERS_ENABLED=false (instance chỉ phục vụ API, replay.py, asgi.py) import main không ghi gì vào
+# Redis và không chạy luồng nền
+if BACKGROUND_WORKERS_ENABLED:
+    start()
@@ -0,0 +1,130 @@
+import logging
+import os
+
+import redis
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# Khi chạy nhiều gunicorn worker, mỗi process ghi số liệu vào thư mục này và /metrics gộp lại (xem gunicorn.conf.py)
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    # Thư mục phải tồn tại trước khi tạo metric, kể cả khi không chạy qua gunicorn (uvicorn, python main.py, replay)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+EMAIL_TO_CONFIRM_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+IMAP_COMMAND_SECONDS = Histogram('ewatcher_imap_command_seconds', 'Thời gian một lệnh IMAP (round trip)',
+                                 ['command'])
+EMAIL_POLL_SECONDS = Histogram('ewatcher_email_poll_seconds', 'Thời gian một lượt lấy và xử lý email mới')
+EMAIL_LAST_SUCCESS = Gauge('ewatcher_email_last_success_timestamp_seconds',
+                           'Thời điểm kiểm tra hộp thư thành công gần nhất (lượt poll hoặc chu kỳ IDLE)', ['source'],
+                           multiprocess_mode='max')
+MAILBOX_UP = Gauge('ewatcher_mailbox_up', 'Hộp thư đang hoạt động bình thường (1) hay đang lỗi và chờ thử lại (0)',
+                   ['source'], multiprocess_mode='livemax')
+EMAILS_TOTAL = Counter('ewatcher_emails_total', 'Số email đã xử lý theo kết quả', ['result'])
+EMAIL_PARSE_SECONDS = Histogram('ewatcher_email_parse_seconds', 'Thời gian trích xuất chi tiết giao dịch từ email',
+                                buckets=FAST_BUCKETS)
+EMAIL_PROCESS_SECONDS = Histogram('ewatcher_email_process_seconds', 'Thời gian xử lý một email (process_cake_email)',
+                                  buckets=FAST_BUCKETS)
+TRANSACTION_MATCHES = Counter('ewatcher_transaction_matches_total', 'Kết quả đối chiếu email với giao dịch pending',
+                              ['result'])
+PAYMENT_RECONCILIATIONS = Counter('ewatcher_payment_reconciliations_total',
+                                  'Kết quả đối soát khoản tiền đến không chứa đúng mã giao dịch', ['result'])
+PAYMENT_AMOUNT_CHECKS = Counter('ewatcher_payment_amount_checks_total',
+                                'So sánh số tiền nhận được với số tiền của giao dịch', ['result'])
+RECONCILE_LOOKUP_SECONDS = Histogram('ewatcher_reconcile_lookup_seconds',
+                                     'Thời gian tìm giao dịch khớp với khoản tiền đến qua chỉ mục số tiền',
+                                     buckets=FAST_BUCKETS)
+EMAIL_TO_CONFIRM_SECONDS = Histogram('ewatcher_email_to_confirm_seconds',
+                                     'Thời gian từ lúc ngân hàng gửi email (header Date) tới khi ứng dụng xác nhận',
+                                     ['kind'], buckets=EMAIL_TO_CONFIRM_BUCKETS)
+
+CONFIRMATIONS_QUEUED = Counter('ewatcher_confirmations_queued_total', 'Số request xác nhận đã đưa vào outbox', ['kind'])
+WEBHOOK_REQUEST_SECONDS = Histogram('ewatcher_webhook_request_seconds', 'Thời gian một request tới APP_URL', ['kind'])
+WEBHOOK_QUEUE_SECONDS = Histogram('ewatcher_webhook_queue_seconds',
+                                  'Thời gian từ lúc đưa vào outbox tới khi gửi thành công', ['kind'])
+WEBHOOK_DELIVERIES = Counter('ewatcher_webhook_deliveries_total', 'Kết quả gửi request xác nhận', ['kind', 'result'])
+
+QR_RENDER_SECONDS = Histogram('ewatcher_qr_render_seconds', 'Thời gian render ảnh QR', ['format'],
+                              buckets=FAST_BUCKETS)
+QR_CACHE_REQUESTS = Counter('ewatcher_qr_cache_requests_total', 'Số lần tra cache ảnh QR theo kết quả', ['result'])
+
+EXPIRY_RUN_SECONDS = Histogram('ewatcher_expiry_run_seconds', 'Thời gian một lượt xử lý giao dịch hết hạn',
+                               buckets=FAST_BUCKETS)
+RECONCILE_SECONDS = Histogram('ewatcher_expiry_reconcile_seconds', 'Thời gian đối soát giao dịch pending trong lịch sử')
+TRANSACTIONS_EXPIRED = Counter('ewatcher_transactions_expired_total', 'Số giao dịch chuyển sang expired')
+HISTORY_COMPACTION_SECONDS = Histogram('ewatcher_history_compaction_seconds',
+                                       'Thời gian một lượt lưu trữ lịch sử giao dịch cũ ra đĩa')
+HISTORY_ARCHIVED = Counter('ewatcher_history_archived_total', 'Số bản ghi lịch sử đã chuyển từ Redis ra đĩa')
+
+STATUS_EVENTS_PUBLISHED = Counter('ewatcher_status_events_published_total', 'Số sự kiện trạng thái giao dịch đã phát',
+                                  ['status'])
+STATUS_SUBSCRIBERS = Gauge('ewatcher_status_subscribers', 'Số request SSE/long-poll đang chờ trạng thái giao dịch',
+                           multiprocess_mode='livesum')
+
+REDIS_COMMAND_SECONDS = Histogram('ewatcher_redis_command_seconds', 'Thời gian một lệnh (hoặc pipeline) Redis',
+                                  ['command'], buckets=FAST_BUCKETS)
+WRITE_BUFFER_ENTRIES = Counter('ewatcher_write_buffer_entries_total',
+                               'Số email được đệm ra đĩa khi Redis không phản hồi (buffered) và kết quả xử lý lại '
+                               '(processed, duplicate, failed)', ['result'])
+
+
+class InstrumentedRedis(redis.Redis):
+    """redis.Redis đo thời gian từng lệnh và từng pipeline (nhãn PIPELINE/MULTI)."""
+
+    def execute_command(self, *args, **options):
+        with REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).time():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with REDIS_COMMAND_SECONDS.labels('MULTI' if self.transaction else 'PIPELINE').time():
+            return super().execute(raise_on_error)
+
+
+class StateCollector:
+    """Gauge được tính khi scrape (ví dụ đọc số lượng từ Redis), nên đúng với mọi process và instance."""
+
+    def __init__(self):
+        self.gauges = []
+
+    def add(self, name, documentation, callback, label=None):
+        """callback() trả về một số, hoặc dict {giá trị nhãn: số} nếu có label."""
+        self.gauges.append((name, documentation, callback, label))
+
+    def collect(self):
+        for name, documentation, callback, label in self.gauges:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Lỗi khi lấy số liệu {name}: {e}")
+                continue
+            if label is None:
+                yield GaugeMetricFamily(name, documentation, value=value)
+            else:
+                family = GaugeMetricFamily(name, documentation, labels=[label])
+                for label_value, sample in value.items():
+                    family.add_metric([label_value], sample)
+                yield family
+
+
+state_collector = StateCollector()
+
+
+def render():
+    """Nội dung cho /metrics: số liệu của mọi worker (chế độ multiprocess) hoặc của process hiện tại."""
+    registry = CollectorRegistry()
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(state_collector)
+    return generate_latest(registry)
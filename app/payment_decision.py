@@ -0,0 +1,109 @@
+"""Quyết định xử lý một email biến động số dư, dùng chung cho luồng xử lý email (main.process_cake_email) và
+chế độ --dry-run của replay.py.
+
+plan_actions chỉ đọc dữ liệu qua các hàm được truyền vào và trả về danh sách hành động; việc ghi Redis, gửi xác nhận
+và số liệu do caller thực hiện.
+"""
+import time
+
+from payment_matcher import parse_amount
+from transaction_store import parse_transaction_time
+
+
+def credit_time(transaction_details, received_at=None):
+    """Thời điểm tiền về dùng để tìm giao dịch pending: lúc nhận email, thời gian trong email hoặc hiện tại."""
+    return received_at or parse_transaction_time(transaction_details.get('time')) or time.time()
+
+
+def amount_status(expected_amount, amount_received):
+    """So sánh số tiền nhận được với số tiền của giao dịch: exact, underpaid hoặc overpaid."""
+    expected, received = parse_amount(expected_amount), parse_amount(amount_received)
+    if expected is None or received is None or received == expected:
+        return 'exact'
+    return 'underpaid' if received < expected else 'overpaid'
+
+
+def settled_status(status, amount_check):
+    """Trạng thái mới của giao dịch khi nhận tiền, None nếu giao dịch đã được xử lý trước đó."""
+    if status == 'pending':
+        return 'underpaid' if amount_check == 'underpaid' else 'completed'
+    if status == 'expired':
+        return 'received_after_expired'
+    return None
+
+
+def is_receive_transaction(transaction):
+    return bool(transaction) and transaction.get('type') == 'receive'
+
+
+def settle_action(code, transaction, amount_received, match, distance=0):
+    status = transaction.get('status', 'pending')
+    amount_check = amount_status(transaction.get('amount'), amount_received)
+    return {
+        'action': 'settle',
+        'code': code,
+        'transaction': transaction,
+        'amount': amount_received,
+        'expected_amount': transaction.get('amount', '0'),
+        'amount_status': amount_check,
+        'status': status,
+        'new_status': settled_status(status, amount_check),
+        'match': match,
+        'distance': distance,
+    }
+
+
+def plan_actions(transaction_details, credit_at, read_pending, match_payment):
+    """Các hành động cần làm với một email đã trích xuất, theo thứ tự.
+
+    read_pending(code): hash pending_transaction đã giải mã ({} nếu không có).
+    match_payment(description, amount, credit_at): kết quả PaymentMatcher.match.
+
+    Hành động (trường 'action'):
+    - topup: nạp tiền theo số điện thoại (phone_number, amount, transaction_type increase/decrease)
+    - skip: mã trong email không dùng được (reason not_found hoặc amount_mismatch)
+    - settle: ghi nhận tiền cho giao dịch code (xem settle_action): new_status None nghĩa là đã xử lý trước đó
+    - needs_review: khoản tiền không khớp giao dịch nào (reason, candidates)
+    """
+    actions = []
+    if not transaction_details:
+        return actions
+    description = transaction_details.get('description', '')
+    amount_decreased = transaction_details.get('amount_decreased')
+    amount_increased = transaction_details.get('amount_increased')
+    phone_number = transaction_details.get('phone_number')
+
+    if amount_decreased and phone_number:
+        actions.append({'action': 'topup', 'phone_number': phone_number, 'amount': amount_decreased,
+                        'transaction_type': 'decrease'})
+    if amount_increased and phone_number:
+        actions.append({'action': 'topup', 'phone_number': phone_number, 'amount': amount_increased,
+                        'transaction_type': 'increase'})
+
+    # Xác thực giao dịch chuyển tiền với mã tạm thời
+    code = transaction_details.get('code')
+    transaction = None
+    if code:
+        transaction = read_pending(code)
+        if not is_receive_transaction(transaction):
+            actions.append({'action': 'skip', 'reason': 'not_found', 'code': code})
+            transaction = None
+        elif not amount_increased:
+            actions.append({'action': 'skip', 'reason': 'amount_mismatch', 'code': code})
+            return actions
+
+    if transaction:
+        actions.append(settle_action(code, transaction, amount_increased, 'exact_code'))
+    elif amount_increased and not phone_number:
+        # Không có mã hợp lệ trong nội dung: đối soát theo số tiền và mã gần đúng
+        result = match_payment(description, amount_increased, credit_at)
+        if result['code']:
+            transaction = read_pending(result['code'])
+            if is_receive_transaction(transaction):
+                actions.append(settle_action(result['code'], transaction, amount_increased, 'fuzzy_code',
+                                             result['distance']))
+                return actions
+            result = {**result, 'reason': 'no_candidate', 'candidates': []}
+        actions.append({'action': 'needs_review', 'amount': amount_increased, 'reason': result['reason'],
+                        'candidates': result['candidates']})
+    return actions
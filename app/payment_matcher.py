@@ -0,0 +1,242 @@
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+PENDING_AMOUNT_PREFIX = os.environ.get('PENDING_AMOUNT_PREFIX', 'pending_transaction_amount:')
+PENDING_AMOUNTS_KEY = os.environ.get('PENDING_AMOUNTS_KEY', 'pending_transaction_amounts')
+
+# Chuỗi có thể là mã giao dịch: tối đa 4 chữ cái (VCD, VDC, CD...) rồi 6-14 chữ số, cho phép một ký tự phân cách
+# giữa các chữ số (khách hàng hay gõ "VCD 12345 67890" hoặc "VCD1234.567.890")
+CODE_TOKEN_PATTERN = re.compile(r"([A-Z]{0,4})[\s.\-_]*(\d(?:[\s.\-_]?\d){5,13})")
+DIGIT_SEPARATOR_PATTERN = re.compile(r"[\s.\-_]")
+PHONE_PREFIX = 'NT'
+
+# Lấy giao dịch pending theo từng số tiền trong khoảng thời gian tạo, bỏ phần đã quá hạn của mỗi key và xóa
+# số tiền không còn giao dịch nào khỏi danh sách số tiền.
+# KEYS[1] = zset số tiền, KEYS[2..] = key theo số tiền
+# ARGV[1] = mốc quá hạn, ARGV[2] = từ thời điểm, ARGV[3] = đến thời điểm, ARGV[4..] = số tiền tương ứng KEYS[2..]
+CANDIDATES_SCRIPT = """
+local result = {}
+for i = 2, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', '(' .. ARGV[1])
+    if redis.call('ZCARD', KEYS[i]) == 0 then
+        redis.call('ZREM', KEYS[1], ARGV[i + 2])
+    else
+        local members = redis.call('ZRANGEBYSCORE', KEYS[i], ARGV[2], ARGV[3], 'WITHSCORES')
+        for j = 1, #members, 2 do
+            table.insert(result, members[j])
+            table.insert(result, ARGV[i + 2])
+            table.insert(result, members[j + 1])
+        end
+    end
+end
+return result
+"""
+
+
+def parse_amount(value):
+    """Số tiền (VND) dạng số nguyên từ giá trị lưu trong Redis/JSON, None nếu không đọc được."""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    try:
+        return int(float(str(value).replace(',', '')))
+    except ValueError:
+        return None
+
+
+def edit_distance(a, b, limit):
+    """Khoảng cách Damerau-Levenshtein (OSA: thêm, bớt, sửa, đổi chỗ hai ký tự liền nhau) giữa a và b.
+
+    Dừng sớm và trả về limit + 1 khi khoảng cách chắc chắn vượt quá limit.
+    """
+    if a == b:
+        return 0
+    if limit == 0 or abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def code_tokens(description):
+    """Các dãy số có thể là mã giao dịch trong nội dung chuyển khoản (bỏ qua số điện thoại nạp tiền NT...)."""
+    tokens = set()
+    for letters, digits in CODE_TOKEN_PATTERN.findall((description or '').upper()):
+        if letters.endswith(PHONE_PREFIX):
+            continue
+        tokens.add(DIGIT_SEPARATOR_PATTERN.sub('', digits))
+        # Dãy số gộp qua dấu phân cách có thể dính với số khác (số tiền, số tài khoản), xét cả từng phần
+        tokens.update(part for part in DIGIT_SEPARATOR_PATTERN.split(digits) if len(part) >= 6)
+    return tokens
+
+
+class PendingAmountIndex:
+    """Chỉ mục giao dịch pending theo số tiền và thời điểm tạo, dùng để đối soát chuyển khoản thiếu hoặc sai mã.
+
+    Bố cục khóa:
+        {prefix}{amount}    zset code -> thời điểm tạo (epoch giây), mỗi số tiền một key
+        {amounts_key}       zset số tiền -> số tiền, để tìm các số tiền gần với số tiền nhận được
+
+    Giao dịch chỉ pending tối đa max_age giây nên key theo số tiền tự hết hạn sau max_age kể từ lần thêm cuối,
+    phần quá hạn bị cắt mỗi lần đọc: giao dịch hết hạn không cần xóa khỏi chỉ mục. Mỗi lần tra cứu chỉ đọc các
+    key của số tiền cần xét nên không phụ thuộc vào tổng số giao dịch đang mở.
+    """
+
+    def __init__(self, redis_client, max_age, prefix=PENDING_AMOUNT_PREFIX, amounts_key=PENDING_AMOUNTS_KEY):
+        self.redis = redis_client
+        self.max_age = max_age
+        self.prefix = prefix
+        self.amounts_key = amounts_key
+        self._candidates_script = redis_client.register_script(CANDIDATES_SCRIPT)
+
+    def amount_key(self, amount):
+        return f"{self.prefix}{amount}"
+
+    def add(self, code, amount, created_at, pipe=None):
+        amount = parse_amount(amount)
+        if amount is None:
+            return
+        client = pipe if pipe is not None else self.redis
+        client.zadd(self.amount_key(amount), {code: created_at})
+        client.expire(self.amount_key(amount), self.max_age)
+        client.zadd(self.amounts_key, {amount: amount})
+
+    def remove(self, code, amount, pipe=None):
+        amount = parse_amount(amount)
+        if amount is not None:
+            (pipe if pipe is not None else self.redis).zrem(self.amount_key(amount), code)
+
+    def nearby_amounts(self, amount, tolerance, limit):
+        """Tối đa limit số tiền gần nhất ở mỗi phía của amount, trong khoảng ±tolerance (tỉ lệ)."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(self.amounts_key, f"({amount}", amount * (1 + tolerance), start=0, num=limit)
+        pipe.zrevrangebyscore(self.amounts_key, f"({amount}", amount * (1 - tolerance), start=0, num=limit)
+        above, below = pipe.execute()
+        return [int(value) for value in below + above]
+
+    def candidates(self, amounts, since, until, now=None):
+        """Các giao dịch pending có số tiền thuộc amounts, tạo trong [since, until]: danh sách (code, amount, created_at)."""
+        if not amounts:
+            return []
+        now = time.time() if now is None else now
+        values = self._candidates_script(
+            keys=[self.amounts_key] + [self.amount_key(amount) for amount in amounts],
+            args=[now - self.max_age, since, until] + list(amounts),
+        )
+        return [(values[i].decode(), int(values[i + 1]), float(values[i + 2])) for i in range(0, len(values), 3)]
+
+    def backfill(self, pending_prefix, batch_size=100):
+        """Thêm vào chỉ mục các giao dịch pending tạo trước khi có chỉ mục (chạy khi khởi động)."""
+        added = 0
+        for key in self.redis.scan_iter(match=f"{pending_prefix}*", count=batch_size):
+            data = self.redis.hmget(key, 'status', 'amount', 'timestamp')
+            amount = parse_amount(data[1])
+            if data[0] != b'pending' or amount is None:
+                continue
+            code = key.decode()[len(pending_prefix):]
+            if self.redis.zscore(self.amount_key(amount), code) is None:
+                self.add(code, amount, int(data[2] or 0))
+                added += 1
+        if added:
+            logger.info(f"Đã bổ sung {added} giao dịch pending vào chỉ mục số tiền")
+        return added
+
+
+class PaymentMatcher:
+    """Tìm giao dịch pending cho một khoản tiền đến khi nội dung chuyển khoản không chứa đúng mã giao dịch.
+
+    Thứ tự xét:
+    1. Giao dịch cùng số tiền, tạo trong cửa sổ thời gian: chọn giao dịch có mã gần nhất với một dãy số trong nội
+       dung (sai tối đa max_distance ký tự, thiếu hoặc sai tiền tố VCD) nếu chỉ có đúng một giao dịch như vậy.
+    2. Giao dịch có số tiền lệch tối đa amount_tolerance (chuyển thiếu/thừa): chỉ nhận khi phần số của mã khớp
+       tuyệt đối (mismatch_max_distance, mặc định 0) vì mã liên tiếp nhau chỉ khác một chữ số.
+    3. Còn lại: trả về các giao dịch gợi ý để người vận hành đối soát (không tự xác nhận).
+
+    match() trả về dict: code (None nếu không tự xác nhận được), method, distance, reason, candidates.
+    """
+
+    def __init__(self, index, code_prefix='VCD', max_distance=1, mismatch_max_distance=0, window=600,
+                 time_slack=120, amount_tolerance=0.1, nearby_limit=20, suggestion_limit=5):
+        self.index = index
+        self.code_prefix = code_prefix
+        self.max_distance = max_distance
+        self.mismatch_max_distance = mismatch_max_distance
+        self.window = window
+        self.time_slack = time_slack
+        self.amount_tolerance = amount_tolerance
+        self.nearby_limit = nearby_limit
+        self.suggestion_limit = suggestion_limit
+
+    def _distance(self, code, tokens, limit):
+        digits = code[len(self.code_prefix):] if code.startswith(self.code_prefix) else code
+        return min((edit_distance(token, digits, limit) for token in tokens), default=limit + 1)
+
+    def _ranked(self, candidates, tokens, amount, limit):
+        return sorted(
+            ((self._distance(code, tokens, limit), abs(candidate_amount - amount), -created_at, code, candidate_amount)
+             for code, candidate_amount, created_at in candidates),
+            key=lambda entry: entry[:4],
+        )
+
+    def _unique_best(self, ranked, max_distance):
+        if not ranked or ranked[0][0] > max_distance:
+            return None
+        if len(ranked) > 1 and ranked[1][0] == ranked[0][0]:
+            return None
+        return ranked[0]
+
+    def match(self, description, amount, credit_time=None):
+        amount = parse_amount(amount)
+        credit_time = time.time() if credit_time is None else credit_time
+        if amount is None:
+            return {'code': None, 'method': None, 'reason': 'invalid_amount', 'candidates': []}
+        since, until = credit_time - self.window - self.time_slack, credit_time + self.time_slack
+        tokens = code_tokens(description)
+
+        # Khoảng cách được tính tới suggest_distance ở cả hai bước nên gợi ý hiển thị đúng khoảng cách đã tính;
+        # mã xa hơn mức đó có distance None
+        suggest_distance = max(self.max_distance, self.mismatch_max_distance)
+        same_amount = self._ranked(self.index.candidates([amount], since, until), tokens, amount, suggest_distance)
+        best = self._unique_best(same_amount, self.max_distance) if tokens else None
+        if best is not None:
+            return {'code': best[3], 'method': 'fuzzy_code', 'distance': best[0], 'candidates': []}
+
+        nearby = []
+        if tokens and self.amount_tolerance > 0:
+            nearby_amounts = self.index.nearby_amounts(amount, self.amount_tolerance, self.nearby_limit)
+            nearby = self._ranked(self.index.candidates(nearby_amounts, since, until), tokens, amount,
+                                  suggest_distance)
+            best = self._unique_best(nearby, self.mismatch_max_distance)
+            if best is not None:
+                return {'code': best[3], 'method': 'fuzzy_code', 'distance': best[0], 'candidates': []}
+
+        if not tokens:
+            reason = 'amount_only' if same_amount else 'no_candidate'
+        elif same_amount and same_amount[0][0] <= self.max_distance:
+            reason = 'ambiguous'
+        else:
+            reason = 'no_candidate'
+        suggestions = sorted(same_amount + nearby, key=lambda entry: entry[:4])[:self.suggestion_limit]
+        return {
+            'code': None,
+            'method': None,
+            'reason': reason,
+            'candidates': [{'code': code, 'amount': candidate_amount,
+                            'distance': distance if distance <= suggest_distance else None}
+                           for distance, _, _, code, candidate_amount in suggestions],
+        }
@@ -0,0 +1,83 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PENDING_DEADLINES_KEY = os.environ.get('PENDING_DEADLINES_KEY', 'pending_transaction_deadlines')
+
+# Lấy ra nguyên tử các giao dịch đã đến hạn (đã đọc trước bằng ZRANGEBYSCORE) và xóa key pending của những giao dịch
+# vẫn còn pending. Giao dịch đã bị lấy ra hoặc được gia hạn/xóa khỏi chỉ mục trong lúc đó bị bỏ qua.
+# KEYS[1] = deadline zset, KEYS[2..] = key pending của từng giao dịch
+# ARGV[1] = now, ARGV[2..] = code tương ứng với KEYS[2..]
+POP_DUE_SCRIPT = """
+local expired = {}
+for i = 2, #KEYS do
+    local code = ARGV[i]
+    local deadline = redis.call('ZSCORE', KEYS[1], code)
+    if deadline and tonumber(deadline) <= tonumber(ARGV[1]) then
+        redis.call('ZREM', KEYS[1], code)
+        local status = redis.call('HGET', KEYS[i], 'status')
+        -- Key pending có thể đã tự hết hạn (TTL) trước khi được xử lý
+        if status == false or status == 'pending' then
+            redis.call('DEL', KEYS[i])
+            table.insert(expired, code)
+        end
+    end
+end
+return expired
+"""
+
+
+class PendingDeadlineIndex:
+    """Chỉ mục hạn của các giao dịch pending: zset code -> thời điểm hết hạn (epoch giây).
+
+    Chi phí xử lý tỉ lệ với số giao dịch thực sự hết hạn, không phụ thuộc vào kích thước Redis DB.
+    """
+
+    def __init__(self, redis_client, pending_prefix, key=PENDING_DEADLINES_KEY):
+        self.redis = redis_client
+        self.pending_prefix = pending_prefix
+        self.key = key
+        self._pop_due_script = redis_client.register_script(POP_DUE_SCRIPT)
+
+    def add(self, code, deadline, pipe=None):
+        (pipe if pipe is not None else self.redis).zadd(self.key, {code: deadline})
+
+    def remove(self, code, pipe=None):
+        (pipe if pipe is not None else self.redis).zrem(self.key, code)
+
+    def pop_due(self, now=None, limit=100):
+        """Lấy ra tối đa limit giao dịch đã đến hạn, trả về danh sách code cần chuyển sang expired."""
+        now = time.time() if now is None else now
+        # Script chỉ được chạm vào khóa khai báo trong KEYS nên code đến hạn được đọc trước
+        due = [code.decode() for code in self.redis.zrangebyscore(self.key, '-inf', now, start=0, num=limit)]
+        if not due:
+            return []
+        codes = self._pop_due_script(keys=[self.key] + [f"{self.pending_prefix}{code}" for code in due],
+                                     args=[now] + due)
+        return [code.decode() for code in codes]
+
+    def next_deadline(self):
+        """Thời điểm hết hạn sớm nhất, None nếu không còn giao dịch pending."""
+        first = self.redis.zrange(self.key, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    def count(self):
+        return self.redis.zcard(self.key)
+
+    def backfill(self, expiration, batch_size=100):
+        """Thêm vào chỉ mục các key pending tạo trước khi có chỉ mục (chạy một lần khi khởi động)."""
+        added = 0
+        for key in self.redis.scan_iter(match=f"{self.pending_prefix}*", count=batch_size):
+            try:
+                data = self.redis.hmget(key, 'status', 'timestamp')
+            except Exception as e:
+                logger.error(f"Lỗi khi đọc key {key}: {e}")
+                continue
+            if data[0] == b'pending':
+                code = key.decode()[len(self.pending_prefix):]
+                added += self.redis.zadd(self.key, {code: int(data[1] or 0) + expiration}, nx=True)
+        if added:
+            logger.info(f"Đã bổ sung {added} giao dịch pending vào chỉ mục hạn {self.key}")
+        return added
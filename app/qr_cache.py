@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from metrics import QR_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+QR_CACHE_PREFIX = os.environ.get('QR_CACHE_PREFIX', 'qr_cache:')
+
+
+def cache_key(*parts):
+    """Khóa cache ổn định cho các tham số tạo ảnh QR."""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class QRImageCache:
+    """Cache ảnh QR đã render: LRU trong process (giới hạn dung lượng, có TTL) và cache dùng chung qua Redis.
+
+    Ảnh QR chỉ phụ thuộc vào tham số tạo nên khóa cache cũng được dùng làm ETag.
+    """
+
+    def __init__(self, redis_client, max_bytes=32 * 1024 * 1024, ttl=24 * 3600, prefix=QR_CACHE_PREFIX):
+        self.redis = redis_client
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def _put_local(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (data, time.monotonic() + self.ttl)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        data, _ = self.entries.pop(key)
+        self.size -= len(data)
+
+    def peek(self, key):
+        """Chỉ tra cache trong process (không gọi Redis), trả về None nếu chưa có."""
+        data = self._get_local(key)
+        if data is not None:
+            QR_CACHE_REQUESTS.labels('local').inc()
+        return data
+
+    def get_or_render(self, key, render):
+        """Trả về ảnh (bytes) theo khóa, chỉ gọi render() khi cả hai tầng cache đều không có."""
+        data = self._get_local(key)
+        if data is not None:
+            QR_CACHE_REQUESTS.labels('local').inc()
+            return data
+
+        try:
+            data = self.redis.get(f"{self.prefix}{key}")
+        except Exception as e:
+            logger.warning(f"Lỗi khi đọc cache QR từ Redis: {e}")
+            data = None
+
+        if data is None:
+            QR_CACHE_REQUESTS.labels('miss').inc()
+            data = render()
+            try:
+                self.redis.set(f"{self.prefix}{key}", data, ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Lỗi khi ghi cache QR vào Redis: {e}")
+        else:
+            QR_CACHE_REQUESTS.labels('redis').inc()
+
+        self._put_local(key, data)
+        return data
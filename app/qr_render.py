@@ -0,0 +1,98 @@
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import segno
+from qr_pay import QRPay
+
+logger = logging.getLogger(__name__)
+
+QR_RENDER_PROCESSES = int(os.environ.get('QR_RENDER_PROCESSES', 0)) or os.cpu_count() or 1
+QR_RENDER_START_METHOD = os.environ.get('QR_RENDER_START_METHOD', 'forkserver')
+
+# Màu ảnh QR dùng chung cho mọi ảnh do ứng dụng render
+QR_COLORS = {'dark': 'darkred', 'data_dark': 'darkorange', 'data_light': 'yellow'}
+
+
+def render_payment_qr(bank_code, account_number, amount, purpose, kind='png', scale=10):
+    """Render ảnh QR thanh toán (bytes): QR động cho một giao dịch, hoặc QR tĩnh (không kèm số tiền) khi amount
+    là None."""
+    if amount is None:
+        qr_pay = QRPay(bank_code, account_number, point_of_initiation_method='STATIC', purpose_of_transaction=purpose)
+    else:
+        qr_pay = QRPay(bank_code, account_number, transaction_amount=amount, point_of_initiation_method='DYNAMIC',
+                       purpose_of_transaction=purpose)
+    # Ảnh được render trong bộ nhớ: QRPay.generate_qr_code_image còn lưu ảnh ra qr_code.png trong thư mục làm việc
+    # ở mỗi lần gọi
+    qr_content = segno.make_qr(qr_pay.code)
+    buffer = io.BytesIO()
+    qr_content.save(buffer, kind=kind, scale=scale, **QR_COLORS)
+    return buffer.getvalue()
+
+
+def _render_item(args):
+    # Chạy trong process con: trả lỗi về cùng kết quả để một ảnh lỗi không làm hỏng cả lô
+    try:
+        return render_payment_qr(*args), None
+    except Exception as e:
+        return None, str(e)
+
+
+class QRRenderPool:
+    """Render nhiều ảnh QR song song trên một process pool (segno render thuần Python nên bị giới hạn bởi GIL).
+
+    Pool được tạo khi cần lần đầu. Mặc định dùng start method forkserver để process con không kế thừa
+    các thread và kết nối của gunicorn worker. Lô nhỏ hơn min_parallel được render ngay trong process hiện tại.
+    """
+
+    def __init__(self, processes=QR_RENDER_PROCESSES, start_method=QR_RENDER_START_METHOD, chunksize=16,
+                 min_parallel=8):
+        self.processes = processes
+        self.start_method = start_method
+        self.chunksize = chunksize
+        self.min_parallel = min_parallel
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == 'forkserver':
+                    context.set_forkserver_preload([__name__])
+                self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+            return self.executor
+
+    def _reset(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def render_many(self, items):
+        """items: danh sách tham số của render_payment_qr. Trả về iterator (ảnh, lỗi) theo đúng thứ tự items."""
+        if self.processes <= 1 or len(items) < self.min_parallel:
+            yield from map(_render_item, items)
+            return
+
+        executor = self._get_executor()
+        done = 0
+        try:
+            for result in executor.map(_render_item, items, chunksize=self.chunksize):
+                yield result
+                done += 1
+        except BrokenProcessPool as e:
+            # Process con bị dừng đột ngột (ví dụ OOM): tạo lại pool ở lần sau, phần còn lại render tại chỗ
+            logger.error(f"Process pool render QR bị lỗi: {e}. Render {len(items) - done} ảnh còn lại trong process hiện tại")
+            self._reset(executor)
+            yield from map(_render_item, items[done:])
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,137 @@
+import logging
+
+import redis
+import redis.asyncio
+import redis.asyncio.retry
+import redis.asyncio.sentinel
+import redis.sentinel
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class BlockingSentinelConnectionPool(redis.sentinel.SentinelConnectionPool, redis.BlockingConnectionPool):
+    """Pool qua Sentinel nhưng chờ tối đa `timeout` giây khi hết kết nối thay vì báo lỗi ngay như pool mặc định."""
+
+
+class AsyncBlockingSentinelConnectionPool(redis.asyncio.sentinel.SentinelConnectionPool,
+                                          redis.asyncio.BlockingConnectionPool):
+    """Như BlockingSentinelConnectionPool cho redis.asyncio."""
+
+
+def parse_sentinels(value):
+    """'host1:26379,host2:26379' -> [('host1', 26379), ('host2', 26379)]."""
+    sentinels = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if entry:
+            host, _, port = entry.rpartition(':')
+            sentinels.append((host, int(port)) if host else (entry, 26379))
+    return sentinels
+
+
+class RedisSettings:
+    """Cấu hình kết nối Redis dùng chung cho client đồng bộ (Flask, luồng nền) và redis.asyncio (ASGI).
+
+    - Không kết nối khi khởi tạo: kết nối đầu tiên được mở khi có lệnh đầu tiên, nên ứng dụng khởi động được
+      cả khi Redis chưa sẵn sàng (/health báo degraded tới khi Redis phản hồi).
+    - Pool giới hạn max_connections, chờ tối đa pool_timeout giây khi hết kết nối rảnh.
+    - client (đọc/ghi) không tự thử lại: redis-py thử lại cả pipeline khi mất kết nối, nên một MULTI/EXEC đã chạy
+      trên server có thể bị chạy lần hai (gửi webhook, HINCRBY, INCR hai lần). Lỗi được báo ngay cho caller.
+    - read_client chỉ dùng cho lệnh đọc nên lỗi kết nối được thử lại retry_attempts lần với backoff tăng dần
+      (tối đa 1 giây) trước khi báo lỗi. read_client luôn có pool riêng, kể cả khi đọc từ chính master.
+    - sentinels: dùng Redis Sentinel (sentinel_master) để tự chuyển sang master mới khi failover.
+    - read_from_replicas / replica_host: read_client đọc từ replica (có thể trễ vài mili giây so với master).
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, sentinels=(), sentinel_master='mymaster',
+                 sentinel_password=None, read_from_replicas=False, replica_host=None, replica_port=None,
+                 max_connections=50, pool_timeout=5, socket_timeout=5, connect_timeout=2, health_check_interval=30,
+                 retry_attempts=3):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password or None
+        self.sentinels = list(sentinels)
+        self.sentinel_master = sentinel_master
+        self.sentinel_password = sentinel_password or None
+        self.read_from_replicas = read_from_replicas
+        self.replica_host = replica_host or None
+        self.replica_port = replica_port or port
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.health_check_interval = health_check_interval
+        self.retry_attempts = retry_attempts
+
+    def describe(self):
+        if self.sentinels:
+            return f"sentinel {self.sentinel_master}@{','.join(f'{h}:{p}' for h, p in self.sentinels)} (DB: {self.db})"
+        return f"{self.host}:{self.port} (DB: {self.db})"
+
+    @property
+    def reads_from_replica(self):
+        """read_client đọc từ replica (dữ liệu có thể trễ so với master) hay từ chính master."""
+        return bool(self.replica_host) or bool(self.sentinels and self.read_from_replicas)
+
+    def connection_kwargs(self, retry_class=None):
+        """Tham số kết nối; retry_class: bật thử lại lỗi kết nối (chỉ dùng cho client đọc)."""
+        kwargs = {
+            'db': self.db,
+            'password': self.password,
+            'socket_timeout': self.socket_timeout,
+            'socket_connect_timeout': self.connect_timeout,
+            'socket_keepalive': True,
+            'health_check_interval': self.health_check_interval,
+        }
+        if retry_class is not None and self.retry_attempts:
+            # Chỉ thử lại lỗi kết nối, không thử lại timeout
+            kwargs['retry'] = retry_class(ExponentialBackoff(cap=1, base=0.05), self.retry_attempts)
+            kwargs['retry_on_error'] = [redis.exceptions.ConnectionError]
+        return kwargs
+
+    def _sentinel_kwargs(self):
+        return {'password': self.sentinel_password, 'socket_timeout': self.socket_timeout,
+                'socket_connect_timeout': self.connect_timeout}
+
+    def create_clients(self, redis_class=redis.Redis):
+        """(client, read_client): client đọc/ghi trên master không thử lại, read_client chỉ đọc và có thử lại."""
+        kwargs = self.connection_kwargs()
+        read_kwargs = self.connection_kwargs(Retry)
+        if self.sentinels:
+            sentinel = redis.sentinel.Sentinel(self.sentinels, sentinel_kwargs=self._sentinel_kwargs())
+            pool_kwargs = {'redis_class': redis_class, 'connection_pool_class': BlockingSentinelConnectionPool,
+                           'max_connections': self.max_connections, 'timeout': self.pool_timeout}
+            client = sentinel.master_for(self.sentinel_master, **pool_kwargs, **kwargs)
+            read_for = sentinel.slave_for if self.read_from_replicas else sentinel.master_for
+            return client, read_for(self.sentinel_master, **pool_kwargs, **read_kwargs)
+
+        client = redis_class(connection_pool=redis.BlockingConnectionPool(
+            host=self.host, port=self.port, max_connections=self.max_connections, timeout=self.pool_timeout, **kwargs))
+        read_client = redis_class(connection_pool=redis.BlockingConnectionPool(
+            host=self.replica_host or self.host, port=self.replica_port if self.replica_host else self.port,
+            max_connections=self.max_connections, timeout=self.pool_timeout, **read_kwargs))
+        return client, read_client
+
+    def create_async_clients(self, max_connections=None, pool_timeout=None):
+        """Như create_clients nhưng cho redis.asyncio (mỗi worker ASGI một pool)."""
+        kwargs = self.connection_kwargs()
+        read_kwargs = self.connection_kwargs(redis.asyncio.retry.Retry)
+        max_connections = max_connections or self.max_connections
+        pool_timeout = pool_timeout if pool_timeout is not None else self.pool_timeout
+        if self.sentinels:
+            sentinel = redis.asyncio.sentinel.Sentinel(self.sentinels, sentinel_kwargs=self._sentinel_kwargs())
+            pool_kwargs = {'connection_pool_class': AsyncBlockingSentinelConnectionPool,
+                           'max_connections': max_connections, 'timeout': pool_timeout}
+            client = sentinel.master_for(self.sentinel_master, **pool_kwargs, **kwargs)
+            read_for = sentinel.slave_for if self.read_from_replicas else sentinel.master_for
+            return client, read_for(self.sentinel_master, **pool_kwargs, **read_kwargs)
+
+        client = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+            host=self.host, port=self.port, max_connections=max_connections, timeout=pool_timeout, **kwargs))
+        read_client = redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+            host=self.replica_host or self.host, port=self.replica_port if self.replica_host else self.port,
+            max_connections=max_connections, timeout=pool_timeout, **read_kwargs))
+        return client, read_client
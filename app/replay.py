@@ -0,0 +1,239 @@
+"""Xử lý lại email biến động số dư theo khoảng thời gian, không phụ thuộc cờ \\Seen.
+
+Nguồn email: hộp thư IMAP (mở chỉ đọc bằng EXAMINE, không đổi cờ email) hoặc file xuất mbox/Maildir. Email được
+trích xuất song song trên process pool rồi xử lý tuần tự bằng đúng luồng của watcher (handle_email). Sổ ghi nhận
+email (email_ledger) bảo đảm email đã xử lý không bao giờ được xác nhận lại, nên có thể chạy lại nhiều lần.
+
+    python app/replay.py --since 2026-10-01 --until 2026-10-03 --dry-run
+    python app/replay.py --since 2026-10-01 --source cake-chinh
+    python app/replay.py --mbox export.mbox --workers 8
+    python app/replay.py --maildir ~/Maildir/cake --mark-processed
+
+--dry-run: chỉ in (NDJSON) những gì sẽ được xác nhận, không xác nhận giao dịch và không ghi vào sổ ghi nhận.
+--mark-processed: ghi email vào sổ ghi nhận là đã xử lý mà không xác nhận giao dịch, dùng khi dựng lại Redis
+để watcher không xác nhận lại các email cũ.
+"""
+import argparse
+import email
+import email.utils
+import json
+import logging
+import mailbox
+import multiprocessing
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import email_parser
+import payment_decision
+from email_ledger import message_key
+from email_watcher import build_sender_criteria, build_text_message, format_uid_set, parse_fetch_response
+
+logger = logging.getLogger('replay')
+
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Xử lý lại email biến động số dư từ IMAP hoặc file mbox/Maildir')
+    parser.add_argument('--since', help='Từ ngày (YYYY-MM-DD, tính cả ngày này)')
+    parser.add_argument('--until', help='Đến ngày (YYYY-MM-DD, không tính ngày này)')
+    parser.add_argument('--source', action='append',
+                        help='Tên hộp thư trong EMAIL_SOURCES (lặp lại để chọn nhiều hộp thư, mặc định: tất cả). '
+                             'Với --mbox/--maildir: hộp thư dùng cấu hình parser, người gửi, tài khoản (mặc định: đầu tiên)')
+    files = parser.add_mutually_exclusive_group()
+    files.add_argument('--mbox', help='Đọc email từ file mbox thay vì IMAP')
+    files.add_argument('--maildir', help='Đọc email từ thư mục Maildir thay vì IMAP')
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--dry-run', action='store_true', help='Chỉ báo cáo những gì sẽ được xác nhận')
+    modes.add_argument('--mark-processed', action='store_true',
+                       help='Chỉ ghi email vào sổ ghi nhận là đã xử lý, không xác nhận giao dịch')
+    parser.add_argument('--include-expired-ledger', action='store_true',
+                        help='Xử lý cả email cũ hơn EMAIL_LEDGER_TTL (sổ ghi nhận không còn chứng minh được email '
+                             'đã xử lý hay chưa, có thể xác nhận lại)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Số process trích xuất email')
+    parser.add_argument('--batch-size', type=int, default=2000, help='Số email mỗi lô trích xuất/xử lý')
+    parser.add_argument('--verbose', action='store_true', help='Giữ log INFO của ứng dụng')
+    return parser.parse_args(argv)
+
+
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+def imap_date(day):
+    """Ngày theo định dạng của SEARCH SINCE/BEFORE (không phụ thuộc locale)."""
+    return f"{day.day:02d}-{IMAP_MONTHS[day.month - 1]}-{day.year}"
+
+
+def imap_messages(source, since, until, batch_size):
+    """Email của source trong khoảng ngày, theo lô UID FETCH (BODY.PEEK, hộp thư mở chỉ đọc nên không đổi cờ)."""
+    mail = source.connect()
+    try:
+        mail.login(source.login, source.password)
+        mail.select(source.folder, readonly=True)
+        criteria = []
+        if since:
+            criteria.append(f'SINCE {imap_date(since)}')
+        if until:
+            criteria.append(f'BEFORE {imap_date(until)}')
+        sender_criteria = build_sender_criteria(source.senders)
+        if sender_criteria:
+            criteria.append(sender_criteria)
+        _, data = mail.uid('SEARCH', None, f"({' '.join(criteria) or 'ALL'})")
+        uids = sorted(map(int, data[0].split()))
+        logger.info(f"Hộp thư {source.name}: {len(uids)} email trong khoảng thời gian")
+        for start in range(0, len(uids), batch_size):
+            uid_set = format_uid_set(uids[start:start + batch_size])
+            _, data = mail.uid('FETCH', uid_set, '(UID BODY.PEEK[HEADER] BODY.PEEK[1.MIME] BODY.PEEK[1])')
+            for _, sections in parse_fetch_response(data):
+                yield sections
+    finally:
+        try:
+            mail.logout()
+        except Exception:
+            pass
+
+
+def file_messages(path, kind):
+    """Email (bytes) từ file mbox hoặc thư mục Maildir."""
+    box = mailbox.mbox(path, create=False) if kind == 'mbox' else mailbox.Maildir(path, factory=None, create=False)
+    try:
+        for key in box.iterkeys():
+            yield box.get_bytes(key)
+    finally:
+        box.close()
+
+
+def parse_item(item, parser, senders, since, until):
+    """Chạy trong process con: trích xuất một email. Trả về None nếu email không thuộc phạm vi xử lý lại."""
+    msg = build_text_message(item) if isinstance(item, dict) else email.message_from_bytes(item)
+    sender = (msg.get('From') or '').lower()
+    if senders and not any(expected.lower() in sender for expected in senders):
+        return None
+    try:
+        received_at = email.utils.parsedate_to_datetime(msg.get('Date')).timestamp()
+    except (TypeError, ValueError):
+        received_at = None
+    if received_at is not None and ((since is not None and received_at < since)
+                                    or (until is not None and received_at >= until)):
+        return None
+    body = email_parser.extract_body(msg)
+    if body is None:
+        return None
+    return message_key(msg.get('Message-ID'), body), body, received_at, email_parser.parse(body, parser)
+
+
+def _parse_batch(args):
+    items, parser, senders, since, until = args
+    return [parse_item(item, parser, senders, since, until) for item in items]
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def describe(app, details, credit_time):
+    """Những gì process_cake_email sẽ làm với email này (cùng quyết định payment_decision.plan_actions), chỉ đọc Redis."""
+    actions = []
+    for action in payment_decision.plan_actions(details, credit_time, app.read_pending_transaction,
+                                                app.payment_matcher.match):
+        if action['action'] == 'settle':
+            transaction = action.pop('transaction')
+            action.update(action='confirm_transaction' if action['new_status'] else 'already_processed',
+                          transaction_id=transaction.get('transaction_id', ''))
+        elif action['action'] == 'needs_review':
+            action['candidates'] = [candidate['code'] for candidate in action['candidates']]
+        actions.append(action)
+    return actions
+
+
+def replay_source(app, source, items, args, executor, summary):
+    since, until = parse_day(args.since), parse_day(args.until)
+    since_ts, until_ts = (since.timestamp() if since else None), (until.timestamp() if until else None)
+    ledger_cutoff = time.time() - app.EMAIL_LEDGER_TTL
+
+    # Mỗi lô chia thành các phần nhỏ cho process pool; lô sau chỉ được đọc khi lô trước đã xử lý xong
+    chunk_size = max(1, min(256, args.batch_size // max(args.workers, 1)))
+    for batch in batched(items, args.batch_size):
+        jobs = [(chunk, source.parser, source.senders, since_ts, until_ts) for chunk in batched(batch, chunk_size)]
+        parsed = [entry for chunk in executor.map(_parse_batch, jobs) for entry in chunk if entry is not None]
+        summary['read'] += len(batch)
+        summary['skipped'] += len(batch) - len(parsed)
+        if not parsed:
+            continue
+
+        statuses = app.email_ledger.statuses([key for key, _, _, _ in parsed])
+        for (key, body, received_at, details), status in zip(parsed, statuses):
+            if status == 'processed':
+                summary['already_processed'] += 1
+                continue
+            if received_at is not None and received_at < ledger_cutoff and not args.include_expired_ledger:
+                summary['outside_ledger_ttl'] += 1
+                continue
+
+            if args.dry_run:
+                actions = describe(app, details, payment_decision.credit_time(details or {}, received_at))
+                summary['would_confirm'] += sum(action['action'] in ('topup', 'confirm_transaction')
+                                                for action in actions)
+                summary['would_review'] += sum(action['action'] == 'needs_review' for action in actions)
+                if actions:
+                    print(json.dumps({'key': key, 'source': source.name, 'received_at': received_at,
+                                      'description': details.get('description'), 'actions': actions},
+                                     ensure_ascii=False))
+            elif args.mark_processed:
+                if app.email_ledger.claim(key, '', source.name):
+                    app.email_ledger.mark_processed(key)
+                    summary['marked_processed'] += 1
+                else:
+                    summary['duplicate'] += 1
+            else:
+                summary[app.handle_email(key, body, received_at, source, details)] += 1
+        logger.info(f"Hộp thư {source.name}: đã đọc {summary['read']} email, {dict(summary)}")
+
+
+def run(args):
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    # main kết nối Redis và khởi tạo các kho khi import nên chỉ import ở process chính. Các luồng nền (đọc email,
+    # hết hạn giao dịch, gửi webhook, ghi lại bộ đệm) đã chạy ở ứng dụng, CLI không được tranh quyền leader với chúng
+    os.environ['BACKGROUND_WORKERS_ENABLED'] = 'false'
+    import main as app
+    logger.setLevel(logging.INFO)
+
+    if args.source:
+        unknown = [name for name in args.source if name not in app.mailbox_sources_by_name]
+        if unknown:
+            raise SystemExit(f"Không có hộp thư: {', '.join(unknown)}")
+        sources = [app.mailbox_sources_by_name[name] for name in args.source]
+    else:
+        sources = app.mailbox_sources
+    if args.mbox or args.maildir:
+        sources = sources[:1]
+
+    summary = Counter()
+    started = time.monotonic()
+    # forkserver: process con không kế thừa kết nối Redis và các thread của process chính
+    context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        for source in sources:
+            if args.mbox or args.maildir:
+                items = file_messages(args.mbox or args.maildir, 'mbox' if args.mbox else 'maildir')
+            else:
+                items = imap_messages(source, parse_day(args.since), parse_day(args.until), args.batch_size)
+            replay_source(app, source, items, args, executor, summary)
+
+    elapsed = time.monotonic() - started
+    result = {'summary': dict(summary), 'seconds': round(elapsed, 2),
+              'messages_per_second': round(summary['read'] / elapsed, 1) if elapsed else None}
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import STATUS_EVENTS_PUBLISHED, STATUS_SUBSCRIBERS
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_STATUS_CHANNEL = os.environ.get('TRANSACTION_STATUS_CHANNEL', 'transaction_status')
+
+# Giá trị đưa vào hàng đợi của subscriber khi có thể đã lỡ sự kiện (vừa kết nối lại Redis), cần đọc lại trạng thái
+RESYNC = None
+
+
+class TransactionStatusHub:
+    """Phát và nhận thay đổi trạng thái giao dịch qua Redis pub/sub.
+
+    Mỗi process chỉ giữ một kết nối SUBSCRIBE tới kênh chung và chuyển sự kiện tới các request đang chờ theo code,
+    nên số kết nối Redis không tăng theo số client SSE/long-poll.
+    """
+
+    def __init__(self, redis_client, channel=TRANSACTION_STATUS_CHANNEL, initial_backoff=1, max_backoff=30,
+                 ping_interval=30):
+        self.redis = redis_client
+        self.channel = channel
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.subscribed = threading.Event()
+        self.thread = None
+
+    def publish(self, code, status, pipe=None):
+        """Phát sự kiện trạng thái mới của giao dịch, có thể nằm trong pipeline của caller."""
+        message = json.dumps({'code': code, 'status': status, 'timestamp': time.time()})
+        (pipe if pipe is not None else self.redis).publish(self.channel, message)
+        STATUS_EVENTS_PUBLISHED.labels(status).inc()
+
+    def subscribe(self, code, timeout=2):
+        """Đăng ký nhận sự kiện của một giao dịch. Trả về queue.Queue nhận dict sự kiện (hoặc RESYNC).
+
+        Caller phải đọc trạng thái hiện tại sau khi subscribe (để không lỡ thay đổi xảy ra trước đó)
+        và gọi unsubscribe() khi xong.
+        """
+        waiter = queue.Queue()
+        with self.lock:
+            self.waiters.setdefault(code, set()).add(waiter)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._listen, daemon=True)
+                self.thread.start()
+        STATUS_SUBSCRIBERS.inc()
+        # Chờ kết nối SUBSCRIBE sẵn sàng; nếu quá thời gian, waiter sẽ nhận RESYNC khi kết nối xong
+        self.subscribed.wait(timeout)
+        return waiter
+
+    def unsubscribe(self, code, waiter):
+        with self.lock:
+            waiters = self.waiters.get(code)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.waiters[code]
+        STATUS_SUBSCRIBERS.dec()
+
+    def _dispatch(self, code, event):
+        with self.lock:
+            waiters = list(self.waiters.get(code, ()))
+        for waiter in waiters:
+            waiter.put(event)
+
+    def _resync_all(self):
+        with self.lock:
+            waiters = [waiter for group in self.waiters.values() for waiter in group]
+        for waiter in waiters:
+            waiter.put(RESYNC)
+
+    def _listen(self):
+        backoff = self.initial_backoff
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                # Chỉ báo sẵn sàng khi server đã xác nhận SUBSCRIBE
+                message = pubsub.get_message(timeout=10)
+                if message is None or message['type'] != 'subscribe':
+                    raise ConnectionError(f"Không nhận được xác nhận SUBSCRIBE: {message!r}")
+                self.subscribed.set()
+                backoff = self.initial_backoff
+                # Sự kiện phát ra trong lúc chưa (hoặc mất) kết nối đã bị lỡ
+                self._resync_all()
+                last_ping = time.monotonic()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message['type'] == 'message':
+                        try:
+                            event = json.loads(message['data'])
+                        except ValueError:
+                            logger.warning(f"Sự kiện trạng thái giao dịch không hợp lệ: {message['data']!r}")
+                            continue
+                        self._dispatch(event.get('code'), event)
+                    # PING định kỳ để phát hiện kết nối đã chết
+                    if time.monotonic() - last_ping >= self.ping_interval:
+                        pubsub.ping()
+                        last_ping = time.monotonic()
+            except Exception as e:
+                self.subscribed.clear()
+                logger.error(f"Lỗi pub/sub trạng thái giao dịch: {e}. Kết nối lại sau {backoff} giây")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+
+class AsyncTransactionStatusHub:
+    """Phiên bản asyncio của TransactionStatusHub dùng cho asgi.py (redis.asyncio).
+
+    Phải được tạo bên trong event loop (ví dụ trong lifespan của ứng dụng ASGI).
+    """
+
+    def __init__(self, redis_client, channel=TRANSACTION_STATUS_CHANNEL, initial_backoff=1, max_backoff=30,
+                 ping_interval=30):
+        self.redis = redis_client
+        self.channel = channel
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval
+        self.waiters = {}
+        self.subscribed = asyncio.Event()
+        self.task = None
+
+    async def subscribe(self, code, timeout=2):
+        """Như TransactionStatusHub.subscribe, trả về asyncio.Queue."""
+        waiter = asyncio.Queue()
+        self.waiters.setdefault(code, set()).add(waiter)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._listen())
+        STATUS_SUBSCRIBERS.inc()
+        try:
+            await asyncio.wait_for(self.subscribed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return waiter
+
+    def unsubscribe(self, code, waiter):
+        waiters = self.waiters.get(code)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self.waiters[code]
+        STATUS_SUBSCRIBERS.dec()
+
+    def _notify(self, waiters, event):
+        for waiter in list(waiters):
+            waiter.put_nowait(event)
+
+    async def _listen(self):
+        backoff = self.initial_backoff
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                message = await pubsub.get_message(timeout=10)
+                if message is None or message['type'] != 'subscribe':
+                    raise ConnectionError(f"Không nhận được xác nhận SUBSCRIBE: {message!r}")
+                self.subscribed.set()
+                backoff = self.initial_backoff
+                for waiters in list(self.waiters.values()):
+                    self._notify(waiters, RESYNC)
+                last_ping = time.monotonic()
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is not None and message['type'] == 'message':
+                        try:
+                            event = json.loads(message['data'])
+                        except ValueError:
+                            logger.warning(f"Sự kiện trạng thái giao dịch không hợp lệ: {message['data']!r}")
+                            continue
+                        self._notify(self.waiters.get(event.get('code'), ()), event)
+                    if time.monotonic() - last_ping >= self.ping_interval:
+                        await pubsub.ping()
+                        last_ping = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.subscribed.clear()
+                logger.error(f"Lỗi pub/sub trạng thái giao dịch: {e}. Kết nối lại sau {backoff} giây")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
@@ -0,0 +1,96 @@
+import logging
+import os
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_CODE_SEQ_KEY = os.environ.get('TRANSACTION_CODE_SEQ_KEY', 'transaction_code_seq')
+TRANSACTION_CODE_RESERVATION_PREFIX = "transaction_code:"
+
+
+class TransactionCodeGenerator:
+    """Sinh mã giao dịch dạng VCD + 10 chữ số, không trùng lặp giữa các process và instance.
+
+    Số thứ tự lấy từ bộ đếm Redis theo từng khối (INCRBY block_size) nên mỗi process chỉ cần một round trip
+    cho mỗi block_size mã. Bộ đếm được khởi tạo bằng epoch hiện tại để không trùng với mã cũ dạng VCD{timestamp}.
+    Mỗi mã còn được giữ chỗ bằng SET NX, phòng trường hợp bộ đếm bị mất hoặc khởi tạo lại; khi gặp mã đã được giữ
+    chỗ, bộ đếm được đẩy lên với bước tăng gấp đôi sau mỗi lần để nhanh chóng vượt qua vùng mã đã cấp.
+    """
+
+    def __init__(self, redis_client, prefix="VCD", digits=10, block_size=100, reservation_ttl=90 * 24 * 3600,
+                 seq_key=TRANSACTION_CODE_SEQ_KEY, max_attempts=10):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.digits = digits
+        self.block_size = block_size
+        self.reservation_ttl = reservation_ttl
+        self.seq_key = seq_key
+        self.max_attempts = max_attempts
+        self.lock = Lock()
+        self.next_number = 0
+        self.block_end = -1
+
+    def _allocate_block(self):
+        self.redis.set(self.seq_key, int(time.time()), nx=True)
+        self.block_end = self.redis.incrby(self.seq_key, self.block_size)
+        self.next_number = self.block_end - self.block_size + 1
+
+    def _take_number(self):
+        with self.lock:
+            if self.next_number > self.block_end:
+                self._allocate_block()
+            number = self.next_number
+            self.next_number += 1
+        if number >= 10 ** self.digits:
+            raise OverflowError(f"Bộ đếm mã giao dịch vượt quá {self.digits} chữ số")
+        return number
+
+    def _take_numbers(self, count):
+        """Lấy count số thứ tự: dùng phần còn lại của khối hiện tại, phần thiếu được cấp bằng một INCRBY."""
+        with self.lock:
+            taken = min(max(self.block_end - self.next_number + 1, 0), count)
+            numbers = list(range(self.next_number, self.next_number + taken))
+            self.next_number += taken
+        remaining = count - taken
+        if remaining:
+            self.redis.set(self.seq_key, int(time.time()), nx=True)
+            end = self.redis.incrby(self.seq_key, remaining)
+            numbers.extend(range(end - remaining + 1, end + 1))
+        if numbers and numbers[-1] >= 10 ** self.digits:
+            raise OverflowError(f"Bộ đếm mã giao dịch vượt quá {self.digits} chữ số")
+        return numbers
+
+    def _skip_ahead(self, attempt):
+        """Bỏ phần còn lại của khối hiện tại và đẩy bộ đếm lên block_size * 2**attempt (bộ đếm đang đứng sau mã đã cấp)."""
+        with self.lock:
+            self.next_number = self.block_end + 1
+        self.redis.incrby(self.seq_key, self.block_size * 2 ** attempt)
+
+    def generate(self):
+        """Trả về một mã giao dịch mới đã được giữ chỗ trong Redis."""
+        for attempt in range(self.max_attempts):
+            code = f"{self.prefix}{self._take_number():0{self.digits}d}"
+            if self.redis.set(f"{TRANSACTION_CODE_RESERVATION_PREFIX}{code}", 1, nx=True, ex=self.reservation_ttl):
+                return code
+            logger.warning(f"Mã giao dịch {code} đã tồn tại, sinh mã khác")
+            self._skip_ahead(attempt)
+        raise RuntimeError("Không sinh được mã giao dịch không trùng lặp")
+
+    def generate_many(self, count):
+        """Trả về count mã giao dịch mới; việc giữ chỗ được gửi trong một pipeline thay vì mỗi mã một round trip."""
+        codes = []
+        for attempt in range(self.max_attempts):
+            candidates = [f"{self.prefix}{number:0{self.digits}d}" for number in self._take_numbers(count - len(codes))]
+            pipe = self.redis.pipeline(transaction=False)
+            for code in candidates:
+                pipe.set(f"{TRANSACTION_CODE_RESERVATION_PREFIX}{code}", 1, nx=True, ex=self.reservation_ttl)
+            for code, reserved in zip(candidates, pipe.execute()):
+                if reserved:
+                    codes.append(code)
+                else:
+                    logger.warning(f"Mã giao dịch {code} đã tồn tại, sinh mã khác")
+            if len(codes) == count:
+                return codes
+            self._skip_ahead(attempt)
+        raise RuntimeError("Không sinh được mã giao dịch không trùng lặp")
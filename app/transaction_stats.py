@@ -0,0 +1,113 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from payment_matcher import parse_amount
+
+STATS_KEY_PREFIX = os.environ.get('STATS_KEY_PREFIX', 'stats:day:')
+
+# Trạng thái nghĩa là khách hàng đã trả tiền, dùng để tính thời gian từ lúc tạo mã tới lúc thanh toán
+PAID_STATUSES = ('completed', 'underpaid', 'received_after_expired')
+
+
+def day_of(timestamp):
+    """Ngày (giờ địa phương, giống transaction_time) của một thời điểm epoch giây."""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+class TransactionStats:
+    """Số liệu tổng hợp theo ngày, cập nhật dần ở chính các chỗ thay đổi trạng thái giao dịch.
+
+    Mỗi ngày một hash {prefix}{YYYY-MM-DD} với các trường:
+        count:{type}:{status}, amount:{type}:{status}   số lần vào trạng thái và tổng số tiền, theo loại giao dịch
+        amount_in, amount_out                           tổng tiền vào/ra tài khoản
+        paid_count, paid_seconds                        số giao dịch đã thanh toán và tổng thời gian từ lúc tạo mã
+
+    Sự kiện được tính vào ngày xảy ra (tạo, nhận tiền, hết hạn). record() chỉ đưa lệnh HINCRBY vào pipeline của
+    caller nên số liệu được ghi trong cùng MULTI/EXEC với thay đổi trạng thái. summary() đọc mỗi ngày một hash
+    nên thời gian truy vấn chỉ phụ thuộc vào số ngày, không phụ thuộc vào độ dài lịch sử giao dịch.
+    """
+
+    def __init__(self, redis_client, prefix=STATS_KEY_PREFIX):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def day_key(self, day):
+        return f"{self.prefix}{day}"
+
+    def record(self, pipe, kind, status, amount=None, at=None, created_at=None, direction=None):
+        """Ghi nhận một giao dịch loại kind vào trạng thái status lúc at (epoch giây).
+
+        direction: 'in'/'out' để cộng amount vào tổng tiền vào/ra. created_at: thời điểm tạo mã, khi status là
+        trạng thái đã thanh toán thì được dùng để tính thời gian tới lúc thanh toán.
+        """
+        at = time.time() if at is None else at
+        key = self.day_key(day_of(at))
+        amount = parse_amount(amount)
+        pipe.hincrby(key, f"count:{kind}:{status}", 1)
+        if amount is not None:
+            pipe.hincrby(key, f"amount:{kind}:{status}", amount)
+            if direction is not None:
+                pipe.hincrby(key, f"amount_{direction}", amount)
+        if status in PAID_STATUSES and created_at:
+            pipe.hincrby(key, 'paid_count', 1)
+            pipe.hincrbyfloat(key, 'paid_seconds', max(at - float(created_at), 0))
+
+    def retract(self, pipe, kind, status, amount=None, at=None):
+        """Hoàn tác một lần record() không kèm direction/created_at (ví dụ nạp tiền đã tính failed khi bị chuyển vào
+        dead-letter nhưng sau đó gửi lại thành công). at: thời điểm của lần record() cần hoàn tác."""
+        at = time.time() if at is None else at
+        key = self.day_key(day_of(at))
+        amount = parse_amount(amount)
+        pipe.hincrby(key, f"count:{kind}:{status}", -1)
+        if amount is not None:
+            pipe.hincrby(key, f"amount:{kind}:{status}", -amount)
+
+    def days(self, since, until):
+        """Các ngày (YYYY-MM-DD) từ since tới until (date), tính cả hai đầu."""
+        return [(since + timedelta(days=offset)).isoformat() for offset in range((until - since).days + 1)]
+
+    def summary(self, since, until):
+        """Số liệu từng ngày và tổng của khoảng [since, until] (date), đọc trong một round trip."""
+        days = self.days(since, until)
+        pipe = self.redis.pipeline(transaction=False)
+        for day in days:
+            pipe.hgetall(self.day_key(day))
+        daily = [(day, {field.decode(): value.decode() for field, value in data.items()})
+                 for day, data in zip(days, pipe.execute())]
+
+        total = {}
+        for _, fields in daily:
+            for field, value in fields.items():
+                total[field] = total.get(field, 0) + float(value)
+        return {
+            'days': [{'date': day, **self.describe(fields)} for day, fields in daily],
+            'total': self.describe(total),
+        }
+
+    @staticmethod
+    def describe(fields):
+        """Chuyển các trường của hash thành nội dung trả về của /stats."""
+        by_type = {}
+        for field, value in fields.items():
+            metric, _, rest = field.partition(':')
+            if metric in ('count', 'amount') and rest:
+                kind, _, status = rest.partition(':')
+                entry = by_type.setdefault(kind, {}).setdefault(status, {'count': 0, 'amount': 0})
+                entry[metric] = int(float(value))
+
+        transactions = by_type.get('transaction', {})
+        completed = transactions.get('completed', {}).get('count', 0)
+        expired = transactions.get('expired', {}).get('count', 0)
+        paid_count = int(float(fields.get('paid_count', 0)))
+        return {
+            'amount_in': int(float(fields.get('amount_in', 0))),
+            'amount_out': int(float(fields.get('amount_out', 0))),
+            'created': transactions.get('pending', {}).get('count', 0),
+            'completed': completed,
+            'expired': expired,
+            'completion_rate': round(completed / (completed + expired), 4) if completed + expired else None,
+            'paid_count': paid_count,
+            'avg_seconds_to_pay': round(float(fields.get('paid_seconds', 0)) / paid_count, 1) if paid_count else None,
+            'by_type': by_type,
+        }
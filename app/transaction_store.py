@@ -0,0 +1,382 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_HISTORY_KEY = os.environ.get('TRANSACTION_HISTORY_KEY', 'transaction_history')
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 1000))
+
+# Cập nhật nguyên tử một bản ghi: ghi các trường mới và chuyển chỉ mục trạng thái nếu trạng thái thay đổi.
+# KEYS[1] = record key, KEYS[2] = time index, KEYS[3] = chỉ mục của trạng thái mới (khi cập nhật status),
+# KEYS[4] = chỉ mục của trạng thái cũ đọc trước khi gọi script (nếu có)
+# ARGV[1] = status index prefix, ARGV[2] = record id, ARGV[3..] = field, value (đã mã hóa JSON)
+# Trạng thái cũ được đọc lại trong script nên việc chuyển chỉ mục không phụ thuộc vào lần đọc trước đó: chỉ khi
+# có cập nhật đồng thời xen vào giữa thì chỉ mục cũ mới khác KEYS[4].
+UPDATE_RECORD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local old_status = redis.call('HGET', KEYS[1], 'status')
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+if #KEYS >= 3 and old_status ~= redis.call('HGET', KEYS[1], 'status') then
+    local score = redis.call('ZSCORE', KEYS[2], ARGV[2]) or 0
+    if old_status then
+        redis.call('ZREM', ARGV[1] .. cjson.decode(old_status), ARGV[2])
+    end
+    redis.call('ZADD', KEYS[3], score, ARGV[2])
+end
+return 1
+"""
+
+# Xóa một bản ghi đã được lưu trữ ra đĩa khỏi Redis, kèm chỉ mục thời gian và chỉ mục trạng thái hiện tại.
+# KEYS[1] bản ghi, KEYS[2] chỉ mục thời gian, KEYS[3] (nếu có) chỉ mục trạng thái của bản ghi đã lưu trữ
+# ARGV[1] id, ARGV[2..] các cặp trường/giá trị đã ghi ra archive. Bản ghi chỉ bị xóa nếu chưa đổi kể từ lúc đọc,
+# nếu đã đổi thì giữ lại để lô sau lưu trữ bản mới
+ARCHIVE_RECORD_SCRIPT = """
+local current = redis.call('HGETALL', KEYS[1])
+if #current ~= #ARGV - 1 then
+    return 0
+end
+local archived = {}
+for i = 2, #ARGV, 2 do
+    archived[ARGV[i]] = ARGV[i + 1]
+end
+for i = 1, #current, 2 do
+    if archived[current[i]] ~= current[i + 1] then
+        return 0
+    end
+end
+redis.call('DEL', KEYS[1])
+for i = 2, #KEYS do
+    redis.call('ZREM', KEYS[i], ARGV[1])
+end
+return 1
+"""
+
+
+def parse_transaction_time(value, default=None):
+    """Chuyển transaction_time (ISO 8601) sang epoch giây, trả về default nếu không hợp lệ."""
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+
+class TransactionStore:
+    """Lưu lịch sử giao dịch theo từng bản ghi (hash) kèm chỉ mục sorted-set theo thời gian và trạng thái.
+
+    Bố cục khóa (với key = TRANSACTION_HISTORY_KEY):
+        {key}:record:{id}          hash, mỗi trường là giá trị mã hóa JSON
+        {key}:index:time           zset id -> thời điểm tạo (epoch giây)
+        {key}:index:status:{s}     zset id -> thời điểm tạo, theo trạng thái
+        {key}:seq                  bộ đếm sinh id cho bản ghi không có code
+
+    Giao dịch có `code` dùng chính code làm id nên tra cứu/cập nhật theo code là O(1).
+    Khi có archive (HistoryArchive), bản ghi cũ được chuyển ra đĩa bằng archive_older_than(); get() và query()
+    đọc tiếp từ archive nên việc này trong suốt với người dùng.
+    """
+
+    def __init__(self, redis_client, key=TRANSACTION_HISTORY_KEY, archive=None):
+        self.redis = redis_client
+        self.key = key
+        self.archive = archive
+        self.time_index_key = f"{key}:index:time"
+        self.status_index_prefix = f"{key}:index:status:"
+        self.seq_key = f"{key}:seq"
+        self.legacy_key = f"{key}:legacy"
+        self.migration_lock_key = f"{key}:migration_lock"
+        self._update_script = redis_client.register_script(UPDATE_RECORD_SCRIPT)
+        self._archive_script = redis_client.register_script(ARCHIVE_RECORD_SCRIPT)
+
+    def record_key(self, record_id):
+        return f"{self.key}:record:{record_id}"
+
+    def status_index_key(self, status):
+        return f"{self.status_index_prefix}{status}"
+
+    @staticmethod
+    def _encode(record):
+        return {field: json.dumps(value) for field, value in record.items()}
+
+    @staticmethod
+    def _matches(record, filters):
+        return all(str(record.get(field)) == str(value) for field, value in filters.items())
+
+    @staticmethod
+    def _decode(data):
+        return {
+            (field.decode() if isinstance(field, bytes) else field): json.loads(value)
+            for field, value in data.items()
+        }
+
+    def new_id(self):
+        """Sinh id cho bản ghi không có code (ví dụ giao dịch nạp tiền)."""
+        return f"T{self.redis.incr(self.seq_key)}"
+
+    def add(self, record, record_id=None, created_at=None, pipe=None):
+        """Thêm một bản ghi vào lịch sử, trả về id của bản ghi (O(log N))."""
+        record_id = record_id or record.get('code') or self.new_id()
+        if created_at is None:
+            created_at = parse_transaction_time(record.get('transaction_time'), time.time())
+        target = pipe if pipe is not None else self.redis.pipeline()
+        target.hset(self.record_key(record_id), mapping=self._encode(record))
+        target.zadd(self.time_index_key, {record_id: created_at})
+        if record.get('status'):
+            target.zadd(self.status_index_key(record['status']), {record_id: created_at})
+        if pipe is None:
+            target.execute()
+        return record_id
+
+    def get(self, record_id):
+        """Lấy một bản ghi theo id/code, trả về None nếu không tồn tại."""
+        data = self.redis.hgetall(self.record_key(record_id))
+        if data:
+            return self._decode(data)
+        return self.archive.get(record_id) if self.archive is not None else None
+
+    def get_many(self, record_ids):
+        """Lấy nhiều bản ghi trong một round trip, giữ nguyên thứ tự, bỏ qua bản ghi không tồn tại."""
+        if not record_ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for record_id in record_ids:
+            pipe.hgetall(self.record_key(record_id.decode() if isinstance(record_id, bytes) else record_id))
+        return [self._decode(data) for data in pipe.execute() if data]
+
+    def update(self, record_id, fields, pipe=None):
+        """Cập nhật các trường của bản ghi và chỉ mục trạng thái một cách nguyên tử.
+
+        Trả về False nếu bản ghi không tồn tại. Khi truyền pipe, lệnh được đưa vào pipeline và luôn trả về True.
+        """
+        keys = [self.record_key(record_id), self.time_index_key]
+        if 'status' in fields:
+            # Trạng thái cũ được đọc trước để khai báo chỉ mục của nó trong KEYS (lệnh đọc chạy ngay, kể cả khi
+            # dùng pipeline); script đọc lại trạng thái khi chuyển chỉ mục nên lần đọc này không cần nhất quán
+            keys.append(self.status_index_key(fields['status']))
+            current = self.redis.hget(keys[0], 'status')
+            if current is not None and json.loads(current) != fields['status']:
+                keys.append(self.status_index_key(json.loads(current)))
+        args = [self.status_index_prefix, record_id]
+        for field, value in self._encode(fields).items():
+            args.extend([field, value])
+        if pipe is not None:
+            self._update_script(keys=keys, args=args, client=pipe)
+            return True
+        return bool(self._update_script(keys=keys, args=args))
+
+    def ids_by_status(self, status, start=0, end=-1):
+        """Danh sách id theo trạng thái, sắp xếp theo thời gian tạo."""
+        return [member.decode() for member in self.redis.zrange(self.status_index_key(status), start, end)]
+
+    def scan(self, status=None, min_score='-inf', max_score='+inf', after=None, batch_size=500):
+        """Duyệt bản ghi theo thời gian tạo tăng dần, trả về từng (score, id, record).
+
+        Dữ liệu được đọc theo lô batch_size nên bộ nhớ không phụ thuộc vào độ dài lịch sử.
+        `after` là cặp (score, id) của bản ghi cuối cùng đã trả về (dùng cho phân trang bằng cursor).
+        """
+        index_key = self.status_index_key(status) if status else self.time_index_key
+        lower, offset = min_score, 0
+        if after is not None:
+            after_score, after_id = after
+            # Các phần tử cùng score được Redis sắp theo thứ tự từ điển của member
+            ties = self.redis.zrangebyscore(index_key, after_score, after_score)
+            lower = after_score
+            offset = sum(1 for member in ties if member.decode() <= after_id)
+
+        while True:
+            members = self.redis.zrangebyscore(index_key, lower, max_score, start=offset, num=batch_size, withscores=True)
+            if not members:
+                return
+            pipe = self.redis.pipeline(transaction=False)
+            for member, _ in members:
+                pipe.hgetall(self.record_key(member.decode()))
+            for (member, score), data in zip(members, pipe.execute()):
+                if not data:
+                    continue
+                yield score, member.decode(), self._decode(data)
+
+            last_score = members[-1][1]
+            trailing = sum(1 for _, score in members if score == last_score)
+            offset = offset + trailing if lower == last_score else trailing
+            lower = last_score
+            if len(members) < batch_size:
+                return
+
+    def query(self, filters=None, status=None, min_score='-inf', max_score='+inf', after=None, batch_size=500):
+        """Như scan() nhưng chỉ trả về các bản ghi khớp mọi điều kiện bằng trong filters (ví dụ type, phone_number)."""
+        filters = {field: value for field, value in (filters or {}).items() if value is not None}
+        results = (
+            (score, record_id, record)
+            for score, record_id, record in self.scan(status, min_score, max_score, after, batch_size)
+            if self._matches(record, filters)
+        )
+        if self.archive is None:
+            yield from results
+            return
+
+        # Ghép với bản ghi đã lưu trữ theo thứ tự (score, id); bản còn trong Redis được ưu tiên nếu trùng
+        archived = self.archive.scan(filters, status, min_score, max_score, after)
+        previous = None
+        for score, record_id, record in heapq.merge(results, archived, key=lambda entry: (entry[0], entry[1])):
+            if (score, record_id) != previous:
+                previous = (score, record_id)
+                yield score, record_id, record
+
+    def count(self):
+        return self.redis.zcard(self.time_index_key)
+
+    def archive_older_than(self, cutoff, batch_size=1000):
+        """Chuyển các bản ghi tạo trước cutoff (epoch giây) sang archive theo lô, trả về số bản ghi đã chuyển.
+
+        Mỗi lô được ghi xuống đĩa (fsync) trước khi bị xóa khỏi Redis. Bản ghi bị cập nhật trong lúc đó không bị
+        xóa mà được lưu trữ lại ở lô sau (archive luôn trả về bản mới nhất).
+        """
+        total = 0
+        while True:
+            members = self.redis.zrangebyscore(self.time_index_key, '-inf', f'({cutoff}', start=0, num=batch_size,
+                                               withscores=True)
+            if not members:
+                return total
+            pipe = self.redis.pipeline(transaction=False)
+            for member, _ in members:
+                pipe.hgetall(self.record_key(member.decode()))
+            raw = {member.decode(): data for (member, _), data in zip(members, pipe.execute())}
+            entries = [(score, member.decode(), self._decode(raw[member.decode()]))
+                       for member, score in members if raw[member.decode()]]
+            if entries:
+                self.archive.write(entries)
+
+            statuses = {record_id: record.get('status') for _, record_id, record in entries}
+            pipe = self.redis.pipeline()
+            for record_id, data in raw.items():
+                keys = [self.record_key(record_id), self.time_index_key]
+                if statuses.get(record_id) is not None:
+                    keys.append(self.status_index_key(statuses[record_id]))
+                args = [record_id]
+                for field, value in data.items():
+                    args.extend([field, value])
+                self._archive_script(keys=keys, args=args, client=pipe)
+            total += sum(pipe.execute())
+
+    def migrate_legacy_list(self):
+        """Chuyển dữ liệu từ danh sách JSON cũ (TRANSACTION_HISTORY_KEY kiểu list) sang bố cục mới.
+
+        Chỉ chạy một lần: danh sách cũ được đổi tên thành {key}:legacy sau khi chuyển xong.
+        Trả về số bản ghi đã chuyển.
+        """
+        if self.redis.type(self.key) != b'list':
+            return 0
+        if not self.redis.set(self.migration_lock_key, 1, nx=True, ex=3600):
+            logger.info("Một tiến trình khác đang chuyển đổi lịch sử giao dịch, bỏ qua.")
+            return 0
+
+        try:
+            total = self.redis.llen(self.key)
+            logger.info(f"Bắt đầu chuyển đổi {total} giao dịch từ danh sách cũ {self.key}")
+            migrated = 0
+            last_score = float('-inf')
+            for start in range(0, total, MIGRATION_BATCH_SIZE):
+                entries = self.redis.lrange(self.key, start, start + MIGRATION_BATCH_SIZE - 1)
+                pipe = self.redis.pipeline(transaction=False)
+                for entry in entries:
+                    try:
+                        record = json.loads(entry.decode())
+                    except ValueError:
+                        logger.warning(f"Bỏ qua bản ghi lịch sử không hợp lệ: {entry!r}")
+                        continue
+                    score = parse_transaction_time(record.get('transaction_time'))
+                    if score is None:
+                        # Không đọc được thời gian: xếp ngay sau bản ghi đứng trước trong danh sách cũ
+                        score = last_score + 1e-6 if last_score > float('-inf') else time.time() - total
+                    last_score = score
+                    self.add(record, created_at=score, pipe=pipe)
+                    migrated += 1
+                pipe.execute()
+
+            self.redis.rename(self.key, self.legacy_key)
+            logger.info(f"Đã chuyển đổi {migrated} giao dịch, danh sách cũ được lưu tại {self.legacy_key}")
+            return migrated
+        finally:
+            self.redis.delete(self.migration_lock_key)
+
+
+class AsyncTransactionStore:
+    """Phần đọc của TransactionStore cho redis.asyncio (ASGI): cùng bố cục khóa và archive với store đồng bộ.
+
+    scan()/query() là async generator nên việc duyệt lịch sử không giữ thread nào trong lúc chờ Redis; chỉ việc
+    đọc archive trên đĩa (nếu có) được chạy trong thread pool mặc định của event loop.
+    """
+
+    def __init__(self, redis_client, store):
+        self.redis = redis_client
+        self.store = store
+
+    async def scan(self, status=None, min_score='-inf', max_score='+inf', after=None, batch_size=500):
+        """Như TransactionStore.scan()."""
+        index_key = self.store.status_index_key(status) if status else self.store.time_index_key
+        lower, offset = min_score, 0
+        if after is not None:
+            after_score, after_id = after
+            ties = await self.redis.zrangebyscore(index_key, after_score, after_score)
+            lower = after_score
+            offset = sum(1 for member in ties if member.decode() <= after_id)
+
+        while True:
+            members = await self.redis.zrangebyscore(index_key, lower, max_score, start=offset, num=batch_size,
+                                                     withscores=True)
+            if not members:
+                return
+            pipe = self.redis.pipeline(transaction=False)
+            for member, _ in members:
+                pipe.hgetall(self.store.record_key(member.decode()))
+            for (member, score), data in zip(members, await pipe.execute()):
+                if not data:
+                    continue
+                yield score, member.decode(), TransactionStore._decode(data)
+
+            last_score = members[-1][1]
+            trailing = sum(1 for _, score in members if score == last_score)
+            offset = offset + trailing if lower == last_score else trailing
+            lower = last_score
+            if len(members) < batch_size:
+                return
+
+    async def query(self, filters=None, status=None, min_score='-inf', max_score='+inf', after=None, batch_size=500):
+        """Như TransactionStore.query()."""
+        filters = {field: value for field, value in (filters or {}).items() if value is not None}
+        results = (
+            (score, record_id, record)
+            async for score, record_id, record in self.scan(status, min_score, max_score, after, batch_size)
+            if TransactionStore._matches(record, filters)
+        )
+        if self.store.archive is None:
+            async for entry in results:
+                yield entry
+            return
+
+        # Ghép với bản ghi đã lưu trữ theo thứ tự (score, id) như heapq.merge; bản còn trong Redis được ưu tiên
+        archived = self.store.archive.scan(filters, status, min_score, max_score, after)
+        loop = asyncio.get_running_loop()
+        pending = await loop.run_in_executor(None, next, archived, None)
+        previous = None
+        async for entry in results:
+            while pending is not None and pending[:2] < entry[:2]:
+                if pending[:2] != previous:
+                    previous = pending[:2]
+                    yield pending
+                pending = await loop.run_in_executor(None, next, archived, None)
+            if entry[:2] != previous:
+                previous = entry[:2]
+                yield entry
+        while pending is not None:
+            if pending[:2] != previous:
+                previous = pending[:2]
+                yield pending
+            pending = await loop.run_in_executor(None, next, archived, None)
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import WEBHOOK_DELIVERIES, WEBHOOK_QUEUE_SECONDS, WEBHOOK_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_KEY_PREFIX = os.environ.get('WEBHOOK_KEY_PREFIX', 'webhook:')
+
+# Lấy một job khỏi hàng đợi và giữ nó trong zset scheduled tới khi hết visibility timeout. Id không còn job (đã
+# được ack bởi lần gửi khác) bị bỏ qua để lấy id tiếp theo.
+# KEYS[1] = queue, KEYS[2] = scheduled, KEYS[3] = jobs; ARGV[1] = deadline
+POP_SCRIPT = """
+while true do
+    local job_id = redis.call('LPOP', KEYS[1])
+    if not job_id then
+        return nil
+    end
+    local job = redis.call('HGET', KEYS[3], job_id)
+    if job then
+        redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+        return job
+    end
+end
+"""
+
+# Ghi kết quả gửi lỗi của một job, chỉ khi job còn trong outbox (chưa được ack bởi lần gửi khác).
+# KEYS[1] = jobs, KEYS[2] = scheduled, KEYS[3] = dead, KEYS[4] = dead_jobs, KEYS[5] = version của job
+# ARGV[1] = job id, ARGV[2] = job (JSON), ARGV[3] = thời điểm thử lại, rỗng nếu chuyển vào dead-letter,
+# ARGV[4] = job dùng khi gửi lại từ dead-letter, ARGV[5] = TTL của version (giây)
+FAIL_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('INCR', KEYS[5])
+redis.call('EXPIRE', KEYS[5], ARGV[5])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+else
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('RPUSH', KEYS[3], ARGV[2])
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[4])
+end
+return 1
+"""
+
+# Đưa tối đa ARGV[1] job trong dead-letter trở lại hàng đợi.
+# KEYS[1] = dead, KEYS[2] = dead_jobs, KEYS[3] = jobs, KEYS[4] = queue
+REPLAY_DEAD_SCRIPT = """
+local replayed = 0
+while replayed < tonumber(ARGV[1]) do
+    local entry = redis.call('LPOP', KEYS[1])
+    if not entry then
+        break
+    end
+    local job_id = cjson.decode(entry)['id']
+    -- Entry ghi trước khi có dead_jobs được gửi lại nguyên trạng
+    local job = redis.call('HGET', KEYS[2], job_id) or entry
+    redis.call('HDEL', KEYS[2], job_id)
+    redis.call('HSET', KEYS[3], job_id, job)
+    redis.call('RPUSH', KEYS[4], job_id)
+    replayed = replayed + 1
+end
+return replayed
+"""
+
+# Đưa các job đã đến hạn (retry hoặc quá visibility timeout) trở lại hàng đợi.
+# KEYS[1] = scheduled, KEYS[2] = queue; ARGV[1] = now, ARGV[2] = limit
+PROMOTE_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job_id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('RPUSH', KEYS[2], job_id)
+end
+return #ids
+"""
+
+
+class WebhookDispatcher:
+    """Gửi request xác nhận tới APP_URL qua hàng đợi bền vững trong Redis (outbox).
+
+    - enqueue() chỉ ghi job vào Redis nên luồng xử lý email không phải chờ ứng dụng phản hồi.
+    - Một nhóm worker thread gửi request bằng Session giữ kết nối keep-alive, có timeout cho từng request.
+    - Lỗi mạng, 5xx và 429 được thử lại với backoff tăng dần; quá max_attempts hoặc lỗi 4xx khác thì
+      job được chuyển vào danh sách dead-letter và có thể gửi lại bằng replay_dead_letters().
+    - Job đang gửi được giữ trong zset scheduled tới hết visibility_timeout, nếu process chết job sẽ được gửi lại.
+    """
+
+    def __init__(self, redis_client, base_url, headers=None, workers=4, timeout=10, max_attempts=8,
+                 retry_backoff=2, max_backoff=600, visibility_timeout=60, prefix=WEBHOOK_KEY_PREFIX):
+        self.redis = redis_client
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.workers = workers
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.visibility_timeout = visibility_timeout
+        self.jobs_key = f"{prefix}jobs"
+        self.queue_key = f"{prefix}queue"
+        self.scheduled_key = f"{prefix}scheduled"
+        self.dead_key = f"{prefix}dead"
+        self.dead_jobs_key = f"{prefix}dead_jobs"
+        self.version_prefix = f"{prefix}version:"
+        self.handlers = {}
+        self.wakeup = threading.Event()
+        self.local = threading.local()
+        self._pop_script = redis_client.register_script(POP_SCRIPT)
+        self._promote_script = redis_client.register_script(PROMOTE_SCRIPT)
+        self._fail_script = redis_client.register_script(FAIL_SCRIPT)
+        self._replay_dead_script = redis_client.register_script(REPLAY_DEAD_SCRIPT)
+
+    def on_result(self, kind, on_success=None, on_dead=None, on_ack=None):
+        """Đăng ký callback cho loại job: on_success(job, response_json), on_dead(job, error).
+
+        on_ack(job, response_json, pipe) đưa lệnh ghi vào cùng MULTI/EXEC với lệnh xóa job khỏi outbox. Job có thể
+        được gửi nhiều lần (at-least-once) nhưng chỉ lần ack đầu tiên ghi các lệnh này và gọi on_success.
+        Job được gửi lại từ dead-letter có trường dead_at: thời điểm lần đầu job bị chuyển vào dead-letter.
+        """
+        self.handlers[kind] = {'on_success': on_success, 'on_dead': on_dead, 'on_ack': on_ack}
+
+    def enqueue(self, kind, path, payload, meta=None, pipe=None):
+        """Thêm job gửi POST {base_url}{path} vào outbox. Trả về id của job."""
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'path': path,
+            'payload': payload,
+            'meta': meta or {},
+            'attempts': 0,
+            'created_at': time.time(),
+        }
+        target = pipe if pipe is not None else self.redis.pipeline()
+        target.hset(self.jobs_key, job['id'], json.dumps(job))
+        target.rpush(self.queue_key, job['id'])
+        if pipe is None:
+            target.execute()
+        self.wakeup.set()
+        return job['id']
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            self.local.session = session
+        return session
+
+    def run(self, should_run=lambda: True):
+        """Chạy nhóm worker cho tới khi should_run() trả về False."""
+        logger.info(f"Bắt đầu gửi webhook với {self.workers} worker")
+        threads = [threading.Thread(target=self._worker, args=(should_run,), daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        while should_run():
+            try:
+                if self._promote_script(keys=[self.scheduled_key, self.queue_key], args=[time.time(), 100]):
+                    self.wakeup.set()
+            except Exception as e:
+                logger.error(f"Lỗi khi chuyển job webhook tới hạn vào hàng đợi: {e}")
+            time.sleep(0.5)
+        self.wakeup.set()
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, should_run):
+        while should_run():
+            try:
+                job = self._pop_script(keys=[self.queue_key, self.scheduled_key, self.jobs_key],
+                                       args=[time.time() + self.visibility_timeout])
+            except Exception as e:
+                logger.error(f"Lỗi khi lấy job webhook: {e}")
+                time.sleep(1)
+                continue
+            if job is None:
+                self.wakeup.wait(0.5)
+                self.wakeup.clear()
+                continue
+            try:
+                self.deliver(json.loads(job))
+            except Exception as e:
+                # Job vẫn nằm trong jobs/scheduled nên sẽ được lấy lại sau visibility_timeout
+                logger.error(f"Lỗi khi gửi job webhook, sẽ thử lại sau {self.visibility_timeout} giây: {e}")
+
+    def deliver(self, job):
+        job['attempts'] += 1
+        handler = self.handlers.get(job['kind'], {})
+        retryable = True
+        try:
+            with WEBHOOK_REQUEST_SECONDS.labels(job['kind']).time():
+                response = self.session().post(f"{self.base_url}{job['path']}", json=job['payload'],
+                                               timeout=self.timeout)
+            retryable = response.status_code >= 500 or response.status_code == 429
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self._fail(job, handler, e, retryable)
+            return
+
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = response.text
+        if not self._ack(job, handler.get('on_ack'), response_data):
+            # Một lần gửi khác của cùng job (sau visibility_timeout) đã được ack trước
+            logger.info(f"Job webhook {job['id']} đã được ack bởi lần gửi khác")
+            return
+        WEBHOOK_DELIVERIES.labels(job['kind'], 'success').inc()
+        WEBHOOK_QUEUE_SECONDS.labels(job['kind']).observe(time.time() - job['created_at'])
+        if handler.get('on_success'):
+            try:
+                handler['on_success'](job, response_data)
+            except Exception as e:
+                logger.error(f"Lỗi trong callback webhook {job['kind']}: {e}")
+
+    def version_key(self, job_id):
+        """Khóa đổi mỗi khi job được ack hoặc ghi kết quả lỗi, dùng để WATCH riêng từng job khi ack."""
+        return f"{self.version_prefix}{job_id}"
+
+    def _ack(self, job, on_ack=None, response_data=None):
+        """Xóa job khỏi outbox, trả về False nếu job đã được ack hoặc chuyển vào dead-letter trước đó."""
+        version_key = self.version_key(job['id'])
+
+        def ack(pipe):
+            if not pipe.hexists(self.jobs_key, job['id']):
+                return False
+            pipe.multi()
+            pipe.hdel(self.jobs_key, job['id'])
+            pipe.zrem(self.scheduled_key, job['id'])
+            pipe.incr(version_key)
+            pipe.expire(version_key, self.visibility_timeout)
+            if on_ack:
+                on_ack(job, response_data, pipe)
+            return True
+
+        # Chỉ WATCH khóa version của job nên ack/enqueue của các job khác không làm transaction phải chạy lại
+        return self.redis.transaction(ack, version_key, value_from_callable=True)
+
+    def _fail(self, job, handler, error, retryable):
+        job['last_error'] = str(error)
+        keys = [self.jobs_key, self.scheduled_key, self.dead_key, self.dead_jobs_key, self.version_key(job['id'])]
+        if retryable and job['attempts'] < self.max_attempts:
+            delay = min(self.retry_backoff * 2 ** (job['attempts'] - 1), self.max_backoff)
+            if not self._fail_script(keys=keys, args=[job['id'], json.dumps(job), time.time() + delay, '',
+                                                      self.visibility_timeout]):
+                logger.info(f"Job webhook {job['id']} đã được ack bởi lần gửi khác, bỏ qua lỗi: {error}")
+                return
+            logger.warning(f"Gửi webhook {job['path']} lỗi (lần {job['attempts']}): {error}. Thử lại sau {delay} giây")
+            WEBHOOK_DELIVERIES.labels(job['kind'], 'retry').inc()
+            return
+
+        # Job gửi lại từ dead-letter bắt đầu đếm số lần gửi từ đầu và giữ thời điểm lần đầu bị chuyển vào dead-letter
+        replay = {**{key: value for key, value in job.items() if key != 'last_error'}, 'attempts': 0}
+        replay.setdefault('dead_at', time.time())
+        if not self._fail_script(keys=keys, args=[job['id'], json.dumps(job), '', json.dumps(replay),
+                                                  self.visibility_timeout]):
+            logger.info(f"Job webhook {job['id']} đã được ack bởi lần gửi khác, bỏ qua lỗi: {error}")
+            return
+        logger.error(f"Gửi webhook {job['path']} thất bại sau {job['attempts']} lần, chuyển vào dead-letter: {error}")
+        WEBHOOK_DELIVERIES.labels(job['kind'], 'dead').inc()
+        if handler.get('on_dead'):
+            try:
+                handler['on_dead'](job, error)
+            except Exception as e:
+                logger.error(f"Lỗi trong callback webhook {job['kind']}: {e}")
+
+    def dead_letters(self, start=0, end=99):
+        return [json.loads(job) for job in self.redis.lrange(self.dead_key, start, end)]
+
+    def replay_dead_letters(self, limit=100):
+        """Đưa tối đa limit job trong dead-letter trở lại hàng đợi. Trả về số job đã đưa lại."""
+        replayed = self._replay_dead_script(keys=[self.dead_key, self.dead_jobs_key, self.jobs_key, self.queue_key],
+                                            args=[limit])
+        if replayed:
+            self.wakeup.set()
+        return replayed
+
+    def stats(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(self.queue_key)
+        pipe.zcard(self.scheduled_key)
+        pipe.llen(self.dead_key)
+        queued, scheduled, dead = pipe.execute()
+        return {'queued': queued, 'scheduled': scheduled, 'dead': dead}
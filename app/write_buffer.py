@@ -0,0 +1,145 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+
+import redis
+
+from metrics import WRITE_BUFFER_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SUFFIX = '.wal'
+REDIS_UNAVAILABLE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class WriteBufferFull(Exception):
+    """Bộ đệm ghi đã đạt dung lượng tối đa."""
+
+
+class WriteAheadBuffer:
+    """Bộ đệm cục bộ trên đĩa cho email nhận được khi Redis tạm thời không truy cập được.
+
+    Email được đệm nguyên vẹn (khóa, nội dung, hộp thư, thời điểm nhận) chứ không phải các lệnh Redis: khi Redis
+    không phản hồi thì chính bước nhận quyền xử lý trong sổ ghi nhận email đã lỗi, trước mọi lần đọc/ghi khác.
+    append() ghi thêm entry vào file {directory}/{host}-{pid}.wal (mỗi dòng một JSON, fsync trước khi trả về);
+    run()/replay() gọi handler(entry) cho từng entry theo đúng thứ tự khi Redis phản hồi trở lại. handler đi qua
+    sổ ghi nhận email nên entry của email đã được xử lý ở nơi khác chỉ bị bỏ qua, không xác nhận hai lần.
+
+    Bộ đệm giới hạn max_bytes cho cả thư mục: khi đầy, append() báo WriteBufferFull. directory rỗng: không đệm.
+    """
+
+    def __init__(self, directory='', max_bytes=64 * 1024 * 1024, replay_interval=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.replay_interval = replay_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def path(self):
+        # Tên file theo pid nên process con sau fork ghi vào file riêng
+        return os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}{BUFFER_SUFFIX}")
+
+    def paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, f"*{BUFFER_SUFFIX}"))) if self.enabled else []
+
+    def size(self):
+        total = 0
+        for path in self.paths():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def pending(self):
+        """Số entry đang chờ xử lý lại (mọi file trong thư mục)."""
+        count = 0
+        for path in self.paths():
+            try:
+                with open(path, 'rb') as f:
+                    count += sum(1 for line in f if line.strip())
+            except FileNotFoundError:
+                pass
+        return count
+
+    def append(self, entry):
+        """Ghi thêm một entry (dict JSON) vào bộ đệm, chỉ trả về sau khi đã fsync."""
+        line = (json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if self.size() + len(line) > self.max_bytes:
+                raise WriteBufferFull(self.directory)
+            while True:
+                # Mở lại file mỗi lần ghi: replay() có thể đã xóa file này trong lúc chờ khóa
+                with open(self.path(), 'ab') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    if os.fstat(f.fileno()).st_nlink == 0:
+                        continue
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    break
+        WRITE_BUFFER_ENTRIES.labels('buffered').inc()
+        self.wakeup.set()
+
+    def replay(self, handler):
+        """Gọi handler(entry) cho các entry đã đệm (của mọi process dùng chung thư mục). Trả về số entry đã xử lý.
+
+        handler trả về kết quả (dùng làm nhãn số liệu). Dừng ở entry đầu tiên mà handler báo lỗi, các entry còn
+        lại được giữ nguyên thứ tự cho lần sau. handler không được ghi thêm vào bộ đệm (file đang bị khóa).
+        """
+        done = 0
+        for path in self.paths():
+            try:
+                f = open(path, 'r+b')
+            except FileNotFoundError:
+                continue
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                lines = [line for line in f.read().splitlines() if line.strip()]
+                applied = 0
+                try:
+                    for line in lines:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # Dòng ghi dở khi process bị dừng giữa chừng
+                            logger.error(f"Bỏ qua dòng hỏng trong bộ đệm ghi {path}")
+                            applied += 1
+                            continue
+                        WRITE_BUFFER_ENTRIES.labels(handler(entry)).inc()
+                        applied += 1
+                finally:
+                    remaining = lines[applied:]
+                    if remaining:
+                        f.seek(0)
+                        f.write(b''.join(line + b'\n' for line in remaining))
+                        f.truncate()
+                    else:
+                        # Process đang chờ khóa để ghi thêm vào file này sẽ thấy file đã bị xóa và tạo file mới
+                        os.unlink(path)
+                    done += applied
+        return done
+
+    def run(self, handler, should_run=lambda: True):
+        """Vòng lặp xử lý lại bộ đệm: thử lại mỗi replay_interval giây tới khi Redis phản hồi."""
+        while should_run():
+            self.wakeup.wait(self.replay_interval)
+            self.wakeup.clear()
+            try:
+                if self.paths():
+                    replayed = self.replay(handler)
+                    if replayed:
+                        logger.info(f"Đã xử lý lại {replayed} email từ bộ đệm ghi")
+            except REDIS_UNAVAILABLE_ERRORS as e:
+                logger.debug(f"Redis chưa phản hồi, chưa xử lý lại bộ đệm ghi: {e}")
+            except Exception as e:
+                logger.error(f"Lỗi khi xử lý lại bộ đệm ghi: {e}")
@@ -0,0 +1,61 @@
+"""Ứng dụng giả lập cho APP_URL: nhận /confirm_topup và /confirm_transaction, ghi lại thời điểm nhận."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        self.server.record(self.path, payload)
+        body = json.dumps({'status': 'success', 'transaction_id': 'BENCH'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AppStubServer(ThreadingHTTPServer):
+    """Lưu thời điểm (time.perf_counter) nhận request xác nhận, theo transaction_id hoặc phone_number."""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.received = {}
+        self.condition = threading.Condition()
+
+    def record(self, path, payload):
+        key = payload.get('transaction_id') or payload.get('phone_number')
+        with self.condition:
+            self.received.setdefault(key, time.perf_counter())
+            self.condition.notify_all()
+
+    def wait_for(self, keys, timeout):
+        """Chờ tới khi đã nhận đủ các key hoặc hết timeout. Trả về {key: thời điểm nhận} của các key đã nhận."""
+        keys = set(keys)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not keys <= self.received.keys():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return {key: self.received[key] for key in keys if key in self.received}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
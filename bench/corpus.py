@@ -0,0 +1,114 @@
+"""Sinh email biến động số dư Cake giả lập cho benchmark.
+
+Chạy trực tiếp để ghi bộ email ra thư mục (mỗi email một file .eml):
+
+    python bench/corpus.py --count 1000 --output /tmp/cake-corpus
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+CAKE_SENDER = 'no-reply@cake.vn'
+
+# Tỉ lệ các loại email trong bộ sinh ngẫu nhiên
+VARIANT_WEIGHTS = {
+    'transaction': 6,   # Chuyển khoản có mã VCD, định dạng text/plain
+    'topup': 2,         # Chuyển khoản có số điện thoại NT...
+    'html': 1,          # Email chỉ có phần text/html
+    'multipart': 1,     # multipart/alternative (text/plain + text/html)
+    'unrelated': 1,     # Biến động số dư không có mã nào
+}
+
+
+def format_amount(amount):
+    return f"{amount:,}".replace(',', '.')
+
+
+def cake_alert_text(amount, description, when=None, increased=True, balance=10_000_000):
+    """Nội dung văn bản của một email biến động số dư Cake."""
+    when = when or datetime.now()
+    direction = 'tăng' if increased else 'giảm'
+    return (
+        "Xin chào Quý khách,\n"
+        f"Tài khoản của bạn vừa {direction} {format_amount(amount)} VND vào {when:%d/%m/%Y %H:%M}\n"
+        f"Số dư hiện tại: {format_amount(balance)} VND\n"
+        f"Mô tả: {description}\n"
+        "Cảm ơn Quý khách đã sử dụng dịch vụ.\n"
+    )
+
+
+def cake_alert_html(text):
+    rows = ''.join(f"<tr><td>{line}</td></tr>" for line in text.splitlines())
+    return f"<html><body><table>{rows}</table></body></html>"
+
+
+def cake_alert_email(amount, description, when=None, increased=True, kind='plain', sender=CAKE_SENDER,
+                     charset='utf-8'):
+    """Email hoàn chỉnh (bytes) với kind là 'plain', 'html' hoặc 'multipart', các phần văn bản mã hóa theo charset."""
+    text = cake_alert_text(amount, description, when, increased)
+    if kind == 'multipart':
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(text, 'plain', charset))
+        msg.attach(MIMEText(cake_alert_html(text), 'html', charset))
+    elif kind == 'html':
+        msg = MIMEText(cake_alert_html(text), 'html', charset)
+    else:
+        msg = MIMEText(text, 'plain', charset)
+    msg['From'] = sender
+    msg['Subject'] = 'Thông báo biến động số dư'
+    msg['Message-ID'] = make_msgid(domain='bench.local')
+    msg['Date'] = formatdate(localtime=True)
+    return msg.as_bytes()
+
+
+def random_code(rng):
+    return f"VCD{rng.randrange(10 ** 10):010d}"
+
+
+def random_phone(rng):
+    return f"NT09{rng.randrange(10 ** 8):08d}"
+
+
+def generate_corpus(count, seed=0):
+    """Sinh count email ngẫu nhiên (có thể tái lập theo seed). Trả về danh sách (variant, email bytes)."""
+    rng = random.Random(seed)
+    variants = list(VARIANT_WEIGHTS)
+    weights = list(VARIANT_WEIGHTS.values())
+    start = datetime(2024, 1, 1)
+    corpus = []
+    for _ in range(count):
+        variant = rng.choices(variants, weights)[0]
+        amount = rng.randrange(10, 50_000) * 1000
+        when = start + timedelta(minutes=rng.randrange(525_600))
+        increased = variant != 'topup' or rng.random() < 0.8
+        if variant == 'topup':
+            description = f"{random_phone(rng)} nap tien"
+        elif variant == 'unrelated':
+            description = 'Thanh toan hoa don dien'
+        else:
+            description = f"{random_code(rng)} chuyen tien"
+        kind = variant if variant in ('html', 'multipart') else 'plain'
+        corpus.append((variant, cake_alert_email(amount, description, when, increased, kind)))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help='Thư mục ghi các file .eml')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    for i, (variant, raw) in enumerate(generate_corpus(args.count, args.seed)):
+        with open(os.path.join(args.output, f"{i:06d}-{variant}.eml"), 'wb') as f:
+            f.write(raw)
+    print(f"Đã ghi {args.count} email vào {args.output}")
+
+
+if __name__ == '__main__':
+    main()
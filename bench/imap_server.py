@@ -0,0 +1,244 @@
+"""Server IMAP giả lập (không SSL) cho benchmark.
+
+Chỉ hỗ trợ tập lệnh mà email_watcher và replay.py dùng: CAPABILITY, LOGIN, SELECT/EXAMINE, IDLE,
+UID SEARCH/FETCH/STORE, NOOP, LOGOUT.
+Mọi tài khoản/mật khẩu đều được chấp nhận, chỉ có một hộp thư.
+"""
+import email
+import email.utils
+from datetime import datetime
+import re
+import shlex
+import socketserver
+import threading
+
+_SECTION_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\]', re.IGNORECASE)
+
+
+def _parse_set(value):
+    ranges = []
+    for part in value.split(','):
+        start, _, end = part.partition(':')
+        ranges.append((start, end or start))
+    return ranges
+
+
+def _in_set(uid, ranges, max_uid):
+    for start, end in ranges:
+        start = max_uid if start == '*' else int(start)
+        end = max_uid if end == '*' else int(end)
+        if min(start, end) <= uid <= max(start, end):
+            return True
+    return False
+
+
+def _parse_criteria(tokens, max_uid):
+    """Chuyển điều kiện SEARCH (UNSEEN, ALL, FROM, UID, OR, NOT, ngoặc) thành hàm kiểm tra một message."""
+    def one():
+        token = tokens.pop(0).upper()
+        if token == '(':
+            predicates = []
+            while tokens[0] != ')':
+                predicates.append(one())
+            tokens.pop(0)
+            return lambda m: all(p(m) for p in predicates)
+        if token == 'OR':
+            left, right = one(), one()
+            return lambda m: left(m) or right(m)
+        if token == 'NOT':
+            inner = one()
+            return lambda m: not inner(m)
+        if token == 'UNSEEN':
+            return lambda m: '\\Seen' not in m.flags
+        if token == 'ALL':
+            return lambda m: True
+        if token == 'FROM':
+            sender = tokens.pop(0).lower()
+            return lambda m: sender in m.sender
+        if token in ('SINCE', 'BEFORE'):
+            # So với ngày trong header Date (server thật dùng INTERNALDATE)
+            day = datetime.strptime(tokens.pop(0), '%d-%b-%Y').date()
+            if token == 'SINCE':
+                return lambda m: m.date is not None and m.date >= day
+            return lambda m: m.date is not None and m.date < day
+        if token == 'UID':
+            ranges = _parse_set(tokens.pop(0))
+            return lambda m: _in_set(m.uid, ranges, max_uid)
+        raise ValueError(f"Không hỗ trợ điều kiện SEARCH {token}")
+
+    predicates = []
+    while tokens:
+        predicates.append(one())
+    return lambda m: all(p(m) for p in predicates)
+
+
+def _split_header(raw):
+    index = raw.find(b'\r\n\r\n')
+    return (raw[:index + 4], raw[index + 4:]) if index >= 0 else (raw, b'')
+
+
+class StoredMessage:
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        msg = email.message_from_bytes(raw)
+        self.sender = (msg.get('From') or '').lower()
+        try:
+            self.date = email.utils.parsedate_to_datetime(msg.get('Date')).date()
+        except (TypeError, ValueError):
+            self.date = None
+        self.header, body = _split_header(raw)
+        if msg.is_multipart():
+            boundary = b'--' + msg.get_boundary().encode()
+            first = body.split(boundary)[1].lstrip(b'\r\n')
+            self.part_header, part_body = _split_header(first)
+            self.part_body = part_body.rstrip(b'\r\n')
+        else:
+            self.part_header, self.part_body = self.header, body
+
+    def section(self, name):
+        name = name.upper()
+        if name == 'HEADER':
+            return self.header
+        if name == '1.MIME':
+            return self.part_header
+        if name == '1':
+            return self.part_body
+        return self.raw
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def write(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode())
+
+    def exists_update(self):
+        """Giống server thật: báo '* n EXISTS' trong phản hồi lệnh tiếp theo nếu hộp thư có thêm email."""
+        count = len(self.server.messages)
+        if count == self.reported:
+            return ''
+        self.reported = count
+        return f'* {count} EXISTS\r\n'
+
+    def handle(self):
+        server = self.server
+        self.reported = 0
+        self.write('* OK IMAP4rev1 bench server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = command.upper()
+
+            if command == 'CAPABILITY':
+                self.write(f'* CAPABILITY IMAP4rev1 IDLE\r\n{tag} OK CAPABILITY completed\r\n')
+            elif command in ('SELECT', 'EXAMINE'):
+                with server.lock:
+                    self.reported = len(server.messages)
+                mode = 'READ-WRITE' if command == 'SELECT' else 'READ-ONLY'
+                self.write(f'* {self.reported} EXISTS\r\n* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid\r\n'
+                           f'{tag} OK [{mode}] {command} completed\r\n')
+            elif command == 'IDLE':
+                # Ghi dưới lock để không xen kẽ với thông báo EXISTS từ deliver()
+                with server.lock:
+                    self.write('+ idling\r\n' + self.exists_update())
+                    server.idlers.append(self)
+                self.rfile.readline()
+                with server.lock:
+                    server.idlers.remove(self)
+                self.write(f'{tag} OK IDLE terminated\r\n')
+            elif command == 'SEARCH':
+                self.search(tag, args)
+            elif command == 'FETCH':
+                self.fetch(tag, args)
+            elif command == 'STORE':
+                self.store(tag, args)
+            elif command == 'LOGOUT':
+                self.write(f'* BYE\r\n{tag} OK LOGOUT completed\r\n')
+                return
+            else:
+                self.write(self.pending_updates() + f'{tag} OK {command} completed\r\n')
+
+    def pending_updates(self):
+        with self.server.lock:
+            return self.exists_update()
+
+    def search(self, tag, args):
+        messages, max_uid = self.server.snapshot()
+        tokens = shlex.split(args.replace('CHARSET UTF-8', '').replace('(', ' ( ').replace(')', ' ) '))
+        predicate = _parse_criteria(tokens, max_uid)
+        hits = ' '.join(str(m.uid) for m in messages if predicate(m))
+        self.write(f'* SEARCH {hits}'.rstrip() + f'\r\n{self.pending_updates()}{tag} OK SEARCH completed\r\n')
+
+    def fetch(self, tag, args):
+        messages, max_uid = self.server.snapshot()
+        uid_set, _, items = args.partition(' ')
+        ranges = _parse_set(uid_set)
+        out = []
+        for seq, message in enumerate(messages, 1):
+            if not _in_set(message.uid, ranges, max_uid):
+                continue
+            response = f'* {seq} FETCH (UID {message.uid}'.encode()
+            for name in _SECTION_RE.findall(items):
+                data = message.section(name)
+                response += f' BODY[{name}] {{{len(data)}}}\r\n'.encode() + data
+            out.append(response + b')\r\n')
+        self.write(b''.join(out) + f'{self.pending_updates()}{tag} OK FETCH completed\r\n'.encode())
+
+    def store(self, tag, args):
+        messages, max_uid = self.server.snapshot()
+        uid_set, operation, flags = args.split(' ', 2)
+        ranges = _parse_set(uid_set)
+        flags = set(flags.strip('()').split())
+        for message in messages:
+            if _in_set(message.uid, ranges, max_uid):
+                if operation.startswith('+'):
+                    message.flags |= flags
+                else:
+                    message.flags -= flags
+        self.write(f'{self.pending_updates()}{tag} OK STORE completed\r\n')
+
+
+class BenchImapServer(socketserver.ThreadingTCPServer):
+    """Hộp thư IMAP trong bộ nhớ. deliver() thêm email và báo EXISTS cho các kết nối đang IDLE."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, uidvalidity=1):
+        super().__init__((host, port), _Handler)
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.idlers = []
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            messages = list(self.messages)
+        return messages, messages[-1].uid if messages else 0
+
+    def deliver(self, raw):
+        raw = raw.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        message = StoredMessage(0, raw)
+        with self.lock:
+            message.uid = self.messages[-1].uid + 1 if self.messages else 1
+            self.messages.append(message)
+            for handler in self.idlers:
+                try:
+                    handler.write(handler.exists_update())
+                except OSError:
+                    pass
+        return message.uid
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
@@ -0,0 +1,420 @@
+"""Benchmark chạy hoàn toàn cục bộ cho eWatcherBanking.
+
+Dựng server IMAP giả lập, ứng dụng giả lập cho APP_URL và Redis (fakeredis hoặc một DB Redis riêng), sau đó đo:
+
+- parse: tốc độ trích xuất chi tiết giao dịch (extract_transaction_details) trên bộ email sinh ngẫu nhiên
+- email_to_confirm: độ trễ từ lúc email tới hộp thư tới lúc APP_URL nhận request /confirm_transaction
+- http: p50/p99 của /create_transaction, /qrpay và /check_transaction_status (gọi trong process qua Flask test client)
+- expiry: thời gian xử lý giao dịch hết hạn theo kích thước lịch sử giao dịch
+
+Kết quả được ghi ra file JSON (--output) để so sánh giữa các phiên bản (--baseline).
+
+    python bench/run.py --quick
+    python bench/run.py --redis-url redis://localhost:6379/15 --flush-redis --output bench-results.json
+"""
+import argparse
+import email
+import importlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+APP_DIR = os.path.join(REPO_DIR, 'app')
+sys.path.insert(0, APP_DIR)
+
+from app_stub import AppStubServer  # noqa: E402
+from corpus import cake_alert_email, generate_corpus  # noqa: E402
+from imap_server import BenchImapServer  # noqa: E402
+
+API_KEY = 'bench-api-key'
+AUTH_HEADERS = {'Authorization': f'Bearer {API_KEY}'}
+BENCH_SENDER = 'no-reply@cake.vn'
+
+PROFILES = {
+    'full': {'parse_count': 5000, 'parse_repeat': 5, 'http_requests': 500, 'email_count': 200,
+             'history_sizes': [1000, 10000, 50000], 'expiry_due': 100},
+    'quick': {'parse_count': 1000, 'parse_repeat': 3, 'http_requests': 100, 'email_count': 30,
+              'history_sizes': [100, 1000, 5000], 'expiry_due': 50},
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Chạy với số lượng nhỏ (kiểm tra nhanh)')
+    parser.add_argument('--only', action='append', choices=['parse', 'http', 'email_to_confirm', 'expiry'],
+                        help='Chỉ chạy một số bài đo (có thể lặp lại)')
+    parser.add_argument('--redis-url', help='Dùng Redis thật, ví dụ redis://localhost:6379/15. Mặc định dùng fakeredis')
+    parser.add_argument('--flush-redis', action='store_true', help='Cho phép xóa toàn bộ DB Redis được chỉ định')
+    parser.add_argument('--email-mode', choices=['idle', 'poll'], default='idle')
+    parser.add_argument('--email-interval', type=float, default=0.02, help='Khoảng cách giữa hai email (giây)')
+    parser.add_argument('--parse-count', type=int)
+    parser.add_argument('--http-requests', type=int)
+    parser.add_argument('--email-count', type=int)
+    parser.add_argument('--history-sizes', help='Danh sách kích thước lịch sử, ví dụ 1000,10000,50000')
+    parser.add_argument('--expiry-due', type=int, help='Số giao dịch đến hạn trong mỗi lần đo expiry')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-results.json', help='File JSON ghi kết quả')
+    parser.add_argument('--baseline', help='File kết quả của lần chạy trước để so sánh')
+    parser.add_argument('--verbose', action='store_true', help='Giữ log INFO của ứng dụng')
+    args = parser.parse_args()
+
+    profile = PROFILES['quick' if args.quick else 'full']
+    for name, value in profile.items():
+        if getattr(args, name, None) is None:
+            setattr(args, name, value)
+    if isinstance(args.history_sizes, str):
+        args.history_sizes = [int(size) for size in args.history_sizes.split(',') if size]
+    return args
+
+
+def percentile(sorted_values, fraction):
+    """Percentile theo nearest-rank trên danh sách đã sắp xếp."""
+    if not sorted_values:
+        return None
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(samples):
+    """Thống kê độ trễ (giây) thành mili giây."""
+    values = sorted(samples)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p90_ms': round(percentile(values, 0.90) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+    }
+
+
+def use_fakeredis():
+    """Thay redis.Redis bằng fakeredis dùng chung một server trong process (phải gọi trước khi import main)."""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("Cần cài fakeredis và lupa (pip install -r bench/requirements.txt) hoặc dùng --redis-url")
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    class BenchRedis(fakeredis.FakeRedis):
+        def __init__(self, *args, **kwargs):
+            # main dựng pool kết nối riêng (redis_layer), fakeredis dùng pool của nó
+            for name in ('host', 'port', 'db', 'connection_pool'):
+                kwargs.pop(name, None)
+            super().__init__(*args, server=server, **kwargs)
+
+    redis.Redis = BenchRedis
+    redis.StrictRedis = BenchRedis
+
+
+def configure_environment(args, imap, app_stub):
+    os.environ.update({
+        'EMAIL_IMAP': '127.0.0.1',
+        'EMAIL_IMAP_PORT': str(imap.port),
+        'EMAIL_IMAP_SSL': 'false',
+        'EMAIL_USE_IDLE': 'true' if args.email_mode == 'idle' else 'false',
+        'EMAIL_POLL_INTERVAL': '1',
+        'EMAIL_LOGIN': 'bench@example.com',
+        'EMAIL_PASSWORD': 'bench',
+        'CAKE_EMAIL_SENDERS': BENCH_SENDER,
+        'API_KEY': API_KEY,
+        'APP_URL': app_stub.url,
+        'BACKGROUND_WORKERS_ENABLED': 'false',
+    })
+    if args.redis_url:
+        url = urlparse(args.redis_url)
+        os.environ['REDIS_HOST'] = url.hostname or 'localhost'
+        os.environ['REDIS_PORT'] = str(url.port or 6379)
+        os.environ['REDIS_DB'] = (url.path or '/0').lstrip('/') or '0'
+    else:
+        use_fakeredis()
+
+
+def reset_redis(app):
+    app.redis_client.flushdb()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_parse(app, args):
+    """Tốc độ extract_transaction_details trên nội dung email đã tách sẵn (lấy lần chạy nhanh nhất)."""
+    import email_parser
+
+    corpus = generate_corpus(args.parse_count, args.seed)
+    messages = [email.message_from_bytes(raw) for _, raw in corpus]
+    bodies = [email_parser.extract_body(msg) for msg in messages]
+
+    best = float('inf')
+    for _ in range(args.parse_repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            app.extract_transaction_details(body)
+        best = min(best, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for msg in messages:
+        app.extract_transaction_details(email_parser.extract_body(msg))
+    with_body = time.perf_counter() - start
+
+    return {
+        'emails': len(bodies),
+        'repeat': args.parse_repeat,
+        'emails_per_second': round(len(bodies) / best, 1),
+        'us_per_email': round(best / len(bodies) * 1e6, 3),
+        'with_extract_body_emails_per_second': round(len(messages) / with_body, 1),
+    }
+
+
+def timed_requests(call, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = call(i)
+        samples.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Request lỗi {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return samples
+
+
+def bench_http(app, args):
+    """p50/p99 của các endpoint chính, gọi tuần tự qua Flask test client (không tính chi phí mạng)."""
+    reset_redis(app)
+    client = app.app.test_client()
+    count = args.http_requests
+    codes = []
+
+    def create(i):
+        response = client.post('/create_transaction', headers=AUTH_HEADERS,
+                               json={'transaction_id': f'HTTP-{i}', 'amount': 10000 + i})
+        codes.append(response.get_json().get('code'))
+        return response
+
+    def check(i):
+        return client.get('/check_transaction_status', headers=AUTH_HEADERS, query_string={'code': codes[i]})
+
+    qrpay_body = {'purpose': 'NT0900000000'}
+    etag = client.post('/qrpay', json=qrpay_body).headers.get('ETag')
+
+    def qrpay(i):
+        return client.post('/qrpay', json=qrpay_body)
+
+    def qrpay_not_modified(i):
+        return client.post('/qrpay', json=qrpay_body, headers={'If-None-Match': etag})
+
+    def qrpay_uncached(i):
+        # Mỗi request một purpose khác nhau nên phải render ảnh mới
+        return client.post('/qrpay', json={'purpose': f'NT{i:010d}'})
+
+    warmup = min(10, count)
+    timed_requests(create, warmup)
+    del codes[:]
+
+    results = {}
+    for name, call in (('/create_transaction', create),
+                       ('/check_transaction_status', check),
+                       ('/qrpay', qrpay),
+                       ('/qrpay (If-None-Match)', qrpay_not_modified),
+                       ('/qrpay (uncached)', qrpay_uncached)):
+        start = time.perf_counter()
+        samples = timed_requests(call, count)
+        elapsed = time.perf_counter() - start
+        results[name] = dict(summarize(samples), requests_per_second=round(count / elapsed, 1))
+    return results
+
+
+def wait_until(predicate, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def bench_email_to_confirm(app, args, imap, app_stub):
+    """Độ trễ từ khi email tới hộp thư tới khi APP_URL nhận /confirm_transaction."""
+    reset_redis(app)
+    client = app.app.test_client()
+    transactions = []
+    for i in range(args.email_count):
+        response = client.post('/create_transaction', headers=AUTH_HEADERS,
+                               json={'transaction_id': f'E2E-{i}', 'amount': 20000 + i})
+        transactions.append((f'E2E-{i}', response.get_json()['code'], 20000 + i))
+
+    running = threading.Event()
+    running.set()
+    for target in (app.email_processing_thread, app.webhook_dispatcher.run):
+        threading.Thread(target=target, args=(running.is_set,), daemon=True).start()
+
+    if args.email_mode == 'idle' and not wait_until(lambda: imap.idlers, timeout=10):
+        running.clear()
+        raise RuntimeError("Luồng xử lý email không vào trạng thái IDLE")
+
+    sent = {}
+    for transaction_id, code, amount in transactions:
+        raw = cake_alert_email(amount, f'{code} chuyen tien', sender=BENCH_SENDER)
+        sent[transaction_id] = time.perf_counter()
+        imap.deliver(raw)
+        time.sleep(args.email_interval)
+
+    received = app_stub.wait_for(sent, timeout=30 + args.email_count * 0.1)
+    running.clear()
+
+    latencies = [received[key] - sent[key] for key in received]
+    return dict(summarize(latencies), mode=args.email_mode, sent=len(sent), missing=len(sent) - len(received),
+                interval_s=args.email_interval)
+
+
+def populate_history(app, size, due, now):
+    """Tạo size giao dịch đã hoàn tất trong lịch sử và due giao dịch pending đã quá hạn."""
+    store = app.transaction_store
+    pipe = app.redis_client.pipeline(transaction=False)
+    for i in range(size):
+        store.add({'type': 'transaction', 'status': 'completed', 'transaction_id': f'H-{i}', 'amount': '10000',
+                   'code': f'VCDH{i:09d}'}, record_id=f'VCDH{i:09d}', created_at=now - size + i, pipe=pipe)
+        if i % 1000 == 999:
+            pipe.execute()
+    for i in range(due):
+        code = f'VCDD{i:09d}'
+        pipe.hset(f"{app.PENDING_TRANSACTION_PREFIX}{code}", mapping={
+            'transaction_id': f'D-{i}', 'amount': '10000', 'timestamp': int(now) - 700, 'type': 'receive',
+            'status': 'pending'})
+        app.pending_deadlines.add(code, now - 1, pipe=pipe)
+        store.add({'type': 'transaction', 'status': 'pending', 'transaction_id': f'D-{i}', 'amount': '10000',
+                   'code': code}, created_at=now - 700, pipe=pipe)
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+
+
+def bench_expiry(app, args):
+    """Thời gian chuyển due giao dịch quá hạn sang expired, với lịch sử giao dịch có kích thước khác nhau."""
+    results = []
+    for size in args.history_sizes:
+        reset_redis(app)
+        now = time.time()
+        start = time.perf_counter()
+        populate_history(app, size, args.expiry_due, now)
+        populate_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expired = app.expire_due_transactions()
+        expire_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        app.reconcile_pending_history()
+        reconcile_seconds = time.perf_counter() - start
+
+        remaining = len(app.transaction_store.ids_by_status('pending'))
+        results.append({
+            'history_size': size,
+            'due': args.expiry_due,
+            'expired': expired,
+            'pending_left': remaining,
+            'expire_ms': round(expire_seconds * 1000, 3),
+            'reconcile_ms': round(reconcile_seconds * 1000, 3),
+            'populate_s': round(populate_seconds, 3),
+        })
+    return results
+
+
+def flatten(value, prefix=''):
+    """Làm phẳng kết quả thành {đường.dẫn: số} để so sánh với baseline."""
+    items = {}
+    if isinstance(value, dict):
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}{key}."))
+    elif isinstance(value, list):
+        for child in value:
+            label = child.get('history_size', '') if isinstance(child, dict) else ''
+            items.update(flatten(child, f"{prefix}{label}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        items[prefix.rstrip('.')] = value
+    return items
+
+
+def compare(results, baseline):
+    """Tỉ lệ thay đổi (%) của các chỉ số đo thời gian/tốc độ so với baseline."""
+    current = flatten(results)
+    previous = flatten(baseline.get('results', {}))
+    changes = {}
+    for key, value in current.items():
+        metric = key.rsplit('.', 1)[-1]
+        if key in previous and previous[key] and (metric.endswith(('_ms', '_per_second')) or metric == 'us_per_email'):
+            changes[key] = round((value - previous[key]) / previous[key] * 100, 1)
+    return changes
+
+
+def main():
+    args = parse_args()
+
+    imap = BenchImapServer().start()
+    app_stub = AppStubServer().start()
+    configure_environment(args, imap, app_stub)
+
+    app = importlib.import_module('main')
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    if args.redis_url and app.redis_client.dbsize() and not args.flush_redis:
+        sys.exit(f"DB Redis {args.redis_url} không rỗng, thêm --flush-redis để cho phép xóa dữ liệu khi benchmark")
+
+    benchmarks = {
+        'parse': lambda: bench_parse(app, args),
+        'http': lambda: bench_http(app, args),
+        'expiry': lambda: bench_expiry(app, args),
+        # Chạy cuối cùng vì để lại các luồng nền
+        'email_to_confirm': lambda: bench_email_to_confirm(app, args, imap, app_stub),
+    }
+    results = {}
+    for name, run in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        print(f"== {name}", flush=True)
+        results[name] = run()
+        print(json.dumps(results[name], indent=2, ensure_ascii=False), flush=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redis': args.redis_url or 'fakeredis',
+            'profile': 'quick' if args.quick else 'full',
+            'email_mode': args.email_mode,
+        },
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(results, json.load(f))
+        print("== so sánh với baseline (%)")
+        print(json.dumps(report['comparison'], indent=2, ensure_ascii=False))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Đã ghi kết quả vào {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import importlib
+import os
+import sys
+
+import fakeredis
+import pytest
+
+# Các module của ứng dụng nằm phẳng trong app/ (giống WORKDIR của Docker image)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+# Server IMAP giả lập và bộ sinh email của bench/ được dùng làm fixture
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+
+@pytest.fixture
+def redis_server():
+    """Server Redis giả lập trong bộ nhớ, mỗi test một server riêng."""
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_client(redis_server):
+    """Client đồng bộ tới redis_server (fakeredis + lupa để chạy Lua script)."""
+    return fakeredis.FakeRedis(server=redis_server)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Đồng hồ điều khiển được cho các module đọc time.time()."""
+    class Clock:
+        now = 1_700_000_000.0
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr('time.time', lambda: clock.now)
+    return clock
+
+
+@pytest.fixture
+def main(monkeypatch, redis_client):
+    """Module main (ứng dụng Flask) dùng redis_client giả lập, không chạy luồng nền."""
+    import redis_layer
+
+    monkeypatch.setenv('API_KEY', 'test-key')
+    monkeypatch.setenv('BACKGROUND_WORKERS_ENABLED', 'false')
+    monkeypatch.setattr(redis_layer.RedisSettings, 'create_clients',
+                        lambda self, redis_class=None: (redis_client, redis_client))
+    sys.modules.pop('main', None)
+    module = importlib.import_module('main')
+    yield module
+    sys.modules.pop('main', None)
+
+
+@pytest.fixture
+def imap_server():
+    """Server IMAP giả lập (bench/imap_server.py) trên một cổng ngẫu nhiên."""
+    from imap_server import BenchImapServer
+
+    server = BenchImapServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
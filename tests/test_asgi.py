@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+
+import fakeredis
+import pytest
+from starlette.testclient import TestClient
+
+from corpus import cake_alert_text
+
+AUTH = {'Authorization': 'Bearer test-key'}
+
+
+@pytest.fixture
+def asgi(main, monkeypatch, redis_server):
+    """Module asgi dùng redis.asyncio giả lập trên cùng server với main.redis_client."""
+    import asgi
+
+    monkeypatch.setattr(main.redis_settings, 'create_async_clients', lambda **kwargs: (
+        fakeredis.FakeAsyncRedis(server=redis_server), fakeredis.FakeAsyncRedis(server=redis_server)))
+    monkeypatch.setattr(asgi, 'main', main)
+    return asgi
+
+
+@pytest.fixture
+def client(asgi):
+    # Dùng with để chạy lifespan (tạo pool, hub, executor) trên event loop của TestClient
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def create_transaction(client, transaction_id='order-1', amount=50_000):
+    response = client.post('/create_transaction', json={'transaction_id': transaction_id, 'amount': amount},
+                           headers=AUTH)
+    assert response.status_code == 201
+    return response.json()['code']
+
+
+def pay_later(main, code, amount=50_000, delay=0.3):
+    """Xử lý email chuyển khoản cho code sau delay giây bằng luồng đồng bộ của main.py."""
+    timer = threading.Timer(delay, main.handle_email, args=(f'pay-{code}', cake_alert_text(amount, f'CK {code}')))
+    timer.start()
+    return timer
+
+
+def test_created_transaction_is_shared_with_sync_app(main, client, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert client.post('/create_transaction', json={'transaction_id': 'order-1', 'amount': 1}).status_code == 401
+
+    response = client.post('/create_transaction', json={'transaction_id': 'order-1', 'amount': 50_000,
+                                                        'format': 'svg'}, headers=AUTH)
+    assert response.status_code == 201
+    body = response.json()
+    assert body['qr_code_format'] == 'svg' and body['qr_code_data']
+    # Ảnh QR chỉ được render trong bộ nhớ
+    assert list(tmp_path.iterdir()) == []
+
+    assert main.transaction_status_response(body['code'])['status'] == 'pending'
+    response = client.get('/check_transaction_status', params={'code': body['code']}, headers=AUTH)
+    assert response.json()['status'] == 'pending'
+    assert response.json()['transaction_id'] == 'order-1'
+    assert client.get('/check_transaction_status', params={'code': 'VCD0'}, headers=AUTH).status_code == 404
+
+
+def test_long_poll_wakes_up_on_status_published_by_sync_app(main, client):
+    code = create_transaction(client)
+    timer = pay_later(main, code)
+
+    started = time.monotonic()
+    response = client.get('/check_transaction_status', params={'code': code, 'wait': 10}, headers=AUTH)
+    timer.join()
+
+    assert response.json()['status'] == 'completed'
+    assert time.monotonic() - started < 5
+    assert client.get('/check_transaction_status', params={'code': code, 'wait': 'soon'},
+                      headers=AUTH).status_code == 400
+
+
+def test_status_stream_ends_at_final_status(asgi, main, client):
+    code = create_transaction(client)
+    timer = pay_later(main, code)
+
+    with client.stream('GET', '/transaction_status/stream', params={'code': code}, headers=AUTH) as response:
+        assert response.headers['content-type'].startswith('text/event-stream')
+        events = [json.loads(line[len('data: '):]) for line in response.iter_lines() if line.startswith('data: ')]
+    timer.join()
+
+    assert [event['status'] for event in events] == ['pending', 'completed']
+    assert asgi.app.state.status_hub.waiters == {}
+
+
+def test_history_pages_and_ndjson_stream(main, client):
+    for index in range(5):
+        main.transaction_store.add({'type': 'transaction', 'status': 'completed', 'code': f'H{index}'},
+                                   created_at=1_700_000_000 + index)
+
+    seen, cursor = [], None
+    while True:
+        response = client.get('/transaction_history', params={'limit': 2, **({'cursor': cursor} if cursor else {})},
+                              headers=AUTH)
+        page = response.json()
+        seen.extend(transaction['code'] for transaction in page['transactions'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == ['H0', 'H1', 'H2', 'H3', 'H4']
+
+    response = client.get('/transaction_history', params={'status': 'completed'}, headers=AUTH)
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert [json.loads(line)['code'] for line in response.text.splitlines()] == seen
+    assert client.get('/transaction_history', params={'status': 'failed'}, headers=AUTH).status_code == 404
+    assert client.get('/transaction_history', params={'limit': 0}, headers=AUTH).status_code == 400
+
+
+def test_qrpay_and_health(client):
+    query = {'account_number': '0123456789', 'purpose': 'NT0900000000'}
+    response = client.post('/qrpay', json=query)
+    assert response.status_code == 200 and response.content.startswith(b'\x89PNG')
+    assert client.post('/qrpay', json=query, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    health = client.get('/health')
+    assert health.status_code == 200
+    assert health.json()['redis'] is True
+
+
+@pytest.mark.parametrize('enabled', [False, True])
+def test_lifespan_starts_background_workers_only_when_enabled(asgi, main, monkeypatch, enabled):
+    started = []
+    monkeypatch.setattr(asgi, 'BACKGROUND_WORKERS_ENABLED', enabled)
+    monkeypatch.setattr(main, 'start', lambda: started.append(True))
+
+    with TestClient(asgi.app) as client:
+        assert client.get('/health').json()['background_workers'] is enabled
+    assert started == ([True] if enabled else [])
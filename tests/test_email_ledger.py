@@ -0,0 +1,109 @@
+import pytest
+
+from email_ledger import EmailLedger, message_key
+
+
+@pytest.fixture
+def ledger(redis_client):
+    return EmailLedger(redis_client, claim_timeout=300, max_attempts=2, retry_backoff=60)
+
+
+def test_claim_is_exclusive_until_claim_timeout(ledger, clock):
+    assert ledger.claim('m1', 'body', 'cake')
+    assert not ledger.claim('m1', 'body', 'cake')
+
+    clock.advance(301)
+    # Tiến trình giữ quyền đã dừng giữa chừng: email được nhận lại để xử lý
+    assert ledger.claim('m1', 'body', 'cake')
+    assert ledger.status('m1') == 'claimed'
+
+
+def test_claimed_email_is_scheduled_for_retry_after_claim_timeout(ledger, clock):
+    ledger.claim('m1', 'body', 'cake')
+
+    assert ledger.due_entries() == []
+    clock.advance(300)
+    assert ledger.due_entries() == [('m1', 'body', 'cake')]
+
+
+def test_processed_email_is_never_claimed_again(ledger, redis_client, clock):
+    ledger.claim('m1', 'body')
+    pipe = redis_client.pipeline()
+    ledger.mark_processed('m1', pipe=pipe)
+    assert ledger.status('m1') == 'claimed'
+    pipe.execute()
+
+    clock.advance(3600)
+    assert not ledger.claim('m1', 'body')
+    assert ledger.status('m1') == 'processed'
+    assert ledger.due_entries() == []
+    # Nội dung email không còn cần cho việc xử lý lại
+    assert redis_client.hget(ledger.entry_key('m1'), 'body') is None
+
+
+def test_failed_email_is_retried_with_backoff_then_dead(ledger, clock):
+    owner = ledger.claim('m1', 'body', 'cake')
+    assert ledger.mark_failed('m1', ValueError('boom'), owner) == 'failed'
+    assert ledger.status('m1') == 'failed'
+    assert ledger.due_entries() == []
+
+    clock.advance(60)
+    assert ledger.due_entries() == [('m1', 'body', 'cake')]
+    owner = ledger.claim('m1', 'body', 'cake')
+    assert ledger.mark_failed('m1', ValueError('boom'), owner) == 'dead'
+
+    assert ledger.status('m1') == 'dead'
+    clock.advance(3600)
+    assert ledger.due_entries() == []
+    assert not ledger.claim('m1', 'body', 'cake')
+
+
+def test_mark_failed_does_not_undo_a_processed_email(ledger, redis_client, clock):
+    owner = ledger.claim('m1', 'body')
+    # MULTI/EXEC đã chạy trên server nhưng client báo lỗi (ví dụ timeout) và gọi mark_failed
+    ledger.mark_processed('m1')
+
+    assert ledger.mark_failed('m1', TimeoutError('timeout'), owner) is None
+    assert ledger.status('m1') == 'processed'
+    clock.advance(3600)
+    assert ledger.due_entries() == []
+    assert not ledger.claim('m1', 'body')
+
+
+def test_mark_failed_of_a_stale_claim_keeps_the_new_owner(ledger, clock):
+    slow = ledger.claim('m1', 'body')
+    clock.advance(301)
+    current = ledger.claim('m1', 'body')
+    assert current and current != slow
+
+    # Lượt xử lý chậm báo lỗi sau khi email đã được nhận lại
+    assert ledger.mark_failed('m1', ValueError('late'), slow) is None
+    assert ledger.status('m1') == 'claimed'
+    ledger.mark_processed('m1')
+    assert ledger.mark_failed('m1', ValueError('late'), slow) is None
+    assert ledger.status('m1') == 'processed'
+
+
+def test_claims_in_the_same_process_get_distinct_owners(ledger, redis_client, clock):
+    first = ledger.claim('m1', 'body')
+    clock.advance(301)
+    second = ledger.claim('m1', 'body')
+
+    assert first.startswith(ledger.owner) and second.startswith(ledger.owner)
+    assert first != second
+    assert redis_client.hget(ledger.entry_key('m1'), 'owner').decode() == second
+
+
+def test_statuses_reads_many_entries(ledger):
+    ledger.claim('m1', 'body')
+    ledger.mark_processed('m1')
+    ledger.claim('m2', 'body')
+
+    assert ledger.statuses(['m1', 'm2', 'm3']) == ['processed', 'claimed', None]
+
+
+def test_message_key_prefers_message_id():
+    assert message_key(' <id@bank> ', 'body') == '<id@bank>'
+    assert message_key(None, 'body') == message_key('', 'body')
+    assert message_key(None, 'body').startswith('sha256:')
+    assert message_key(None, 'body') != message_key(None, 'other body')
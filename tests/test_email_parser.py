@@ -0,0 +1,105 @@
+import email
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pytest
+
+import email_parser
+from corpus import cake_alert_email, cake_alert_html, cake_alert_text, generate_corpus
+
+WHEN = datetime(2024, 5, 6, 7, 8)
+
+
+def body_of(raw):
+    return email_parser.extract_body(email.message_from_bytes(raw))
+
+
+@pytest.mark.parametrize('kind', ['plain', 'html', 'multipart'])
+@pytest.mark.parametrize('charset', ['utf-8', 'utf-16'])
+def test_extracts_transaction_from_every_body_format(kind, charset):
+    raw = cake_alert_email(1_250_000, 'VCD0123456789 chuyen tien', WHEN, kind=kind, charset=charset)
+
+    details = email_parser.parse(body_of(raw))
+
+    assert details['amount_increased'] == '1250000'
+    assert details['amount_decreased'] is None
+    assert details['current_balance'] == '10000000'
+    assert details['time'] == '2024-05-06T07:08:00+07:00'
+    assert details['description'] == 'VCD0123456789 chuyen tien'
+    assert details['code'] == 'VCD0123456789'
+    assert details['phone_number'] is None
+
+
+def test_fields_after_the_description_on_the_same_line_are_found():
+    body = 'Mô tả: VCD0123456789 chuyen tien vừa tăng 50,000 VND vào 06/05/2024 07:08 Số dư hiện tại: 90,000 VND'
+
+    details = email_parser.parse(body)
+
+    assert details['description'].startswith('VCD0123456789 chuyen tien vừa tăng 50,000 VND')
+    assert details['code'] == 'VCD0123456789'
+    assert details['amount_increased'] == '50000'
+    assert details['time'] == '2024-05-06T07:08:00+07:00'
+    assert details['current_balance'] == '90000'
+
+
+def test_multipart_prefers_the_plain_text_part():
+    raw = cake_alert_email(1000, 'VCD0123456789', WHEN, kind='multipart')
+
+    assert body_of(raw) == cake_alert_text(1000, 'VCD0123456789', WHEN)
+
+
+def test_unknown_charset_is_decoded_as_utf8():
+    raw = cake_alert_email(1000, 'VCD0123456789', WHEN).replace(b'charset="utf-8"', b'charset="x-unknown"')
+
+    assert email_parser.parse(body_of(raw))['amount_increased'] == '1000'
+
+
+def test_email_without_text_part_has_no_body():
+    msg = email.message_from_string('Content-Type: image/png\n\nPNG')
+
+    assert email_parser.extract_body(msg) is None
+
+
+def test_html_body_is_detected_without_content_type():
+    html = cake_alert_html(cake_alert_text(2000, 'NT0900000001 nap tien', WHEN, increased=False))
+
+    details = email_parser.parse(html)
+
+    assert details['amount_decreased'] == '2000'
+    assert details['phone_number'] == 'NT0900000001'
+    assert details['code'] is None
+
+
+def test_missing_fields_are_none_and_bad_time_is_kept():
+    details = email_parser.parse('Tài khoản của bạn vừa tăng 5.000 VND vào 99/99/2024 25:61\nMô tả: hello')
+
+    assert details['amount_increased'] == '5000'
+    assert details['time'] == '99/99/2024 25:61'
+    assert details['current_balance'] is None
+    assert details['code'] is None and details['phone_number'] is None
+
+
+def test_parse_many_keeps_order_with_and_without_executor():
+    bodies = [body_of(raw) for _, raw in generate_corpus(40, seed=3)]
+    expected = [email_parser.parse(body) for body in bodies]
+
+    assert email_parser.parse_many(bodies) == expected
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert email_parser.parse_many(bodies, executor=executor, chunksize=7) == expected
+
+
+def test_registered_parser_is_selected_by_name():
+    class OtherBankParser(email_parser.BankAlertParser):
+        name = 'other-bank'
+        pattern = re.compile(r"\+(?P<amount_increased>[\d,]+)d|ND: (?P<description>[^\n]+)")
+        amount_fields = ('amount_increased',)
+
+    email_parser.register_parser(OtherBankParser())
+    try:
+        details = email_parser.parse('+1,500d\nND: VCD0000000042', parser='other-bank')
+    finally:
+        email_parser.PARSERS.pop('other-bank')
+
+    assert details['amount_increased'] == '1500'
+    assert details['code'] == 'VCD0000000042'
@@ -0,0 +1,183 @@
+import threading
+import time
+
+import pytest
+
+from corpus import cake_alert_email
+from email_watcher import (ImapIdleWatcher, UidHighWaterMark, fetch_new_messages, format_uid_set,
+                           open_imap_connection)
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class RecordingHealth:
+    def __init__(self):
+        self.events = []
+
+    def succeeded(self):
+        self.events.append('ok')
+
+    def failed(self, error, retry_in):
+        self.events.append(('error', retry_in))
+
+
+@pytest.fixture
+def run_watcher(imap_server):
+    """Chạy ImapIdleWatcher trên thread riêng, ghi lại UID các email chưa đọc mỗi lần on_new_mail được gọi."""
+    started = []
+
+    def run(idle=True, connect=None, **kwargs):
+        seen = []
+
+        def on_new_mail(mail):
+            _, data = mail.uid('SEARCH', None, 'UNSEEN')
+            uids = data[0].split()
+            if uids:
+                mail.uid('STORE', b','.join(uids).decode(), '+FLAGS.SILENT', '(\\Seen)')
+            seen.append([int(uid) for uid in uids])
+
+        def default_connect():
+            mail = open_imap_connection('127.0.0.1', imap_server.port, use_ssl=False, timeout=5)
+            if not idle:
+                mail.capabilities = tuple(c for c in mail.capabilities if c != 'IDLE')
+            return mail
+
+        watcher = ImapIdleWatcher(connect or default_connect, 'user', 'secret', on_new_mail, **kwargs)
+        thread = threading.Thread(target=watcher.run, daemon=True)
+        thread.start()
+        started.append((watcher, thread))
+        return watcher, seen
+
+    yield run
+    for watcher, thread in started:
+        watcher.stop()
+        thread.join(5)
+
+
+def test_idle_processes_new_mail_as_soon_as_server_reports_it(imap_server, run_watcher):
+    imap_server.deliver(cake_alert_email(10_000, 'VCD0000000001'))
+    watcher, seen = run_watcher(poll_interval=3600)
+    # Email có sẵn được xử lý ngay sau khi kết nối
+    assert wait_until(lambda: seen and seen[0] == [1])
+
+    # Không chờ poll_interval: server báo EXISTS trong lúc IDLE
+    time.sleep(0.2)
+    uid = imap_server.deliver(cake_alert_email(20_000, 'VCD0000000002'))
+    assert wait_until(lambda: [uid] in seen, timeout=2)
+
+
+def test_falls_back_to_polling_when_server_has_no_idle(imap_server, run_watcher, monkeypatch):
+    monkeypatch.setattr(ImapIdleWatcher, 'idle', lambda self, mail, timeout: pytest.fail('IDLE không được hỗ trợ'))
+    watcher, seen = run_watcher(idle=False, poll_interval=0.1)
+    assert wait_until(lambda: len(seen) >= 1)
+
+    uid = imap_server.deliver(cake_alert_email(10_000, 'VCD0000000001'))
+    assert wait_until(lambda: [uid] in seen)
+    # Mỗi lượt kiểm tra định kỳ gọi lại on_new_mail trên cùng kết nối
+    assert wait_until(lambda: len(seen) >= 4)
+
+
+def test_reconnects_with_backoff_and_reports_health(imap_server, run_watcher):
+    attempts = []
+
+    def flaky_connect():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise ConnectionRefusedError('server chưa sẵn sàng')
+        return open_imap_connection('127.0.0.1', imap_server.port, use_ssl=False, timeout=5)
+
+    health = RecordingHealth()
+    watcher, seen = run_watcher(connect=flaky_connect, initial_backoff=0.05, max_backoff=0.1, health=health)
+
+    assert wait_until(lambda: seen)
+    assert health.events[:3] == [('error', 0.05), ('error', 0.1), 'ok']
+    assert attempts[2] - attempts[1] >= 0.1
+
+
+@pytest.fixture
+def mailbox(imap_server):
+    mail = open_imap_connection('127.0.0.1', imap_server.port, use_ssl=False, timeout=5)
+    mail.login('user', 'secret')
+    mail.select('inbox')
+    yield mail
+    mail.logout()
+
+
+def test_fetches_in_uid_batches_and_persists_high_water_mark(imap_server, mailbox, redis_client, monkeypatch):
+    uids = [imap_server.deliver(cake_alert_email(1000 * n, f'VCD{n:010d}')) for n in range(1, 6)]
+    imap_server.deliver(cake_alert_email(1, 'VCD9999999999', sender='someone@example.com'))
+    high_water_mark = UidHighWaterMark(redis_client, 'user', 'inbox')
+    fetches = []
+    uid_command = mailbox.uid
+
+    def recording_uid(command, *args):
+        if command == 'FETCH':
+            fetches.append(args[0])
+        return uid_command(command, *args)
+
+    monkeypatch.setattr(mailbox, 'uid', recording_uid)
+
+    messages = fetch_new_messages(mailbox, ['no-reply@cake.vn'], high_water_mark, batch_size=2)
+    fetched = [(uid, msg['From']) for uid, msg in messages]
+
+    assert [uid for uid, _ in fetched] == uids
+    assert {sender for _, sender in fetched} == {'no-reply@cake.vn'}
+    assert fetches == ['1:2', '3:4', '5']
+    assert high_water_mark.get(imap_server.uidvalidity) == uids[-1]
+    # Email của người gửi khác không bị đánh dấu đã đọc
+    assert [m.uid for m in imap_server.messages if '\\Seen' not in m.flags] == [6]
+
+
+def test_unfinished_batch_is_fetched_again(imap_server, mailbox, redis_client):
+    for n in range(1, 4):
+        imap_server.deliver(cake_alert_email(1000, f'VCD{n:010d}'))
+    high_water_mark = UidHighWaterMark(redis_client, 'user', 'inbox')
+
+    messages = fetch_new_messages(mailbox, [], high_water_mark, batch_size=2)
+    assert next(messages)[0] == 1
+    messages.close()
+
+    assert high_water_mark.get(imap_server.uidvalidity) == 0
+    assert [uid for uid, _ in fetch_new_messages(mailbox, [], high_water_mark, batch_size=2)] == [1, 2, 3]
+    assert list(fetch_new_messages(mailbox, [], high_water_mark)) == []
+
+
+def test_high_water_mark_resets_when_uidvalidity_changes(redis_client):
+    high_water_mark = UidHighWaterMark(redis_client, 'user', 'inbox')
+    high_water_mark.set(7, 120)
+
+    assert high_water_mark.get(7) == 120
+    assert high_water_mark.get(8) == 0
+
+
+def test_unavailable_high_water_mark_falls_back_to_unseen(imap_server, mailbox, redis_server, redis_client):
+    import redis
+
+    uids = [imap_server.deliver(cake_alert_email(1000, f'VCD{n:010d}')) for n in range(1, 3)]
+    strict = UidHighWaterMark(redis_client, 'user', 'inbox')
+    tolerant = UidHighWaterMark(redis_client, 'user', 'inbox', tolerate_errors=(redis.exceptions.ConnectionError,))
+    redis_server.connected = False
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        list(fetch_new_messages(mailbox, [], strict))
+    assert [uid for uid, _ in fetch_new_messages(mailbox, [], tolerant)] == uids
+    assert [m.uid for m in imap_server.messages if '\\Seen' not in m.flags] == []
+
+    redis_server.connected = True
+    assert tolerant.get(imap_server.uidvalidity) == 0
+
+
+@pytest.mark.parametrize('uids, expected', [
+    ([1, 2, 3, 7], '1:3,7'),
+    ([9, 4, 5, 5], '4:5,9'),
+    ([42], '42'),
+])
+def test_format_uid_set(uids, expected):
+    assert format_uid_set(uids) == expected
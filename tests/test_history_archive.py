@@ -0,0 +1,100 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import history_archive
+from history_archive import HistoryArchive, IdFilter
+
+DAY = 24 * 3600
+# Giữa trưa giờ địa phương để mọi bản ghi trong một ngày thử nghiệm nằm cùng một thư mục ngày
+NOON = datetime(2024, 1, 10, 12).timestamp()
+
+
+def record(code, status='completed', **fields):
+    return {'code': code, 'status': status, 'type': 'transaction', **fields}
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return HistoryArchive(str(tmp_path), index_cache_days=2, merge_segments=3, small_segment=100)
+
+
+def test_get_returns_latest_copy_and_skips_days_without_the_id(archive, monkeypatch):
+    archive.write([(NOON + day * DAY, f'C{day}', record(f'C{day}')) for day in range(5)])
+    # Bản ghi được lưu trữ lại (tiến trình dừng trước khi xóa khỏi Redis) với trạng thái mới
+    archive.write([(NOON + 2 * DAY, 'C2', record('C2', status='refunded'))])
+
+    loaded = []
+    read_day_index = archive._read_day_index
+    monkeypatch.setattr(archive, '_read_day_index', lambda day: loaded.append(day) or read_day_index(day))
+
+    assert archive.get('C2')['status'] == 'refunded'
+    assert archive.get('C4')['code'] == 'C4'
+    assert loaded == ['2024-01-12', '2024-01-14']
+    # Code không có trong archive chỉ được kiểm tra qua bloom filter của từng ngày
+    assert all(archive.get(f'MISS{index}') is None for index in range(20))
+    assert len(loaded) <= 3
+
+
+def test_day_index_cache_is_bounded(archive):
+    archive.write([(NOON + day * DAY, f'C{day}', record(f'C{day}')) for day in range(6)])
+
+    for day in range(6):
+        assert archive.get(f'C{day}')['code'] == f'C{day}'
+    assert list(archive.day_indexes) == ['2024-01-14', '2024-01-15']
+
+
+def test_small_segments_are_merged(archive, tmp_path):
+    for batch in range(3):
+        archive.write([(NOON + batch * 10 + index, f'B{batch}-{index}', record(f'B{batch}-{index}'))
+                       for index in range(3)])
+    archive.write([(NOON + 1, 'B0-1', record('B0-1', status='refunded'))])
+
+    segments = [name for name in os.listdir(tmp_path / '2024-01-10') if name.endswith(history_archive.SEGMENT_SUFFIX)]
+    assert len(segments) == 2
+    assert archive.get('B0-1')['status'] == 'refunded'
+    codes = [record_id for _, record_id, _ in archive.scan()]
+    assert codes == ['B0-0', 'B0-1', 'B0-2', 'B1-0', 'B1-1', 'B1-2', 'B2-0', 'B2-1', 'B2-2']
+
+
+def test_scan_returns_each_record_once_in_order_with_filters(archive):
+    archive.write([(NOON + index, f'A{index}', record(f'A{index}', transaction_id=f'order-{index % 2}'))
+                   for index in range(4)])
+    archive.write([(NOON + DAY + index, f'D{index}', record(f'D{index}', status='expired')) for index in range(2)])
+    archive.write([(NOON + 1, 'A1', record('A1', status='refunded', transaction_id='order-1'))])
+
+    assert [(score - NOON, record_id) for score, record_id, _ in archive.scan()] == [
+        (0, 'A0'), (1, 'A1'), (2, 'A2'), (3, 'A3'), (DAY, 'D0'), (DAY + 1, 'D1')]
+    assert [r for _, r, _ in archive.scan({'transaction_id': 'order-1'})] == ['A1', 'A3']
+    assert [r for _, r, _ in archive.scan(status='refunded')] == ['A1']
+    assert [r for _, r, _ in archive.scan(min_score=NOON + 2, max_score=NOON + DAY)] == ['A2', 'A3', 'D0']
+    assert [r for _, r, _ in archive.scan(after=(NOON + 3, 'A3'))] == ['D0', 'D1']
+
+
+def test_other_process_sees_new_writes_and_merged_segments(archive, tmp_path, monkeypatch):
+    reader = HistoryArchive(str(tmp_path), merge_segments=3, small_segment=100)
+    assert reader.get('X0') is None
+
+    archive.write([(NOON, 'X0', record('X0'))])
+    assert reader.get('X0')['code'] == 'X0'
+    archive.write([(NOON + 1, 'X1', record('X1'))])
+    assert reader.get('X1')['code'] == 'X1'
+
+    # Lần ghi thứ ba gộp các segment nhỏ và xóa file mà chỉ mục reader đang cache trỏ tới; reader chưa kịp thấy
+    # manifest mới nên phải tự đọc lại chỉ mục khi không tìm thấy segment
+    stale_manifest = reader._load_manifest()
+    archive.write([(NOON + 2, 'X2', record('X2'))])
+    history_archive.read_segment.cache_clear()
+    monkeypatch.setattr(reader, '_load_manifest', lambda: stale_manifest)
+    assert reader.get('X1')['code'] == 'X1'
+    monkeypatch.undo()
+    assert [r for _, r, _ in reader.scan()] == ['X0', 'X1', 'X2']
+
+
+def test_id_filter_round_trips_without_false_negatives():
+    ids = [f'VCD{index}' for index in range(1000)]
+    id_filter = IdFilter.from_bytes(IdFilter.build(ids).to_bytes())
+
+    assert all(record_id in id_filter for record_id in ids)
+    assert sum(f'OTHER{index}' in id_filter for index in range(1000)) < 50
@@ -0,0 +1,151 @@
+import threading
+
+import pytest
+
+from leader_election import LeaderElector, LeaderLease
+
+
+@pytest.fixture
+def monotonic(monkeypatch):
+    """Đồng hồ monotonic điều khiển được cho hạn lease."""
+    class Monotonic:
+        now = 1000.0
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Monotonic()
+    monkeypatch.setattr('time.monotonic', lambda: clock.now)
+    return clock
+
+
+def test_only_one_instance_holds_a_lease(redis_client, monotonic):
+    first = LeaderLease(redis_client, 'task', 'a', ttl=30)
+    second = LeaderLease(redis_client, 'task', 'b', ttl=30)
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.is_held() and not second.is_held()
+    assert second.holder() == 'a'
+
+    first.release()
+    assert not first.is_held()
+    assert second.acquire()
+    assert first.holder() == 'b'
+
+
+def test_lease_is_lost_when_it_expires_before_renewal(redis_client, monotonic):
+    lease = LeaderLease(redis_client, 'task', 'a', ttl=30)
+    assert lease.acquire()
+
+    monotonic.advance(31)
+    assert not lease.is_held()
+    # Lease hết hạn trong Redis và instance khác giành được: lần gia hạn sau thất bại
+    redis_client.set(lease.key, 'b')
+    assert not lease.renew()
+    assert not lease.is_held()
+
+
+class Task:
+    def __init__(self):
+        self.started = 0
+        self.lost = 0
+        self.stop = threading.Event()
+        self.running = threading.Event()
+
+    def run(self, should_run):
+        self.started += 1
+        self.should_run = should_run
+        self.running.set()
+        self.stop.wait(5)
+
+    def on_lost(self):
+        self.lost += 1
+        self.stop.set()
+
+
+def tick(elector, name='task'):
+    elector._tick(name, elector.tasks[name])
+
+
+def test_task_runs_on_the_leader_only_and_stops_when_lease_is_lost(redis_client, monotonic):
+    leader, follower = Task(), Task()
+    electors = [LeaderElector(redis_client, instance_id=name, ttl=30) for name in ('a', 'b')]
+    electors[0].register('task', leader.run, on_lost=leader.on_lost)
+    electors[1].register('task', follower.run, on_lost=follower.on_lost)
+
+    for elector in electors:
+        tick(elector)
+    assert electors[0].is_leader('task') and not electors[1].is_leader('task')
+    assert leader.running.wait(1)
+    assert (leader.started, follower.started) == (1, 0)
+    assert leader.should_run()
+
+    # Lease bị instance khác chiếm (ví dụ sau khi hết hạn lúc tiến trình bị treo)
+    redis_client.set('leader:task', 'b')
+    tick(electors[0])
+    assert leader.lost == 1
+    assert not leader.should_run()
+    electors[0].tasks['task']['thread'].join(1)
+    assert not electors[0].status()['leases']['task']['running']
+
+
+def test_running_task_is_not_started_twice(redis_client, monotonic):
+    task = Task()
+    elector = LeaderElector(redis_client, instance_id='a', ttl=30)
+    elector.register('task', task.run, on_lost=task.on_lost)
+
+    tick(elector)
+    assert task.running.wait(1)
+    tick(elector)
+    assert task.started == 1
+    status = elector.status()
+    assert status['leases']['task'] == {'leader': True, 'holder': 'a', 'running': True}
+    task.stop.set()
+
+
+def test_lease_is_held_through_redis_outage_only_when_asked(redis_server, redis_client, monotonic):
+    import redis
+
+    held = LeaderLease(redis_client, 'email', 'a', ttl=30, hold_on_errors=(redis.exceptions.ConnectionError,))
+    strict = LeaderLease(redis_client, 'other', 'a', ttl=30)
+    assert held.acquire() and strict.acquire()
+
+    redis_server.connected = False
+    for _ in range(3):
+        monotonic.advance(10)
+        assert held.renew()
+        with pytest.raises(redis.exceptions.ConnectionError):
+            strict.renew()
+    assert held.is_held() and not strict.is_held()
+
+    # Lease chưa giữ thì không được giành khi Redis không phản hồi
+    follower = LeaderLease(redis_client, 'email', 'b', ttl=30, hold_on_errors=(redis.exceptions.ConnectionError,))
+    with pytest.raises(redis.exceptions.ConnectionError):
+        follower.acquire()
+
+    # Redis trở lại: lease vẫn thuộc về instance này thì tiếp tục gia hạn bình thường
+    redis_server.connected = True
+    assert held.renew()
+    assert held.holder() == 'a'
+
+
+def test_lease_held_through_errors_expires_after_max_hold(redis_server, redis_client, monotonic):
+    import redis
+
+    held = LeaderLease(redis_client, 'email', 'a', ttl=30, hold_on_errors=(redis.exceptions.ConnectionError,),
+                       max_hold=60)
+    assert held.acquire()
+
+    redis_server.connected = False
+    monotonic.advance(20)
+    assert held.renew()
+    monotonic.advance(20)
+    assert held.renew()
+    # Hạn giữ lease tính từ lần gia hạn thành công cuối cùng, không được kéo dài thêm ở mỗi lần gia hạn lỗi
+    monotonic.advance(15)
+    assert held.renew() and held.is_held()
+    monotonic.advance(5)
+    assert not held.is_held()
+    with pytest.raises(redis.exceptions.ConnectionError):
+        held.renew()
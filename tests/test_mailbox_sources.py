@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+
+import pytest
+
+from corpus import cake_alert_email
+from email_watcher import open_imap_connection
+from mailbox_sources import MailboxHealth, MailboxSource, MailboxWatcherPool, load_mailbox_sources
+
+DEFAULTS = {'login': 'main@example.com', 'password': 'secret', 'senders': ['alert@cake.vn']}
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_empty_config_keeps_single_default_mailbox():
+    [source] = load_mailbox_sources('', DEFAULTS)
+    assert (source.name, source.login, source.senders) == ('default', 'main@example.com', ['alert@cake.vn'])
+
+
+def test_sources_are_read_from_json_file_with_password_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv('SHOP_PASSWORD', 'from-env')
+    config = tmp_path / 'sources.json'
+    config.write_text(json.dumps([
+        {'name': 'main'},
+        {'name': 'shop', 'login': 'shop@example.com', 'password_env': 'SHOP_PASSWORD', 'senders': 'a@x.vn,b@x.vn',
+         'use_idle': False, 'account_number': '0999'},
+    ]))
+
+    main, shop = load_mailbox_sources(f'@{config}', DEFAULTS)
+    assert (main.login, main.password) == ('main@example.com', 'secret')
+    assert (shop.password, shop.senders, shop.use_idle) == ('from-env', ['a@x.vn', 'b@x.vn'], False)
+    assert shop.account_number == '0999'
+
+
+@pytest.mark.parametrize('config, error', [
+    ('[]', 'danh sách JSON khác rỗng'),
+    ('[{"name": "a"}, {"name": "a"}]', 'Trùng tên hộp thư: a'),
+    ('[{"name": "b", "password_env": "MISSING_PASSWORD"}]', 'Hộp thư b thiếu login hoặc password'),
+])
+def test_invalid_config_is_rejected(config, error):
+    with pytest.raises(ValueError, match=error):
+        load_mailbox_sources(config, DEFAULTS)
+
+
+class FakeMail:
+    def login(self, login, password):
+        pass
+
+    def select(self, folder):
+        pass
+
+    def logout(self):
+        pass
+
+
+def polling_source(name, poll_interval=0.1):
+    source = MailboxSource(name, f'{name}@example.com', 'secret', use_idle=False, poll_interval=poll_interval)
+    source.connect = FakeMail
+    return source
+
+
+@pytest.fixture
+def run_pool(redis_client):
+    """Chạy MailboxWatcherPool trên thread riêng, dừng khi test kết thúc."""
+    running = threading.Event()
+    running.set()
+    threads = []
+
+    def run(sources, on_new_mail, **kwargs):
+        pool = MailboxWatcherPool(sources, on_new_mail, redis_client, should_run=running.is_set, **kwargs)
+        thread = threading.Thread(target=pool.run, daemon=True)
+        thread.start()
+        threads.append(thread)
+        return pool
+
+    yield run
+    running.clear()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_slow_mailbox_does_not_delay_others_and_never_overlaps(run_pool):
+    release = threading.Event()
+    calls = {'slow': 0, 'fast': 0}
+    active = {'slow': 0, 'fast': 0}
+    overlapped = []
+
+    def on_new_mail(mail, source):
+        active[source.name] += 1
+        overlapped.append(active[source.name] > 1)
+        calls[source.name] += 1
+        if source.name == 'slow':
+            release.wait(5)
+        active[source.name] -= 1
+
+    pool = run_pool([polling_source('slow'), polling_source('fast')], on_new_mail, max_workers=2)
+
+    assert wait_until(lambda: calls['fast'] >= 3)
+    assert calls['slow'] == 1
+    release.set()
+    assert wait_until(lambda: calls['slow'] >= 2)
+    assert not any(overlapped)
+    assert pool.status()['fast']['status'] == 'ok'
+
+
+def test_failing_mailbox_backs_off_and_reports_health(run_pool, redis_client):
+    attempts = []
+
+    def on_new_mail(mail, source):
+        if source.name == 'broken':
+            attempts.append(time.monotonic())
+            raise OSError('connection reset')
+
+    run_pool([polling_source('broken'), polling_source('ok')], on_new_mail, initial_backoff=0.3, max_backoff=0.6)
+
+    assert wait_until(lambda: len(attempts) >= 3)
+    # Backoff tăng gấp đôi sau mỗi lần lỗi (0.3 rồi 0.6 giây)
+    assert attempts[2] - attempts[1] >= attempts[1] - attempts[0] >= 0.3
+    broken = MailboxHealth(redis_client, 'broken').status()
+    assert broken['status'] == 'error' and broken['last_error'] == 'connection reset'
+    assert broken['failures'] >= 2 and broken['retry_at'] is not None
+    assert MailboxHealth(redis_client, 'ok').status()['status'] == 'ok'
+
+
+def test_idle_and_polling_mailboxes_run_side_by_side(run_pool, imap_server):
+    idle = MailboxSource('idle', 'user', 'secret', use_idle=True)
+    idle.connect = lambda: open_imap_connection('127.0.0.1', imap_server.port, use_ssl=False, timeout=5)
+    seen = {'idle': [], 'poll': 0}
+
+    def on_new_mail(mail, source):
+        if source.name == 'poll':
+            seen['poll'] += 1
+            return
+        _, data = mail.uid('SEARCH', None, 'UNSEEN')
+        uids = data[0].split()
+        if uids:
+            mail.uid('STORE', b','.join(uids).decode(), '+FLAGS.SILENT', '(\\Seen)')
+            seen['idle'].extend(int(uid) for uid in uids)
+
+    run_pool([idle, polling_source('poll')], on_new_mail)
+    assert wait_until(lambda: seen['poll'] >= 2)
+    imap_server.deliver(cake_alert_email(50_000, 'CK VCD1'))
+
+    assert wait_until(lambda: seen['idle'] == [1])
@@ -0,0 +1,297 @@
+import json
+import threading
+import time
+from datetime import date
+
+import pytest
+import redis
+import requests
+
+from corpus import cake_alert_text
+
+AUTH = {'Authorization': 'Bearer test-key'}
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
+
+
+def add_history(main, count, created_at=1_700_000_000, **fields):
+    """Thêm count bản ghi (code H0, H1, ...) cách nhau 1 giây, hai bản ghi đầu trùng thời điểm tạo."""
+    codes = []
+    for index in range(count):
+        code = f"H{index}"
+        record = {'type': 'transaction', 'status': 'completed', 'code': code, 'amount': 1000 + index, **fields}
+        main.transaction_store.add(record, created_at=created_at + max(index - 1, 0))
+        codes.append(code)
+    return codes
+
+
+def test_history_pages_follow_cursor_without_gaps_or_repeats(main, client):
+    codes = add_history(main, 7)
+
+    seen, cursor = [], None
+    while True:
+        query = {'limit': 3, **({'cursor': cursor} if cursor else {})}
+        response = client.get('/transaction_history', query_string=query, headers=AUTH)
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['transactions']) <= 3
+        seen.extend(transaction['code'] for transaction in page['transactions'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert seen == codes
+
+
+def test_history_filters_by_type_status_and_time(main, client):
+    add_history(main, 4, created_at=1_000)
+    main.transaction_store.add({'type': 'topup', 'status': 'queued', 'phone_number': '0900'}, created_at=1_001)
+
+    response = client.get('/transaction_history', query_string={'limit': 10, 'type': 'topup'}, headers=AUTH)
+    assert [t['phone_number'] for t in response.get_json()['transactions']] == ['0900']
+
+    response = client.get('/transaction_history', query_string={'limit': 10, 'status': 'completed', 'since': 1_001,
+                                                                'until': '1970-01-01T00:16:42+00:00'}, headers=AUTH)
+    assert [t['code'] for t in response.get_json()['transactions']] == ['H2', 'H3']
+
+
+def test_history_without_limit_streams_ndjson(main, client):
+    codes = add_history(main, 5)
+
+    response = client.get('/transaction_history', headers=AUTH)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['code'] for line in lines] == codes
+
+
+def test_history_rejects_bad_parameters_and_reports_empty_stream(client):
+    assert client.get('/transaction_history', query_string={'limit': 0}, headers=AUTH).status_code == 400
+    assert client.get('/transaction_history', query_string={'since': 'yesterday'}, headers=AUTH).status_code == 400
+    assert client.get('/transaction_history', headers=AUTH).status_code == 404
+    assert client.get('/transaction_history').status_code == 401
+
+
+def create_transaction(client, transaction_id='order-1', amount=50_000):
+    response = client.post('/create_transaction', json={'transaction_id': transaction_id, 'amount': amount},
+                           headers=AUTH)
+    assert response.status_code == 201
+    return response.get_json()['code']
+
+
+def test_email_is_not_processed_twice_when_exec_reply_is_lost(main, client, monkeypatch):
+    code = create_transaction(client)
+    body = cake_alert_text(50_000, f'CK {code}')
+    pipeline = main.redis_client.pipeline
+
+    class LostReplyPipeline:
+        # MULTI/EXEC chạy trên server nhưng client không nhận được phản hồi
+        def __init__(self):
+            self.pipe = pipeline()
+
+        def __getattr__(self, name):
+            return getattr(self.pipe, name)
+
+        def execute(self):
+            self.pipe.execute()
+            raise redis.exceptions.TimeoutError('Timeout reading from socket')
+
+    monkeypatch.setattr(main.redis_client, 'pipeline', lambda *args, **kwargs: LostReplyPipeline())
+    assert main.handle_email('m1', body) == 'failed'
+    monkeypatch.setattr(main.redis_client, 'pipeline', pipeline)
+
+    assert main.email_ledger.status('m1') == 'processed'
+    assert main.handle_email('m1', body) == 'duplicate'
+    assert main.webhook_dispatcher.stats()['queued'] == 1
+
+
+def stats_by_type(main, kind):
+    today = date.fromtimestamp(time.time())
+    return main.transaction_stats.summary(today, today)['total']['by_type'].get(kind, {})
+
+
+def test_expired_transactions_are_counted_with_their_amount(main, client, clock):
+    create_transaction(client, 'order-1', 50_000)
+    stale = create_transaction(client, 'order-2', 30_000)
+    main.redis_client.delete(f"{main.PENDING_TRANSACTION_PREFIX}{stale}")
+    main.pending_deadlines.remove(stale)
+
+    main.reconcile_pending_history()
+    clock.advance(main.TRANSACTION_CODE_EXPIRATION + 1)
+    assert main.expire_due_transactions() == 1
+
+    assert stats_by_type(main, 'transaction')['expired'] == {'count': 2, 'amount': 80_000}
+
+
+class AppSession:
+    """Session giả lập ứng dụng nhận request xác nhận, trả về status_code cho mọi request."""
+
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+    def post(self, url, json=None, timeout=None):
+        return self
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return {'transaction_id': 'a1'}
+
+
+def queued_topup_job(main):
+    main.confirm_topup('0901234567', 20_000, 'NAP 0901234567', '2024-03-04T08:30:00+07:00', 'increase')
+    [job] = [json.loads(raw) for raw in main.redis_client.hvals(main.webhook_dispatcher.jobs_key)]
+    return job
+
+
+def test_topup_delivered_twice_is_counted_once(main):
+    main.webhook_dispatcher.session = AppSession
+    job = queued_topup_job(main)
+
+    main.webhook_dispatcher.deliver(dict(job))
+    main.webhook_dispatcher.deliver(dict(job))
+
+    assert stats_by_type(main, 'topup')['success'] == {'count': 1, 'amount': 20_000}
+    assert main.transaction_store.get(job['meta']['history_id'])['status'] == 'success'
+
+
+def test_replayed_topup_is_counted_once(main, client):
+    dispatcher = main.webhook_dispatcher
+    job = queued_topup_job(main)
+
+    def deliver_replayed(status_code):
+        assert client.post('/webhooks/dead_letters/replay', headers=AUTH).get_json()['replayed'] == 1
+        [raw] = main.redis_client.hvals(dispatcher.jobs_key)
+        dispatcher.session = lambda: AppSession(status_code)
+        dispatcher.deliver(json.loads(raw))
+
+    # Ứng dụng từ chối (4xx): chuyển vào dead-letter, được tính failed một lần kể cả khi gửi lại vẫn lỗi
+    dispatcher.session = lambda: AppSession(400)
+    dispatcher.deliver(dict(job))
+    deliver_replayed(400)
+    assert stats_by_type(main, 'topup')['failed'] == {'count': 1, 'amount': 20_000}
+
+    deliver_replayed(200)
+    topup = stats_by_type(main, 'topup')
+    assert topup['failed'] == {'count': 0, 'amount': 0}
+    assert topup['success'] == {'count': 1, 'amount': 20_000}
+    assert main.transaction_store.get(job['meta']['history_id'])['status'] == 'success'
+
+
+def test_qrpay_serves_cached_image_with_etag(main, client, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    query = {'account_number': '0123456789', 'purpose': 'NT0900000000'}
+
+    response = client.post('/qrpay', json=query)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.data.startswith(b'\x89PNG')
+    assert response.headers['Cache-Control'].startswith('public, max-age=')
+    etag = response.headers['ETag']
+
+    assert client.post('/qrpay', json=query, headers={'If-None-Match': etag}).status_code == 304
+    svg = client.post('/qrpay', json={**query, 'format': 'svg', 'scale': 4})
+    assert svg.mimetype == 'image/svg+xml' and svg.headers['ETag'] != etag
+    assert client.post('/qrpay', json={**query, 'scale': 1000}).status_code == 400
+    # Ảnh chỉ được render trong bộ nhớ, không ghi file ra thư mục làm việc
+    assert list(tmp_path.iterdir()) == []
+
+
+def pay_later(main, code, amount=50_000, delay=0.3):
+    """Xử lý email chuyển khoản cho code sau delay giây trên thread khác."""
+    timer = threading.Timer(delay, main.handle_email, args=(f'pay-{code}', cake_alert_text(amount, f'CK {code}')))
+    timer.start()
+    return timer
+
+
+def test_long_poll_returns_as_soon_as_status_changes(main, client):
+    code = create_transaction(client)
+    timer = pay_later(main, code)
+
+    started = time.monotonic()
+    response = client.get('/check_transaction_status', query_string={'code': code, 'wait': 10}, headers=AUTH)
+    timer.join()
+
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'completed'
+    assert time.monotonic() - started < 5
+
+
+def test_long_poll_times_out_with_current_status(main, client):
+    code = create_transaction(client)
+
+    response = client.get('/check_transaction_status', query_string={'code': code, 'wait': 0.2}, headers=AUTH)
+    assert response.get_json()['status'] == 'pending'
+    assert client.get('/check_transaction_status', query_string={'code': code, 'wait': 3600},
+                      headers=AUTH).status_code == 400
+
+
+def test_status_stream_sends_updates_until_final_status(main, client):
+    code = create_transaction(client)
+    timer = pay_later(main, code)
+
+    response = client.get('/transaction_status/stream', query_string={'code': code}, headers=AUTH)
+    assert response.mimetype == 'text/event-stream'
+    events = [json.loads(line[len('data: '):]) for line in response.get_data(as_text=True).splitlines()
+              if line.startswith('data: ')]
+    timer.join()
+    response.close()
+
+    assert [event['status'] for event in events] == ['pending', 'completed']
+    assert main.transaction_status_hub.waiters == {}
+    assert client.get('/transaction_status/stream', query_string={'code': 'VCD0'}, headers=AUTH).status_code == 404
+
+
+def test_bulk_create_streams_results_in_input_order_with_item_errors(main, client):
+    items = [{'transaction_id': 'order-1', 'amount': 10_000}, {'transaction_id': 'order-2'},
+             {'transaction_id': 'order-3', 'amount': 10 ** 14}, {'transaction_id': 'order-4', 'amount': 40_000}]
+
+    response = client.post('/create_transactions', json={'transactions': items}, headers=AUTH)
+    assert response.status_code == 201
+    assert response.mimetype == 'application/x-ndjson'
+    results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [result['index'] for result in results] == [0, 1, 2, 3]
+    assert [result['status'] for result in results] == ['success', 'error', 'error', 'success']
+    assert results[1]['error'] == 'Missing transaction_id or amount' and 'code' not in results[1]
+    # Giao dịch đã được tạo dù ảnh QR không render được
+    assert results[2]['error'].startswith('Transaction created but QR rendering failed')
+    assert main.transaction_status_response(results[2]['code'])['status'] == 'pending'
+    assert results[0]['qr_code_data'] and results[0]['qr_code_format'] == 'png'
+    codes = [results[index]['code'] for index in (0, 2, 3)]
+    assert len(set(codes)) == 3
+    assert main.transaction_status_response(codes[2])['transaction_id'] == 'order-4'
+
+
+def test_bulk_create_returns_zip_of_images_and_manifest(main, client):
+    import io
+    import zipfile
+
+    items = [{'transaction_id': f'order-{index}', 'amount': 10_000 + index} for index in range(3)]
+    response = client.post('/create_transactions', json={'transactions': items + [{}], 'output': 'zip',
+                                                         'format': 'svg'}, headers=AUTH)
+    assert response.mimetype == 'application/zip'
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        manifest = json.loads(archive.read('results.json'))
+        assert [result['status'] for result in manifest] == ['success', 'success', 'success', 'error']
+        assert sorted(archive.namelist()) == sorted([result['file'] for result in manifest[:3]] + ['results.json'])
+        assert archive.read(manifest[0]['file']).startswith(b'<?xml')
+
+
+def test_bulk_create_rejects_invalid_requests(main, client):
+    assert client.post('/create_transactions', json={'transactions': []}).status_code == 401
+    assert client.post('/create_transactions', json={'transactions': []}, headers=AUTH).status_code == 400
+    assert client.post('/create_transactions', json={'transactions': [{'transaction_id': 'x', 'amount': 1}],
+                                                     'output': 'xml'}, headers=AUTH).status_code == 400
+    too_many = [{'transaction_id': 'x', 'amount': 1}] * (main.BULK_CREATE_MAX_ITEMS + 1)
+    assert client.post('/create_transactions', json={'transactions': too_many}, headers=AUTH).status_code == 400
+    response = client.post('/create_transactions', json={'transactions': [{'amount': 1}]}, headers=AUTH)
+    assert response.status_code == 400 and response.get_json()['results'][0]['status'] == 'error'
+    assert main.redis_client.keys(f'{main.PENDING_TRANSACTION_PREFIX}*') == []
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import metrics
+
+APP_DIR = os.path.dirname(os.path.abspath(metrics.__file__))
+
+
+def run_worker(multiproc_dir, code):
+    """Chạy code trong một process riêng với PROMETHEUS_MULTIPROC_DIR, như một gunicorn worker."""
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(multiproc_dir)}
+    result = subprocess.run([sys.executable, '-c', f"import metrics\n{code}"], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True, timeout=60, check=True)
+    return result.stdout
+
+
+def test_multiprocess_render_merges_every_worker(tmp_path):
+    multiproc_dir = tmp_path / 'prometheus'
+    for source in ('a', 'b'):
+        run_worker(multiproc_dir, f"metrics.EMAILS_TOTAL.labels('processed').inc()\n"
+                                  f"metrics.EMAIL_LAST_SUCCESS.labels('{source}').set(100)")
+
+    output = run_worker(multiproc_dir, "metrics.state_collector.add('ewatcher_pending_transactions', 'doc', lambda: 3)\n"
+                                       "print(metrics.render().decode())")
+
+    # Thư mục được tạo khi import kể cả khi không chạy qua gunicorn
+    assert multiproc_dir.is_dir()
+    assert 'ewatcher_emails_total{result="processed"} 2.0' in output
+    assert 'ewatcher_email_last_success_timestamp_seconds{source="a"} 100.0' in output
+    assert 'ewatcher_email_last_success_timestamp_seconds{source="b"} 100.0' in output
+    assert 'ewatcher_pending_transactions 3.0' in output
+
+
+def test_render_without_multiprocess_dir_reports_this_process(monkeypatch):
+    collector = metrics.StateCollector()
+    monkeypatch.setattr(metrics, 'state_collector', collector)
+    collector.add('ewatcher_test_jobs', 'doc', lambda: {'queued': 2, 'dead': 1}, label='state')
+    metrics.QR_CACHE_REQUESTS.labels('hit').inc()
+
+    output = metrics.render().decode()
+
+    assert 'ewatcher_qr_cache_requests_total{result="hit"}' in output
+    assert 'ewatcher_test_jobs{state="queued"} 2.0' in output
+    assert 'ewatcher_test_jobs{state="dead"} 1.0' in output
+
+
+def test_state_collector_skips_gauges_whose_callback_fails():
+    collector = metrics.StateCollector()
+    collector.add('ewatcher_test_broken', 'doc', lambda: 1 / 0)
+    collector.add('ewatcher_test_ok', 'doc', lambda: 7)
+
+    assert [family.name for family in collector.collect()] == ['ewatcher_test_ok']
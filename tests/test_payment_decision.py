@@ -0,0 +1,85 @@
+import pytest
+
+from payment_decision import amount_status, credit_time, plan_actions, settled_status
+
+PENDING = {
+    'VCD1': {'type': 'receive', 'status': 'pending', 'amount': '50000', 'transaction_id': 'order-1'},
+    'VCD2': {'type': 'receive', 'status': 'expired', 'amount': '50000', 'transaction_id': 'order-2'},
+    'VCD3': {'type': 'receive', 'status': 'completed', 'amount': '50000', 'transaction_id': 'order-3'},
+    'VCD4': {'type': 'topup', 'status': 'pending', 'amount': '50000'},
+}
+
+
+def plan(details, match=None):
+    """plan_actions trên dữ liệu cố định; match là kết quả PaymentMatcher.match trả về cho mọi khoản tiền."""
+    match = match or {'code': None, 'reason': 'no_candidate', 'candidates': []}
+    return plan_actions(details, 1_700_000_000, lambda code: dict(PENDING.get(code, {})),
+                        lambda description, amount, at: match)
+
+
+@pytest.mark.parametrize('expected, received, status', [
+    ('50000', 50_000, 'exact'), ('50000', 40_000, 'underpaid'), ('50000', 60_000, 'overpaid'),
+    (None, 50_000, 'exact'), ('abc', 50_000, 'exact'),
+])
+def test_amount_status(expected, received, status):
+    assert amount_status(expected, received) == status
+
+
+@pytest.mark.parametrize('status, amount_check, new_status', [
+    ('pending', 'exact', 'completed'), ('pending', 'overpaid', 'completed'), ('pending', 'underpaid', 'underpaid'),
+    ('expired', 'underpaid', 'received_after_expired'), ('completed', 'exact', None), ('underpaid', 'exact', None),
+])
+def test_settled_status(status, amount_check, new_status):
+    assert settled_status(status, amount_check) == new_status
+
+
+@pytest.mark.parametrize('details, expected', [
+    ({'code': 'VCD1', 'amount_increased': 50_000}, [('settle', 'VCD1', 'completed', 'exact')]),
+    # Chuyển thiếu/thừa theo đúng mã
+    ({'code': 'VCD1', 'amount_increased': 40_000}, [('settle', 'VCD1', 'underpaid', 'underpaid')]),
+    ({'code': 'VCD1', 'amount_increased': 60_000}, [('settle', 'VCD1', 'completed', 'overpaid')]),
+    ({'code': 'VCD2', 'amount_increased': 50_000}, [('settle', 'VCD2', 'received_after_expired', 'exact')]),
+    ({'code': 'VCD3', 'amount_increased': 50_000}, [('settle', 'VCD3', None, 'exact')]),
+    # Mã đúng nhưng là tiền ra
+    ({'code': 'VCD1', 'amount_decreased': 50_000}, [('skip', 'VCD1', 'amount_mismatch')]),
+    # Mã không tồn tại hoặc không phải giao dịch nhận tiền: đối soát theo số tiền
+    ({'code': 'VCD9', 'amount_increased': 50_000}, [('skip', 'VCD9', 'not_found'), ('needs_review', 'no_candidate')]),
+    ({'code': 'VCD4', 'amount_increased': 50_000}, [('skip', 'VCD4', 'not_found'), ('needs_review', 'no_candidate')]),
+    ({'amount_increased': 50_000}, [('needs_review', 'no_candidate')]),
+    # Nạp tiền theo số điện thoại không đi qua đối soát
+    ({'phone_number': '0900', 'amount_decreased': 20_000}, [('topup', '0900', 'decrease')]),
+    ({'phone_number': '0900', 'amount_increased': 20_000}, [('topup', '0900', 'increase')]),
+    ({'amount_decreased': 20_000}, []),
+    ({}, []),
+])
+def test_plan_actions(details, expected):
+    summary = []
+    for action in plan(details):
+        if action['action'] == 'settle':
+            summary.append(('settle', action['code'], action['new_status'], action['amount_status']))
+        elif action['action'] == 'skip':
+            summary.append(('skip', action['code'], action['reason']))
+        elif action['action'] == 'topup':
+            summary.append(('topup', action['phone_number'], action['transaction_type']))
+        else:
+            summary.append(('needs_review', action['reason']))
+    assert summary == expected
+
+
+def test_fuzzy_match_settles_with_amount_check():
+    [action] = plan({'description': 'CK VCD11', 'amount_increased': 45_000},
+                    match={'code': 'VCD1', 'distance': 1, 'candidates': []})
+    assert (action['code'], action['match'], action['distance']) == ('VCD1', 'fuzzy_code', 1)
+    assert (action['new_status'], action['amount_status']) == ('underpaid', 'underpaid')
+    assert action['transaction']['transaction_id'] == 'order-1'
+
+
+def test_fuzzy_match_on_non_receive_transaction_needs_review():
+    [action] = plan({'amount_increased': 50_000}, match={'code': 'VCD4', 'distance': 0, 'candidates': []})
+    assert (action['action'], action['reason'], action['candidates']) == ('needs_review', 'no_candidate', [])
+
+
+def test_credit_time_prefers_received_at_then_email_time(clock):
+    assert credit_time({'time': '2024-01-01T00:00:00+00:00'}, 123) == 123
+    assert credit_time({'time': '2024-01-01T00:00:00+00:00'}) == 1_704_067_200
+    assert credit_time({'time': 'Không rõ'}) == clock.now
@@ -0,0 +1,99 @@
+import pytest
+
+from payment_matcher import PaymentMatcher, PendingAmountIndex, code_tokens, edit_distance, parse_amount
+
+# Bằng thời điểm của fixture clock (chỉ mục cắt phần quá hạn theo time.time())
+NOW = 1_700_000_000.0
+
+
+@pytest.mark.parametrize('a, b, limit, expected', [
+    ('123456', '123456', 1, 0),
+    ('123456', '123457', 1, 1),   # sai một chữ số
+    ('123456', '123465', 1, 1),   # đổi chỗ hai chữ số liền nhau
+    ('123456', '12345', 1, 1),    # thiếu một chữ số
+    ('123456', '124365', 1, 2),   # hai lần đổi chỗ: vượt limit
+    ('123456', '654321', 2, 3),
+    ('123456', '1234567', 0, 1),  # limit 0 chỉ chấp nhận chuỗi giống hệt
+    ('abc', 'ca', 3, 3),          # OSA: không sửa tiếp chuỗi đã đổi chỗ
+])
+def test_edit_distance(a, b, limit, expected):
+    assert edit_distance(a, b, limit) == expected
+    assert edit_distance(b, a, limit) == expected
+
+
+@pytest.mark.parametrize('description, expected', [
+    ('CK VCD 12345 67890', {'1234567890'}),
+    ('NT0900000000 VCD1234.567.890', {'1234567890'}),  # số điện thoại nạp tiền không phải mã giao dịch
+    ('ma 100010 so tien 50000', {'100010'}),
+    ('VCD123', set()),
+    (None, set()),
+])
+def test_code_tokens(description, expected):
+    assert code_tokens(description) == expected
+
+
+@pytest.mark.parametrize('value, expected', [(b'50000', 50_000), ('50,000', 50_000), (49999.9, 49_999),
+                                             ('abc', None), (None, None)])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+@pytest.fixture
+def matcher(redis_client, clock):
+    index = PendingAmountIndex(redis_client, max_age=600)
+    for code, amount, age in [('VCD100001', 50_000, 60), ('VCD100002', 50_000, 30), ('VCD200000', 45_000, 120),
+                              ('VCD300000', 60_000, 1_000)]:
+        index.add(code, amount, NOW - age)
+    return PaymentMatcher(index, max_distance=1, mismatch_max_distance=0, window=600, time_slack=120,
+                          amount_tolerance=0.1)
+
+
+@pytest.mark.parametrize('description, amount, code, reason, candidates', [
+    # Cùng số tiền, sai một chữ số hoặc đổi chỗ hai chữ số: chỉ một giao dịch đủ gần
+    ('CK VCD100011', 50_000, 'VCD100001', None, []),
+    ('CK VCD100010', 50_000, 'VCD100001', None, []),
+    # Thiếu tiền tố VCD
+    ('chuyen tien 100002', 50_000, 'VCD100002', None, []),
+    # Cách đều hai giao dịch cùng số tiền: không tự xác nhận
+    ('CK VCD100003', 50_000, None, 'ambiguous', ['VCD100002', 'VCD100001', 'VCD200000']),
+    # Chuyển thiếu/thừa: chỉ nhận khi phần số của mã khớp tuyệt đối, kể cả khi có nhiều giao dịch gần
+    ('CK VCD200000', 44_000, 'VCD200000', None, []),
+    ('CK VCD100001', 52_000, 'VCD100001', None, []),
+    ('CK VCD200001', 44_000, None, 'no_candidate', ['VCD200000']),
+    # Không có mã: chỉ gợi ý theo số tiền
+    ('chuyen tien', 50_000, None, 'amount_only', ['VCD100002', 'VCD100001']),
+    # Giao dịch đã quá hạn không được xét
+    ('CK VCD300000', 60_000, None, 'no_candidate', []),
+    ('CK VCD100001', 'abc', None, 'invalid_amount', []),
+])
+def test_match(matcher, description, amount, code, reason, candidates):
+    result = matcher.match(description, amount, credit_time=NOW)
+
+    assert result['code'] == code
+    assert result.get('reason') == reason
+    assert [candidate['code'] for candidate in result['candidates']] == candidates
+    if code is not None:
+        assert result['method'] == 'fuzzy_code'
+
+
+def test_suggestions_carry_distance_only_when_close(matcher):
+    # VCD200000 khác hai chữ số so với mã trong nội dung
+    result = matcher.match('CK VCD100003', 50_000, credit_time=NOW)
+    assert [(c['amount'], c['distance']) for c in result['candidates']] == [(50_000, 1), (50_000, 1), (45_000, None)]
+
+    result = matcher.match('CK VCD999999', 50_000, credit_time=NOW)
+    assert result['reason'] == 'no_candidate'
+    assert {c['code']: c['distance'] for c in result['candidates']} == {'VCD100001': None, 'VCD100002': None,
+                                                                        'VCD200000': None}
+
+
+def test_suggestions_report_distance_up_to_the_larger_limit(redis_client, clock):
+    index = PendingAmountIndex(redis_client, max_age=600)
+    index.add('VCD100022', 50_000, NOW - 60)
+    index.add('VCD100333', 45_000, NOW - 60)
+    matcher = PaymentMatcher(index, max_distance=1, mismatch_max_distance=2, amount_tolerance=0.1)
+
+    # VCD100022 sai hai chữ số: vượt max_distance nhưng vẫn được báo đúng khoảng cách; VCD100333 xa hơn cả hai mức
+    result = matcher.match('CK VCD100000', 50_000, credit_time=NOW)
+    assert result['code'] is None
+    assert [(c['code'], c['distance']) for c in result['candidates']] == [('VCD100022', 2), ('VCD100333', None)]
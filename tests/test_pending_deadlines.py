@@ -0,0 +1,103 @@
+from pending_deadlines import PendingDeadlineIndex
+
+PREFIX = 'pending_transaction:'
+
+
+def add_pending(redis_client, index, code, deadline, status='pending'):
+    redis_client.hset(f"{PREFIX}{code}", mapping={'status': status, 'timestamp': deadline - 600})
+    index.add(code, deadline)
+
+
+def test_pop_due_returns_due_codes_in_deadline_order(redis_client):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    add_pending(redis_client, index, 'B', 200)
+    add_pending(redis_client, index, 'A', 100)
+    add_pending(redis_client, index, 'C', 300)
+
+    assert index.next_deadline() == 100
+    assert index.pop_due(now=250) == ['A', 'B']
+    assert index.pop_due(now=250) == []
+    assert index.count() == 1
+    assert index.next_deadline() == 300
+    assert not redis_client.exists(f"{PREFIX}A", f"{PREFIX}B")
+    assert redis_client.exists(f"{PREFIX}C")
+
+
+def test_pop_due_respects_limit(redis_client):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    for i in range(5):
+        add_pending(redis_client, index, f"T{i}", 100 + i)
+
+    assert index.pop_due(now=1000, limit=2) == ['T0', 'T1']
+    assert index.pop_due(now=1000, limit=10) == ['T2', 'T3', 'T4']
+    assert index.next_deadline() is None
+
+
+def test_pop_due_skips_transactions_no_longer_pending(redis_client):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    add_pending(redis_client, index, 'PAID', 100, status='completed')
+    # Key pending đã tự hết hạn (TTL) trước khi được xử lý vẫn được tính là hết hạn
+    index.add('GONE', 100)
+
+    assert index.pop_due(now=200) == ['GONE']
+    assert index.count() == 0
+    assert redis_client.hget(f"{PREFIX}PAID", 'status') == b'completed'
+
+
+def test_removed_code_never_expires(redis_client):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    add_pending(redis_client, index, 'A', 100)
+    pipe = redis_client.pipeline()
+    index.remove('A', pipe=pipe)
+    pipe.execute()
+
+    assert index.pop_due(now=200) == []
+    assert redis_client.exists(f"{PREFIX}A")
+
+
+def test_backfill_indexes_existing_pending_keys(redis_client):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    redis_client.hset(f"{PREFIX}OLD", mapping={'status': 'pending', 'timestamp': 1000})
+    redis_client.hset(f"{PREFIX}DONE", mapping={'status': 'completed', 'timestamp': 1000})
+
+    assert index.backfill(expiration=600) == 1
+    assert index.backfill(expiration=600) == 0
+    assert index.pop_due(now=1600) == ['OLD']
+
+
+def test_pop_due_declares_every_pending_key(redis_client, monkeypatch):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    add_pending(redis_client, index, 'A', 100)
+    add_pending(redis_client, index, 'B', 150)
+    calls = []
+    script = index._pop_due_script
+
+    def recording_script(keys, args):
+        calls.append(keys)
+        return script(keys=keys, args=args)
+
+    monkeypatch.setattr(index, '_pop_due_script', recording_script)
+
+    assert index.pop_due(now=200) == ['A', 'B']
+    assert calls == [[index.key, f"{PREFIX}A", f"{PREFIX}B"]]
+    assert index.pop_due(now=200) == []
+    assert len(calls) == 1
+
+
+def test_pop_due_skips_codes_taken_or_rescheduled_after_the_read(redis_client, monkeypatch):
+    index = PendingDeadlineIndex(redis_client, PREFIX)
+    add_pending(redis_client, index, 'A', 100)
+    add_pending(redis_client, index, 'B', 100)
+    add_pending(redis_client, index, 'C', 100)
+    script = index._pop_due_script
+
+    def racing_script(keys, args):
+        # Giữa lúc đọc và lúc chạy script: A đã được lấy ra ở tiến trình khác, B được thanh toán
+        index.remove('A')
+        index.remove('B')
+        return script(keys=keys, args=args)
+
+    monkeypatch.setattr(index, '_pop_due_script', racing_script)
+
+    assert index.pop_due(now=200) == ['C']
+    assert redis_client.exists(f"{PREFIX}A", f"{PREFIX}B") == 2
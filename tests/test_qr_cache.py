@@ -0,0 +1,77 @@
+import pytest
+import redis
+
+from qr_cache import QRImageCache, cache_key
+
+
+class Renderer:
+    def __init__(self, size=10):
+        self.calls = 0
+        self.size = size
+
+    def __call__(self):
+        self.calls += 1
+        return bytes([self.calls]) * self.size
+
+
+@pytest.fixture
+def monotonic(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('time.monotonic', lambda: now[0])
+    return now
+
+
+def test_renders_once_and_serves_from_process_cache(redis_client, monotonic):
+    cache = QRImageCache(redis_client)
+    render = Renderer()
+
+    first = cache.get_or_render('k', render)
+    assert cache.get_or_render('k', render) == first
+    assert cache.peek('k') == first
+    assert render.calls == 1
+
+
+def test_other_processes_reuse_the_redis_copy(redis_client, monotonic):
+    render = Renderer()
+    image = QRImageCache(redis_client).get_or_render('k', render)
+
+    other = QRImageCache(redis_client)
+    assert other.peek('k') is None
+    assert other.get_or_render('k', render) == image
+    assert render.calls == 1
+
+
+def test_process_cache_evicts_least_recently_used_by_size(redis_client, monotonic):
+    cache = QRImageCache(redis_client, max_bytes=25)
+    for key in ('a', 'b'):
+        cache.get_or_render(key, Renderer())
+    cache.get_or_render('a', Renderer())
+    cache.get_or_render('c', Renderer())
+
+    assert cache.size == 20
+    assert cache.peek('b') is None
+    assert cache.peek('a') is not None and cache.peek('c') is not None
+
+
+def test_process_cache_entries_expire(redis_client, monotonic):
+    cache = QRImageCache(redis_client, ttl=60)
+    cache.get_or_render('k', Renderer())
+
+    monotonic[0] += 61
+    assert cache.peek('k') is None
+    assert cache.size == 0
+
+
+def test_renders_when_redis_is_unavailable(monotonic):
+    unavailable = redis.Redis(host='127.0.0.1', port=1, socket_connect_timeout=0.1)
+    cache = QRImageCache(unavailable)
+    render = Renderer()
+
+    assert cache.get_or_render('k', render) == bytes([1]) * 10
+    # Ảnh vẫn được giữ trong cache của process
+    assert cache.get_or_render('k', render) == bytes([1]) * 10
+    assert render.calls == 1
+
+def test_cache_key_depends_on_every_part():
+    assert cache_key('static', 'b', 'a', 'p', 'png', 10) == cache_key('static', 'b', 'a', 'p', 'png', 10)
+    assert cache_key('static', 'b', 'a', 'p', 'png', 10) != cache_key('static', 'b', 'a', 'p', 'svg', 10)
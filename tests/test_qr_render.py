@@ -0,0 +1,52 @@
+import pytest
+
+from qr_render import QRRenderPool, render_payment_qr
+
+ITEMS = [('970422', '0123456789', 10_000 + index, f'VCD{index}', 'png', 2) for index in range(10)]
+
+
+def test_render_writes_nothing_to_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert render_payment_qr('970422', '0123456789', 50_000, 'VCD1').startswith(b'\x89PNG')
+    assert render_payment_qr('970422', '0123456789', 50_000, 'VCD1', kind='svg').startswith(b'<?xml')
+    assert render_payment_qr('970422', '0123456789', None, 'NAP').startswith(b'\x89PNG')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_static_qr_differs_from_dynamic_qr():
+    assert render_payment_qr('970422', '0123456789', None, 'NAP') != render_payment_qr('970422', '0123456789', 1, 'NAP')
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_render_many_keeps_input_order_and_reports_errors_per_item(processes):
+    pool = QRRenderPool(processes=processes, start_method='fork', chunksize=3, min_parallel=2)
+    # Số tiền quá 13 chữ số không mã hóa được trong VietQR: chỉ phần tử đó bị lỗi
+    items = ITEMS[:4] + [('970422', '0123456789', 10 ** 20, 'VCD99', 'png', 2)] + ITEMS[4:]
+    try:
+        results = list(pool.render_many(items))
+    finally:
+        pool.shutdown()
+
+    assert len(results) == len(items)
+    assert results[4][0] is None and 'TransactionAmount' in results[4][1]
+    expected = [render_payment_qr(*item) for item in ITEMS]
+    assert [image for image, _ in results[:4] + results[5:]] == expected
+
+
+def test_broken_pool_renders_remaining_items_in_process(monkeypatch):
+    pool = QRRenderPool(processes=2, start_method='fork', min_parallel=2)
+
+    class BrokenExecutor:
+        def map(self, func, items, chunksize):
+            yield func(items[0])
+            from concurrent.futures.process import BrokenProcessPool
+            raise BrokenProcessPool('worker killed')
+
+        def shutdown(self, wait):
+            pass
+
+    monkeypatch.setattr(pool, '_get_executor', BrokenExecutor)
+    results = list(pool.render_many(ITEMS[:5]))
+
+    assert [image for image, _ in results] == [render_payment_qr(*item) for item in ITEMS[:5]]
+    assert pool.executor is None
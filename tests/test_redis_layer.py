@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+import redis
+import redis.asyncio.connection
+import redis.connection
+
+from redis_layer import (AsyncBlockingSentinelConnectionPool, BlockingSentinelConnectionPool, RedisSettings,
+                         parse_sentinels)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('', []),
+    ('sentinel-1:26380', [('sentinel-1', 26380)]),
+    ('sentinel-1:26380, sentinel-2 ,10.0.0.3:26381,', [('sentinel-1', 26380), ('sentinel-2', 26379),
+                                                       ('10.0.0.3', 26381)]),
+])
+def test_parse_sentinels(value, expected):
+    assert parse_sentinels(value) == expected
+
+
+def test_parse_sentinels_rejects_bad_port():
+    with pytest.raises(ValueError):
+        parse_sentinels('sentinel-1:port')
+
+
+@pytest.fixture
+def refused(monkeypatch):
+    """Đếm số lần mở kết nối; mọi lần mở đều bị từ chối như khi Redis không chạy."""
+    attempts = []
+
+    def connect(self):
+        attempts.append(self)
+        raise redis.exceptions.ConnectionError('Connection refused')
+
+    async def connect_async(self):
+        connect(self)
+
+    monkeypatch.setattr(redis.connection.Connection, '_connect', connect)
+    monkeypatch.setattr(redis.asyncio.connection.Connection, '_connect', connect_async)
+    return attempts
+
+
+def test_clients_are_created_without_connecting(refused):
+    settings = RedisSettings(sentinels=[('sentinel-1', 26379)])
+
+    RedisSettings().create_clients()
+    settings.create_clients()
+    settings.create_async_clients()
+
+    assert refused == []
+
+
+def test_write_client_does_not_retry_but_read_client_does(refused):
+    client, read_client = RedisSettings(retry_attempts=2).create_clients()
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        client.set('key', 'value')
+    assert len(refused) == 1
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        read_client.get('key')
+    assert len(refused) > 2
+
+
+def test_async_write_client_does_not_retry_but_read_client_does(refused):
+    async def run():
+        client, read_client = RedisSettings(retry_attempts=2).create_async_clients()
+        with pytest.raises(redis.exceptions.ConnectionError):
+            await client.set('key', 'value')
+        writes = len(refused)
+        with pytest.raises(redis.exceptions.ConnectionError):
+            await read_client.get('key')
+        return writes
+
+    assert asyncio.run(run()) == 1
+    assert len(refused) > 2
+
+
+def test_direct_clients_use_separate_blocking_pools():
+    settings = RedisSettings(host='master', port=6380, replica_host='replica', max_connections=7, pool_timeout=3)
+    client, read_client = settings.create_clients()
+
+    assert settings.reads_from_replica
+    assert client.connection_pool is not read_client.connection_pool
+    for pool, host, port in ((client.connection_pool, 'master', 6380), (read_client.connection_pool, 'replica', 6380)):
+        assert isinstance(pool, redis.BlockingConnectionPool)
+        assert (pool.connection_kwargs['host'], pool.connection_kwargs['port']) == (host, port)
+        assert (pool.max_connections, pool.timeout) == (7, 3)
+    assert 'retry' not in client.connection_pool.connection_kwargs
+    assert 'retry' in read_client.connection_pool.connection_kwargs
+
+
+@pytest.mark.parametrize('read_from_replicas', [False, True])
+def test_sentinel_clients_follow_the_master(read_from_replicas):
+    settings = RedisSettings(sentinels=parse_sentinels('sentinel-1:26379,sentinel-2:26379'), sentinel_master='main',
+                             read_from_replicas=read_from_replicas, max_connections=7, pool_timeout=3)
+    client, read_client = settings.create_clients()
+
+    assert settings.describe() == 'sentinel main@sentinel-1:26379,sentinel-2:26379 (DB: 0)'
+    assert settings.reads_from_replica == read_from_replicas
+    for pool in (client.connection_pool, read_client.connection_pool):
+        assert isinstance(pool, BlockingSentinelConnectionPool)
+        assert (pool.service_name, pool.max_connections, pool.timeout) == ('main', 7, 3)
+    assert client.connection_pool.is_master
+    assert read_client.connection_pool.is_master != read_from_replicas
+    assert 'retry' not in client.connection_pool.connection_kwargs
+
+
+def test_async_sentinel_clients_use_blocking_pools():
+    settings = RedisSettings(sentinels=[('sentinel-1', 26379)], read_from_replicas=True)
+    client, read_client = settings.create_async_clients(max_connections=9, pool_timeout=1)
+
+    for pool in (client.connection_pool, read_client.connection_pool):
+        assert isinstance(pool, AsyncBlockingSentinelConnectionPool)
+        assert (pool.max_connections, pool.timeout) == (9, 1)
+    assert client.connection_pool.is_master and not read_client.connection_pool.is_master
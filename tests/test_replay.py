@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+import replay
+from corpus import cake_alert_text
+
+AUTH = {'Authorization': 'Bearer test-key'}
+
+
+def create_transaction(main, transaction_id, amount):
+    response = main.app.test_client().post('/create_transaction', json={'transaction_id': transaction_id,
+                                                                        'amount': amount}, headers=AUTH)
+    assert response.status_code == 201
+    return response.get_json()['code']
+
+
+@pytest.mark.parametrize('paid, description, action, new_status', [
+    (50_000, 'CK {code}', 'confirm_transaction', 'completed'),
+    (40_000, 'CK {code}', 'confirm_transaction', 'underpaid'),
+    (60_000, 'CK {code}', 'confirm_transaction', 'completed'),
+    # Thiếu tiền tố và chuyển thiếu một ít: chỉ tự xác nhận khi phần số khớp tuyệt đối
+    (49_000, 'chuyen tien {digits}', 'confirm_transaction', 'underpaid'),
+    (50_000, 'chuyen tien', 'needs_review', None),
+])
+def test_dry_run_describes_what_processing_does(main, paid, description, action, new_status):
+    code = create_transaction(main, 'order-1', 50_000)
+    body = cake_alert_text(paid, description.format(code=code, digits=code[3:]))
+    details = main.extract_transaction_details(body)
+    received_at = time.time()
+
+    [planned] = replay.describe(main, details, replay.payment_decision.credit_time(details, received_at))
+    assert planned['action'] == action
+    assert main.redis_client.hget(f'{main.PENDING_TRANSACTION_PREFIX}{code}', 'status') == b'pending'
+
+    assert main.handle_email('m1', body, received_at) == 'processed'
+    status = main.transaction_status_response(code)['status']
+    if action == 'confirm_transaction':
+        assert (planned['code'], planned['new_status'], status) == (code, new_status, new_status)
+        assert planned['amount_status'] == main.transaction_store.get(code)['amount_status']
+    else:
+        assert status == 'pending'
+        assert [record['type'] for _, _, record in main.transaction_store.query({'type': 'unmatched'})] == ['unmatched']
@@ -0,0 +1,56 @@
+import queue
+
+import pytest
+
+from status_events import RESYNC, TransactionStatusHub
+
+
+@pytest.fixture
+def hub(redis_client):
+    return TransactionStatusHub(redis_client, channel='test_status')
+
+
+def next_event(waiter, timeout=2):
+    """Sự kiện tiếp theo, bỏ qua RESYNC (đọc lại trạng thái) được gửi khi kết nối SUBSCRIBE sẵn sàng."""
+    while True:
+        event = waiter.get(timeout=timeout)
+        if event is not RESYNC:
+            return event
+
+
+def test_subscriber_receives_events_of_its_code_only(hub):
+    waiter = hub.subscribe('VCD1')
+    other = hub.subscribe('VCD2')
+
+    hub.publish('VCD1', 'completed')
+    event = next_event(waiter)
+    assert (event['code'], event['status']) == ('VCD1', 'completed')
+    with pytest.raises(queue.Empty):
+        next_event(other, timeout=0.3)
+
+
+def test_event_queued_in_pipeline_is_published_on_execute(hub, redis_client):
+    waiter = hub.subscribe('VCD1')
+    pipe = redis_client.pipeline()
+    hub.publish('VCD1', 'expired', pipe=pipe)
+    with pytest.raises(queue.Empty):
+        next_event(waiter, timeout=0.2)
+
+    pipe.execute()
+    assert next_event(waiter)['status'] == 'expired'
+
+
+def test_unsubscribed_waiter_gets_nothing_and_connection_is_shared(hub):
+    first = hub.subscribe('VCD1')
+    second = hub.subscribe('VCD1')
+    thread = hub.thread
+    hub.unsubscribe('VCD1', first)
+
+    hub.publish('VCD1', 'completed')
+    assert next_event(second)['status'] == 'completed'
+    with pytest.raises(queue.Empty):
+        next_event(first, timeout=0.2)
+    # Một kết nối SUBSCRIBE cho mọi subscriber của process
+    assert hub.thread is thread
+    hub.unsubscribe('VCD1', second)
+    assert hub.waiters == {}
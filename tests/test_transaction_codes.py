@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from transaction_codes import TRANSACTION_CODE_RESERVATION_PREFIX, TransactionCodeGenerator
+
+
+def test_codes_have_prefix_and_fixed_width(redis_client, clock):
+    code = TransactionCodeGenerator(redis_client).generate()
+
+    assert code.startswith('VCD') and len(code) == 13 and code[3:].isdigit()
+    assert redis_client.exists(f"{TRANSACTION_CODE_RESERVATION_PREFIX}{code}")
+
+
+def test_codes_are_unique_across_workers(redis_client, clock):
+    # Mỗi generator đóng vai một gunicorn worker/instance dùng chung Redis
+    generators = [TransactionCodeGenerator(redis_client, block_size=7) for _ in range(4)]
+    results = [[] for _ in generators]
+
+    def work(generator, codes):
+        for i in range(50):
+            if i % 10 == 0:
+                codes.extend(generator.generate_many(5))
+            codes.append(generator.generate())
+
+    threads = [threading.Thread(target=work, args=args) for args in zip(generators, results)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    codes = [code for worker_codes in results for code in worker_codes]
+    assert len(codes) == 4 * (50 + 25)
+    assert len(set(codes)) == len(codes)
+
+
+def test_codes_stay_unique_after_counter_reset(redis_client, clock):
+    generator = TransactionCodeGenerator(redis_client, block_size=10)
+    before = set(generator.generate_many(500))
+
+    # Bộ đếm bị mất (ví dụ Redis khôi phục từ bản sao cũ) và khởi tạo lại từ cùng epoch
+    redis_client.delete(generator.seq_key)
+    after = [TransactionCodeGenerator(redis_client, block_size=10).generate() for _ in range(20)]
+    after += TransactionCodeGenerator(redis_client, block_size=10).generate_many(50)
+
+    assert len(set(after)) == len(after)
+    assert before.isdisjoint(after)
+
+
+def test_generate_many_reuses_the_current_block(redis_client, clock):
+    generator = TransactionCodeGenerator(redis_client, block_size=100)
+    first = generator.generate()
+    many = generator.generate_many(3)
+
+    assert [int(code[3:]) for code in many] == [int(first[3:]) + offset for offset in (1, 2, 3)]
+
+
+def test_counter_overflow_is_reported(redis_client, clock):
+    generator = TransactionCodeGenerator(redis_client, digits=4)
+    redis_client.set(generator.seq_key, 9_999)
+
+    with pytest.raises(OverflowError):
+        generator.generate()
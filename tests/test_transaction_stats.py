@@ -0,0 +1,82 @@
+from datetime import date, datetime
+
+import pytest
+
+from transaction_stats import TransactionStats
+
+MONDAY = datetime(2024, 3, 4, 12).timestamp()
+TUESDAY = datetime(2024, 3, 5, 12).timestamp()
+
+
+@pytest.fixture
+def stats(redis_client):
+    return TransactionStats(redis_client, prefix='stats:')
+
+
+def record(stats, redis_client, *args, **kwargs):
+    pipe = redis_client.pipeline()
+    stats.record(pipe, *args, **kwargs)
+    pipe.execute()
+
+
+def test_record_writes_to_the_day_of_the_event(stats, redis_client):
+    record(stats, redis_client, 'transaction', 'pending', '50,000', at=MONDAY)
+    record(stats, redis_client, 'transaction', 'completed', 50_000, at=TUESDAY, created_at=MONDAY, direction='in')
+
+    assert redis_client.hgetall('stats:2024-03-04') == {b'count:transaction:pending': b'1',
+                                                         b'amount:transaction:pending': b'50000'}
+    tuesday = redis_client.hgetall('stats:2024-03-05')
+    assert tuesday[b'amount_in'] == b'50000'
+    assert tuesday[b'paid_count'] == b'1'
+    assert float(tuesday[b'paid_seconds']) == TUESDAY - MONDAY
+
+
+def test_summary_reports_each_day_and_the_total(stats, redis_client):
+    record(stats, redis_client, 'transaction', 'pending', 50_000, at=MONDAY)
+    record(stats, redis_client, 'transaction', 'pending', 20_000, at=MONDAY)
+    record(stats, redis_client, 'transaction', 'completed', 50_000, at=MONDAY + 60, created_at=MONDAY, direction='in')
+    record(stats, redis_client, 'transaction', 'expired', 20_000, at=TUESDAY)
+    record(stats, redis_client, 'topup', 'queued', 10_000, at=TUESDAY, direction='out')
+    record(stats, redis_client, 'topup', 'success', 10_000, at=TUESDAY)
+
+    summary = stats.summary(date(2024, 3, 3), date(2024, 3, 5))
+
+    assert [day['date'] for day in summary['days']] == ['2024-03-03', '2024-03-04', '2024-03-05']
+    empty, monday, tuesday = summary['days']
+    assert empty['created'] == 0 and empty['completion_rate'] is None and empty['by_type'] == {}
+    assert (monday['created'], monday['completed'], monday['expired']) == (2, 1, 0)
+    assert monday['completion_rate'] == 1.0
+    assert monday['avg_seconds_to_pay'] == 60.0
+    assert tuesday['amount_out'] == 10_000
+    assert tuesday['by_type']['topup'] == {'queued': {'count': 1, 'amount': 10_000},
+                                           'success': {'count': 1, 'amount': 10_000}}
+
+    total = summary['total']
+    assert (total['created'], total['completed'], total['expired']) == (2, 1, 1)
+    assert total['completion_rate'] == 0.5
+    assert total['amount_in'] == 50_000 and total['amount_out'] == 10_000
+    assert total['paid_count'] == 1 and total['avg_seconds_to_pay'] == 60.0
+    assert total['by_type']['transaction']['pending'] == {'count': 2, 'amount': 70_000}
+    assert total['by_type']['transaction']['expired'] == {'count': 1, 'amount': 20_000}
+
+
+def test_retract_undoes_a_record_on_its_day(stats, redis_client):
+    record(stats, redis_client, 'topup', 'failed', 10_000, at=MONDAY)
+    pipe = redis_client.pipeline()
+    stats.retract(pipe, 'topup', 'failed', 10_000, at=MONDAY)
+    stats.record(pipe, 'topup', 'success', 10_000, at=TUESDAY)
+    pipe.execute()
+
+    by_type = stats.summary(date(2024, 3, 4), date(2024, 3, 5))['total']['by_type']['topup']
+    assert by_type == {'failed': {'count': 0, 'amount': 0}, 'success': {'count': 1, 'amount': 10_000}}
+
+
+def test_days_include_both_ends(stats):
+    assert stats.days(date(2024, 2, 28), date(2024, 3, 1)) == ['2024-02-28', '2024-02-29', '2024-03-01']
+
+
+def test_describe_ignores_unknown_fields():
+    described = TransactionStats.describe({'count:transaction:completed': '3', 'note': '1', 'count:': '1'})
+
+    assert described['completed'] == 3
+    assert described['by_type'] == {'transaction': {'completed': {'count': 3, 'amount': 0}}}
@@ -0,0 +1,173 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from history_archive import HistoryArchive
+from transaction_store import TransactionStore
+
+
+@pytest.fixture
+def store(redis_client):
+    return TransactionStore(redis_client, 'history')
+
+
+@pytest.fixture
+def archived_store(redis_client, tmp_path):
+    return TransactionStore(redis_client, 'history', archive=HistoryArchive(str(tmp_path)))
+
+
+def add(store, code, status, created_at):
+    return store.add({'code': code, 'status': status, 'type': 'transaction'}, created_at=created_at)
+
+
+def test_update_moves_record_between_status_indexes(store):
+    add(store, 'A', 'pending', 100)
+
+    assert store.update('A', {'status': 'completed', 'amount': 5000})
+    assert store.ids_by_status('pending') == []
+    assert store.ids_by_status('completed') == ['A']
+    assert store.get('A')['amount'] == 5000
+    # Điểm trong chỉ mục trạng thái là thời điểm tạo, giống chỉ mục thời gian
+    assert [score for score, _, _ in store.scan(status='completed')] == [100]
+
+
+def test_pipelined_update_is_applied_with_the_pipeline(store, redis_client):
+    add(store, 'A', 'pending', 100)
+    pipe = redis_client.pipeline()
+
+    assert store.update('A', {'status': 'expired'}, pipe=pipe)
+    assert store.ids_by_status('pending') == ['A']
+
+    pipe.execute()
+    assert store.ids_by_status('pending') == []
+    assert store.ids_by_status('expired') == ['A']
+
+
+def test_update_without_status_keeps_status_index(store):
+    add(store, 'A', 'pending', 100)
+
+    assert store.update('A', {'description': 'ck'})
+    assert store.ids_by_status('pending') == ['A']
+
+
+def test_update_moves_record_out_of_unknown_status_index(store):
+    add(store, 'A', 'legacy_status', 100)
+
+    assert store.update('A', {'status': 'failed'})
+    assert store.ids_by_status('legacy_status') == []
+    assert store.ids_by_status('failed') == ['A']
+
+
+def test_pipelined_update_moves_record_out_of_unknown_status_index(store, redis_client):
+    add(store, 'A', 'legacy_status', 100)
+    pipe = redis_client.pipeline()
+
+    store.update('A', {'status': 'completed'}, pipe=pipe)
+    pipe.execute()
+    assert store.ids_by_status('legacy_status') == []
+    assert store.ids_by_status('completed') == ['A']
+
+
+def test_update_declares_only_old_and_new_status_indexes(store, monkeypatch):
+    add(store, 'A', 'pending', 100)
+    calls = []
+    script = store._update_script
+
+    def recording_script(keys, args, **kwargs):
+        calls.append(keys)
+        return script(keys=keys, args=args, **kwargs)
+
+    monkeypatch.setattr(store, '_update_script', recording_script)
+
+    store.update('A', {'status': 'completed'})
+    store.update('A', {'status': 'completed'})
+    store.update('A', {'description': 'ck'})
+    record_keys = [store.record_key('A'), store.time_index_key]
+    assert calls == [
+        record_keys + [store.status_index_key('completed'), store.status_index_key('pending')],
+        record_keys + [store.status_index_key('completed')],
+        record_keys,
+    ]
+
+
+def test_concurrent_status_change_does_not_leave_stale_index_entries(store, redis_client, monkeypatch):
+    add(store, 'A', 'pending', 100)
+    hget = redis_client.hget
+
+    def racing_hget(*args):
+        # Một instance khác đổi trạng thái ngay sau khi update() đọc trạng thái cũ
+        value = hget(*args)
+        monkeypatch.setattr(redis_client, 'hget', hget)
+        store.update('A', {'status': 'expired'})
+        return value
+
+    monkeypatch.setattr(redis_client, 'hget', racing_hget)
+    store.update('A', {'status': 'completed'})
+
+    assert store.ids_by_status('pending') == []
+    assert store.ids_by_status('expired') == []
+    assert [record_id for _, record_id, _ in store.scan(status='completed')] == ['A']
+
+
+def test_update_of_missing_record_does_nothing(store, redis_client):
+    assert not store.update('missing', {'status': 'completed'})
+    assert not redis_client.exists(store.record_key('missing'))
+    assert store.ids_by_status('completed') == []
+
+
+def test_migration_keeps_historical_transaction_times(store, redis_client, clock):
+    legacy = [
+        {'code': 'A', 'status': 'completed', 'transaction_time': '2024-01-02T10:00:00+07:00'},
+        {'code': 'B', 'status': 'completed', 'transaction_time': 'Không rõ'},
+        {'code': 'C', 'status': 'expired', 'transaction_time': '2024-03-04T08:30:00+07:00'},
+    ]
+    redis_client.rpush('history', *(json.dumps(record) for record in legacy))
+
+    assert store.migrate_legacy_list() == 3
+    scores = {record_id: score for score, record_id, _ in store.scan()}
+    assert scores['A'] == datetime.fromisoformat('2024-01-02T10:00:00+07:00').timestamp()
+    assert scores['C'] == datetime.fromisoformat('2024-03-04T08:30:00+07:00').timestamp()
+    # Bản ghi không đọc được thời gian được xếp ngay sau bản ghi đứng trước nó
+    assert scores['A'] < scores['B'] < scores['A'] + 1
+    assert redis_client.type('history') == b'none'
+    assert redis_client.llen('history:legacy') == 3
+    # Lọc theo khoảng thời gian dùng đúng thời điểm lịch sử
+    since = datetime.fromisoformat('2024-03-01T00:00:00+07:00').timestamp()
+    assert [record_id for _, record_id, _ in store.query(min_score=since)] == ['C']
+
+
+def test_archive_removes_records_and_indexes_from_redis(archived_store):
+    add(archived_store, 'OLD', 'completed', 100)
+    add(archived_store, 'NEW', 'pending', 300)
+
+    assert archived_store.archive_older_than(200) == 1
+    assert archived_store.count() == 1
+    assert archived_store.ids_by_status('completed') == []
+    assert archived_store.ids_by_status('pending') == ['NEW']
+    # Bản ghi đã lưu trữ vẫn đọc được và vẫn nằm trong kết quả truy vấn
+    assert archived_store.get('OLD')['status'] == 'completed'
+    assert [record_id for _, record_id, _ in archived_store.query({'type': 'transaction'})] == ['OLD', 'NEW']
+
+
+def test_archive_keeps_record_updated_while_it_was_written(archived_store, monkeypatch):
+    add(archived_store, 'OLD', 'pending', 100)
+    write = archived_store.archive.write
+    calls = []
+
+    def write_then_update(entries):
+        written = write(entries)
+        # Giao dịch được cập nhật sau khi đã đọc để lưu trữ nhưng trước khi xóa khỏi Redis
+        if not calls:
+            archived_store.update('OLD', {'status': 'completed'})
+        calls.append(entries)
+        return written
+
+    monkeypatch.setattr(archived_store.archive, 'write', write_then_update)
+
+    assert archived_store.archive_older_than(200) == 1
+    assert [entries[0][2]['status'] for entries in calls] == ['pending', 'completed']
+    assert archived_store.count() == 0
+    assert archived_store.ids_by_status('pending') == archived_store.ids_by_status('completed') == []
+    assert archived_store.get('OLD')['status'] == 'completed'
+    assert [record['status'] for _, _, record in archived_store.query()] == ['completed']
@@ -0,0 +1,189 @@
+import json
+
+import pytest
+import requests
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error")
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def post(self, url, json=None, timeout=None):
+        self.requests.append((url, json))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def dispatcher(redis_client):
+    return WebhookDispatcher(redis_client, 'http://app', max_attempts=2, retry_backoff=10, visibility_timeout=60)
+
+
+@pytest.fixture
+def results(dispatcher):
+    results = {'success': [], 'dead': []}
+    dispatcher.on_result('topup', on_success=lambda job, data: results['success'].append((job['id'], data)),
+                         on_dead=lambda job, error: results['dead'].append(job['id']))
+    return results
+
+
+def run_worker(dispatcher, iterations=1):
+    remaining = iter(range(iterations))
+    dispatcher._worker(lambda: next(remaining, None) is not None)
+
+
+def pop(dispatcher, deadline):
+    return dispatcher._pop_script(keys=[dispatcher.queue_key, dispatcher.scheduled_key, dispatcher.jobs_key],
+                                  args=[deadline])
+
+
+def promote(dispatcher, now):
+    return dispatcher._promote_script(keys=[dispatcher.scheduled_key, dispatcher.queue_key], args=[now, 100])
+
+
+def test_enqueue_in_pipeline_is_written_with_the_pipeline(dispatcher, redis_client):
+    pipe = redis_client.pipeline()
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1}, pipe=pipe)
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 0, 'dead': 0}
+
+    pipe.execute()
+    assert dispatcher.stats() == {'queued': 1, 'scheduled': 0, 'dead': 0}
+    assert json.loads(redis_client.hget(dispatcher.jobs_key, job_id))['payload'] == {'amount': 1}
+
+
+def test_delivered_job_is_acked_once(dispatcher, results, redis_client):
+    session = FakeSession(FakeResponse(200, {'transaction_id': 'a1'}))
+    dispatcher.session = lambda: session
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+
+    run_worker(dispatcher, 2)
+
+    assert session.requests == [('http://app/confirm_topup', {'amount': 1})]
+    assert results['success'] == [(job_id, {'transaction_id': 'a1'})]
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 0, 'dead': 0}
+    assert redis_client.hlen(dispatcher.jobs_key) == 0
+
+
+def test_popped_job_is_redelivered_after_visibility_timeout(dispatcher, clock):
+    dispatcher.deliver = lambda job: (_ for _ in ()).throw(RuntimeError('worker crashed'))
+    dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+
+    # Lỗi khi gửi không làm dừng worker, job vẫn được giữ trong scheduled
+    run_worker(dispatcher, 2)
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 1, 'dead': 0}
+
+    assert promote(dispatcher, clock.now + 59) == 0
+    assert promote(dispatcher, clock.now + 60) == 1
+    assert dispatcher.stats() == {'queued': 1, 'scheduled': 0, 'dead': 0}
+
+
+def test_retryable_failures_are_retried_then_dead_lettered(dispatcher, results, clock, redis_client):
+    session = FakeSession(FakeResponse(503), requests.exceptions.ConnectionError('refused'))
+    dispatcher.session = lambda: session
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+
+    run_worker(dispatcher)
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 1, 'dead': 0}
+    assert promote(dispatcher, clock.now + 9) == 0
+    assert promote(dispatcher, clock.now + 10) == 1
+
+    run_worker(dispatcher)
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 0, 'dead': 1}
+    assert results['dead'] == [job_id]
+    [dead] = dispatcher.dead_letters()
+    assert dead['attempts'] == 2 and 'refused' in dead['last_error']
+
+    assert dispatcher.replay_dead_letters() == 1
+    assert dispatcher.stats() == {'queued': 1, 'scheduled': 0, 'dead': 0}
+    replayed = json.loads(redis_client.hget(dispatcher.jobs_key, job_id))
+    assert replayed['attempts'] == 0 and 'last_error' not in replayed
+    assert redis_client.hlen(dispatcher.dead_jobs_key) == 0
+
+
+def test_client_errors_are_not_retried(dispatcher, results):
+    dispatcher.session = lambda: FakeSession(FakeResponse(400))
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+
+    run_worker(dispatcher)
+
+    assert results == {'success': [], 'dead': [job_id]}
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 0, 'dead': 1}
+
+
+def test_job_delivered_twice_is_acked_and_recorded_once(dispatcher, redis_client):
+    results = []
+    dispatcher.on_result('topup', on_success=lambda job, data: results.append(('success', data)),
+                         on_ack=lambda job, data, pipe: pipe.incr('acked'))
+    dispatcher.session = lambda: FakeSession(FakeResponse(200, {'transaction_id': 'a1'}))
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+    job = json.loads(redis_client.hget(dispatcher.jobs_key, job_id))
+
+    # Hai worker cùng gửi một job (job được lấy lại sau visibility_timeout khi lần gửi đầu còn chưa xong)
+    dispatcher.deliver(dict(job))
+    dispatcher.deliver(dict(job))
+
+    assert results == [('success', {'transaction_id': 'a1'})]
+    assert redis_client.get('acked') == b'1'
+    assert redis_client.hlen(dispatcher.jobs_key) == 0
+
+
+@pytest.mark.parametrize('failure', [FakeResponse(503), FakeResponse(400)])
+def test_failure_of_a_job_acked_by_another_delivery_is_ignored(dispatcher, results, redis_client, failure):
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+    job = json.loads(pop(dispatcher, 0))
+
+    # Lần gửi đầu quá visibility_timeout, lần gửi thứ hai thành công rồi lần đầu mới trả về lỗi
+    dispatcher.session = lambda: FakeSession(FakeResponse(200, {}))
+    dispatcher.deliver(dict(job))
+    dispatcher.session = lambda: FakeSession(failure)
+    dispatcher.deliver(dict(job))
+
+    assert results == {'success': [(job_id, {})], 'dead': []}
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 0, 'dead': 0}
+    assert redis_client.hlen(dispatcher.jobs_key) == 0
+
+
+def test_pop_skips_ids_of_jobs_that_were_already_acked(dispatcher, redis_client):
+    acked = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+    live = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 2})
+    redis_client.hdel(dispatcher.jobs_key, acked)
+
+    assert json.loads(pop(dispatcher, 0))['id'] == live
+    assert dispatcher.stats() == {'queued': 0, 'scheduled': 1, 'dead': 0}
+
+
+def test_ack_is_not_retried_when_other_jobs_change(dispatcher, redis_client, monkeypatch):
+    dispatcher.session = lambda: FakeSession(FakeResponse(200, {}))
+    job_id = dispatcher.enqueue('topup', '/confirm_topup', {'amount': 1})
+    job = json.loads(redis_client.hget(dispatcher.jobs_key, job_id))
+    attempts = []
+
+    def on_ack(job, data, pipe):
+        attempts.append(job['id'])
+        # Một worker khác thêm job mới trong lúc job này đang được ack
+        if len(attempts) == 1:
+            dispatcher.enqueue('topup', '/confirm_topup', {'amount': 2})
+
+    dispatcher.on_result('topup', on_ack=on_ack)
+    dispatcher.deliver(job)
+
+    assert attempts == [job_id]
+    assert dispatcher.stats()['queued'] == 2
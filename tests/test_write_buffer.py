@@ -0,0 +1,92 @@
+import pytest
+import redis
+
+from write_buffer import WriteAheadBuffer, WriteBufferFull
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    return WriteAheadBuffer(str(tmp_path / 'wal'))
+
+
+def test_replay_handles_entries_in_order_and_removes_them(buffer):
+    for key in ('e1', 'e2', 'e3'):
+        buffer.append({'key': key})
+    assert buffer.pending() == 3
+
+    handled = []
+    assert buffer.replay(lambda entry: handled.append(entry['key']) or 'processed') == 3
+    assert handled == ['e1', 'e2', 'e3']
+    assert buffer.pending() == 0
+    assert buffer.paths() == []
+
+
+def test_replay_stops_at_first_error_and_keeps_remaining_entries(buffer):
+    for key in ('e1', 'e2', 'e3'):
+        buffer.append({'key': key})
+
+    def handler(entry):
+        if entry['key'] == 'e2':
+            raise redis.exceptions.ConnectionError('down')
+        return 'processed'
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        buffer.replay(handler)
+    assert buffer.pending() == 2
+
+    handled = []
+    buffer.replay(lambda entry: handled.append(entry['key']) or 'duplicate')
+    assert handled == ['e2', 'e3']
+
+
+def test_corrupt_lines_are_skipped(buffer):
+    buffer.append({'key': 'e1'})
+    with open(buffer.path(), 'ab') as f:
+        f.write(b'{"key": "half-writ\n')
+
+    handled = []
+    assert buffer.replay(lambda entry: handled.append(entry['key']) or 'processed') == 2
+    assert handled == ['e1']
+
+
+def test_append_fails_when_buffer_is_full(tmp_path):
+    buffer = WriteAheadBuffer(str(tmp_path), max_bytes=40)
+    buffer.append({'key': 'e1'})
+
+    with pytest.raises(WriteBufferFull):
+        buffer.append({'key': 'x' * 40})
+    assert buffer.pending() == 1
+
+
+def test_disabled_buffer_has_nothing_pending():
+    buffer = WriteAheadBuffer('')
+    assert not buffer.enabled
+    assert buffer.pending() == 0
+
+
+def test_emails_read_during_outage_are_buffered_and_replayed(main, imap_server, redis_server, tmp_path, monkeypatch):
+    from corpus import CAKE_SENDER, cake_alert_email
+    from email_watcher import open_imap_connection
+    from mailbox_sources import MailboxSource
+
+    monkeypatch.setattr(main.write_buffer, 'directory', str(tmp_path / 'wal'))
+    response = main.app.test_client().post('/create_transaction', json={'transaction_id': 'order-1', 'amount': 50_000},
+                                           headers={'Authorization': 'Bearer test-key'})
+    code = response.get_json()['code']
+    imap_server.deliver(cake_alert_email(50_000, f'CK {code}'))
+    source = MailboxSource('default', 'user', 'secret', senders=[CAKE_SENDER])
+    mail = open_imap_connection('127.0.0.1', imap_server.port, use_ssl=False, timeout=5)
+    mail.login('user', 'secret')
+    mail.select('inbox')
+
+    # Redis không phản hồi từ trước khi đọc high-water mark: email vẫn được đọc và đệm ra đĩa
+    redis_server.connected = False
+    main.process_unseen_emails(mail, source)
+    mail.logout()
+    assert main.write_buffer.pending() == 1
+    assert all('\\Seen' in message.flags for message in imap_server.messages)
+
+    redis_server.connected = True
+    assert main.write_buffer.replay(main.replay_buffered_email) == 1
+    assert main.transaction_status_response(code)['status'] == 'completed'
+    assert main.write_buffer.pending() == 0